@@ -0,0 +1,105 @@
+import os
+from . import envs
+from . import var
+from .acpi_data import ACPI_STRINGS
+from .host import get_host_facts
+from .log_utils import get_logger
+
+NVIDIA_VENDOR_ID = "0x10de"
+
+
+def get_acpi_call_candidates():
+    # `ACPI_STRINGS` narrowed down to the calls whose device exists in the ACPI namespace,
+    # the ones bound to the Nvidia card first. Cached per board and firmware version.
+    logger = get_logger()
+    fingerprint = get_host_facts().dmi_fingerprint
+
+    try:
+        cache = var.read_acpi_candidates_cache()
+
+    except var.VarError:
+        cache = {}
+
+    if fingerprint in cache:
+        return [tuple(strings) for strings in cache[fingerprint]]
+
+    acpi_devices = _read_acpi_devices()
+
+    if acpi_devices is None:
+        logger.info("ACPI namespace unavailable: Trying all ACPI calls (may polute the kernel log)")
+        return list(ACPI_STRINGS)
+
+    candidates = _rank_candidates(ACPI_STRINGS, acpi_devices)
+    logger.info("ACPI calls matching this machine: %d of %d", len(candidates), len(ACPI_STRINGS))
+
+    if len(candidates) == 0:
+        logger.info("Trying all ACPI calls (may polute the kernel log)")
+        return list(ACPI_STRINGS)
+
+    cache[fingerprint] = candidates
+
+    try:
+        var.write_acpi_candidates_cache(cache)
+
+    except var.VarError as error:
+        logger.info("Not caching ACPI call candidates: %s", str(error))
+
+    return candidates
+
+
+def _read_acpi_devices():
+    # Maps every ACPI device path to whether it is bound to the Nvidia card
+    try:
+        names = os.listdir(envs.ACPI_DEVICES_PATH)
+
+    except OSError:
+        return None
+
+    acpi_devices = {}
+
+    for name in names:
+        device_path = os.path.join(envs.ACPI_DEVICES_PATH, name)
+
+        try:
+            with open(os.path.join(device_path, "path"), "r") as pathfile:
+                acpi_path = pathfile.read().strip()
+
+        except IOError:
+            continue
+
+        try:
+            with open(os.path.join(device_path, "physical_node", "vendor"), "r") as vendorfile:
+                is_nvidia = vendorfile.read().strip().lower() == NVIDIA_VENDOR_ID
+
+        except IOError:
+            is_nvidia = False
+
+        acpi_devices[acpi_path] = acpi_devices.get(acpi_path, False) or is_nvidia
+
+    return acpi_devices
+
+
+def _rank_candidates(acpi_strings, acpi_devices):
+    nvidia_candidates = []
+    other_candidates = []
+
+    for off_str, on_str in acpi_strings:
+        # The method is the last segment: `\_SB.PCI0.PEG0.PEGP._OFF` -> `\_SB_.PCI0.PEG0.PEGP`
+        device_path = _normalize_acpi_path(off_str.rsplit(".", 1)[0])
+
+        if device_path not in acpi_devices:
+            continue
+
+        if acpi_devices[device_path]:
+            nvidia_candidates.append((off_str, on_str))
+
+        else:
+            other_candidates.append((off_str, on_str))
+
+    return nvidia_candidates + other_candidates
+
+
+def _normalize_acpi_path(acpi_path):
+    # sysfs pads every name segment to 4 characters: `\_SB.PCI0.PEG` -> `\_SB_.PCI0.PEG_`
+    segments = acpi_path.lstrip("\\").split(".")
+    return "\\" + ".".join(segment.ljust(4, "_") for segment in segments)
@@ -1,9 +1,11 @@
-import dbus
 import os
 import re
-import subprocess
+import shutil
 from ctypes import byref, c_int, c_uint, c_void_p, CDLL, POINTER, Structure
-from pathlib import Path
+from . import envs
+from . import kmod
+from . import runner
+from .host import get_host_facts
 from .log_utils import get_logger
 
 
@@ -12,22 +14,26 @@ class CheckError(Exception):
 
 
 def check_running_graphical_session():
-    return subprocess.run(
-        "xhost",
-        shell=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    ).returncode == 0
+    return runner.run(["xhost"], check=False).returncode == 0
 
 
 def is_ac_power_connected():
-    for power_source_path in Path("/sys/class/power_supply/").iterdir():
+    # Not a host fact: supplies come and go during a boot, like USB-C docks
+    try:
+        names = os.listdir(envs.POWER_SUPPLY_PATH)
+
+    except OSError:
+        return False
+
+    for name in names:
+        power_source_path = os.path.join(envs.POWER_SUPPLY_PATH, name)
+
         try:
-            with open(power_source_path / "type", 'r') as f:
+            with open(os.path.join(power_source_path, "type"), 'r') as f:
                 if f.read().strip() != "Mains":
                     continue
 
-            with open(power_source_path / "online", 'r') as f:
+            with open(os.path.join(power_source_path, "online"), 'r') as f:
                 if f.read(1) == "1":
                     return True
 
@@ -81,10 +87,7 @@ def is_nvidia_display_connected():
 
 
 def is_pat_available():
-    return subprocess.run(
-        "grep -E '^flags.+ pat( |$)' /proc/cpuinfo",
-        shell=True, stdout=subprocess.DEVNULL
-    ).returncode == 0
+    return "pat" in get_host_facts().cpu_flags
 
 
 def get_active_renderer():
@@ -96,10 +99,9 @@ def get_active_renderer():
 
 def get_integrated_provider():
     try:
-        out = subprocess.check_output(
-                "xrandr --listproviders", shell=True, text=True, stderr=subprocess.PIPE).strip()
+        out = runner.run(["xrandr", "--listproviders"], capture_output=True).stdout.strip()
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         raise CheckError(f"No xrandr provider: {error.stderr}") from error
 
     for line in out.splitlines():
@@ -111,17 +113,15 @@ def get_integrated_provider():
 
 
 def is_module_available(module_name):
-    return subprocess.run(
-        f"modinfo -n {module_name}",
-        shell=True, stdout=subprocess.DEVNULL
-    ).returncode == 0
+    try:
+        return kmod.load_module_index().is_available(module_name)
+
+    except kmod.KmodError:
+        return False
 
 
 def is_module_loaded(module_name):
-    return subprocess.run(
-        f"lsmod | grep -E \"^{module_name}\"",
-        shell=True, stdout=subprocess.DEVNULL
-    ).returncode == 0
+    return kmod.read_module_state().is_loaded(module_name)
 
 
 def get_current_display_manager():
@@ -142,10 +142,9 @@ def using_patched_GDM():
 
 def check_offloading_available():
     try:
-        out = subprocess.check_output(
-            "xrandr --listproviders", shell=True, text=True, stderr=subprocess.PIPE).strip()
+        out = runner.run(["xrandr", "--listproviders"], capture_output=True).stdout.strip()
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         raise CheckError(f"Unable to list xrandr providers: {error.stderr}") from error
 
     for line in out.splitlines():
@@ -177,11 +176,11 @@ def is_bumblebeed_service_active():
 
 def _is_gl_provider_nvidia():
     try:
-        out = subprocess.check_output(
-            "__NV_PRIME_RENDER_OFFLOAD=0 glxinfo",
-            shell=True, text=True, stderr=subprocess.PIPE).strip()
+        out = runner.run(
+            ["glxinfo"], capture_output=True,
+            env=dict(os.environ, __NV_PRIME_RENDER_OFFLOAD="0")).stdout.strip()
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         raise CheckError(f"glxinfo failed: {error.stderr}") from error
 
     for line in out.splitlines():
@@ -194,16 +193,20 @@ def _is_gl_provider_nvidia():
 def _is_service_active(service_name):
     logger = get_logger()
 
-    if subprocess.run(f"which sv", shell=True).returncode == 0:
+    if shutil.which("sv"):
         return _is_service_active_sv(service_name)
 
-    if subprocess.run(f"which rc-status", shell=True).returncode == 0:
+    if shutil.which("rc-status"):
         return _is_service_active_openrc(service_name)
 
-    if subprocess.run(f"which s6-svstat", shell=True).returncode == 0:
+    if shutil.which("s6-svstat"):
         return _is_service_active_s6(service_name)
 
-    if subprocess.run(f"which systemctl", shell=True).returncode == 0:
+    if shutil.which("systemctl"):
+        # The D-Bus bindings are only needed here, not by the hooks and tests importing this module
+        # pylint: disable=C0415
+        import dbus
+
         try:
             system_bus = dbus.SystemBus()
 
@@ -220,6 +223,9 @@ def _is_service_active(service_name):
 
 
 def _is_service_active_dbus(system_bus, service_name):
+    # pylint: disable=C0415
+    import dbus
+
     systemd = system_bus.get_object("org.freedesktop.systemd1", "/org/freedesktop/systemd1")
 
     try:
@@ -235,15 +241,16 @@ def _is_service_active_dbus(system_bus, service_name):
 
 
 def _is_service_active_bash(service_name):
-    return subprocess.run(
-        f"systemctl is-active {service_name}", shell=True
-    ).returncode == 0
+    return runner.run(["systemctl", "is-active", service_name], check=False).returncode == 0
 
 
 def _is_service_active_openrc(service_name):
-    if subprocess.run(f"rc-status --nocolor default | grep -E '%s.*started'" % service_name, shell=True).returncode == 0:
-        return True
-    return False
+    out = runner.run(["rc-status", "--nocolor", "default"], check=False, capture_output=True).stdout
+
+    return any(
+        re.search("%s.*started" % service_name, line)
+        for line in out.splitlines()
+    )
 
 
 def _is_service_active_s6(service_name):
@@ -252,7 +259,5 @@ def _is_service_active_s6(service_name):
 
 
 def _is_service_active_sv(service_name):
-    if subprocess.run(f"sv status %s | grep 'up: '" % service_name, shell=True).returncode == 0:
-        return True
-
-    return False
+    out = runner.run(["sv", "status", service_name], check=False, capture_output=True).stdout
+    return "up: " in out
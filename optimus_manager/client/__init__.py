@@ -1,26 +1,30 @@
 #! /usr/bin/env python3
 import argparse
-import json
 import os
-import socket
 import sys
 from .args import parse_args
 from .error_reporting import report_errors
 from .client_checks import run_switch_checks
 from .. import checks
 from .. import envs
+from .. import processes
+from .. import protocol
 from .. import sessions
-from ..config import load_config, ConfigError
+from ..config import config_from_dict, load_config, ConfigError
 from ..kernel_parameters import get_kernel_parameters
-from ..var import read_temp_conf_path_var, load_state, VarError
+from ..pci import PciTopology
+from ..plan import format_plan
+from ..switch import compile_switch_plan
+from ..var import get_status, load_state
 from ..xorg import cleanup_xorg_conf
 
 
 def main():
     args = parse_args()
-    state = load_state()
+    status, config_result = _get_status_and_config()
+    state = status["state"]
     fatal = report_errors(state)
-    config = _get_config()
+    config = _get_config(config_result)
 
     if args.version:
         _print_version()
@@ -28,6 +32,9 @@ def main():
     elif args.print_startup:
         _print_startup_mode(config)
 
+    elif args.gpu_users:
+        _print_gpu_users()
+
     elif args.temp_config:
         _set_temp_config_and_exit(args.temp_config)
 
@@ -45,13 +52,13 @@ def main():
             _print_current_mode(state)
 
         elif args.print_next_mode:
-            _print_next_mode(state)
+            _print_next_mode(status)
 
         elif args.status:
-            _print_status(config, state)
+            _print_status(config, status)
 
         elif args.switch:
-            _gpu_switch(config, args.switch, args.no_confirm)
+            _gpu_switch(config, state, args.switch, args.no_confirm, args.dry_run)
 
         else:
             print("Invalid arguments")
@@ -74,7 +81,7 @@ def _ask_confirmation():
         return False
 
 
-def _gpu_switch(config, switch_mode, no_confirm):
+def _gpu_switch(config, state, switch_mode, no_confirm, dry_run):
     if switch_mode not in ["integrated", "nvidia", "hybrid", "intel"]:
         print("Invalid mode: %s" % switch_mode)
         sys.exit(1)
@@ -82,9 +89,13 @@ def _gpu_switch(config, switch_mode, no_confirm):
     if switch_mode == "intel":
         switch_mode = "integrated"
 
+    if dry_run:
+        _print_switch_plan(config, state, switch_mode)
+        return
+
     run_switch_checks(config, switch_mode)
 
-    if config["optimus"]["auto_logout"] == "yes":
+    if config.optimus.auto_logout:
         if no_confirm:
             confirmation = True
 
@@ -105,20 +116,26 @@ def _gpu_switch(config, switch_mode, no_confirm):
         print("The change will apply on next login")
 
 
+def _print_switch_plan(config, state, requested_mode):
+    current_mode = state["current_mode"]
+    plan = compile_switch_plan(config, PciTopology(), current_mode, requested_mode)
+    print("Switch plan: %s -> %s" % (current_mode, requested_mode))
+    print(format_plan(plan))
+
+
 def _send_switch_command(config, requested_mode):
     print("Switching to mode : %s" % requested_mode)
     command = {"type": "switch", "args": {"mode": requested_mode}}
     _send_command(command)
 
-    if config["optimus"]["auto_logout"] == "yes":
+    if config.optimus.auto_logout:
         sessions.logout_current_desktop_session()
 
 
-def _get_config():
-    try:
-        config = load_config()
+def _get_config(config_result):
+    config, error = config_result
 
-    except ConfigError as error:
+    if error is not None:
         print("Error loading config file: %s" % str(error))
         sys.exit(1)
 
@@ -133,18 +150,12 @@ def _print_current_mode(state):
     print("Current mode: %s" % state["current_mode"])
 
 
-def _print_next_mode(state):
-    if state["type"] == "pending_pre_xorg_start":
-        res_str = state["requested_mode"]
-
-    else:
-        res_str = "Current"
-
-    print("Mode for next login: %s" % res_str)
+def _print_next_mode(status):
+    print("Mode for next login: %s" % (status["next_mode"] or "Current"))
 
 
 def _print_startup_mode(config):
-    startup_mode = config["optimus"]["startup_mode"]
+    startup_mode = config.optimus.startup_mode
     kernel_parameters = get_kernel_parameters()
 
     print("Startup mode: %s" % startup_mode)
@@ -154,37 +165,77 @@ def _print_startup_mode(config):
             % kernel_parameters["startup_mode"])
 
 
-def _print_temp_config_path():
+def _print_gpu_users():
+    if os.geteuid() != 0:
+        print("Not root: Only showing processes of the current user")
+
     try:
-        path = read_temp_conf_path_var()
+        device_paths = processes.get_nvidia_device_paths(PciTopology())
+        gpu_users = processes.find_gpu_users(device_paths)
 
-    except VarError:
-        print("Temporary config: None")
+    except processes.ProcessesError as error:
+        print("Unable to find processes using the Nvidia GPU: %s" % str(error))
+        sys.exit(1)
 
-    else:
-        print("Temporary config: %s" % path)
+    if len(gpu_users) == 0:
+        print("No process is using the Nvidia GPU")
+        return
+
+    print("%-8s %-12s %-22s %s" % ("PID", "USER", "DEVICE", "COMMAND"))
+
+    for gpu_user in gpu_users:
+        print("%-8d %-12s %-22s %s" % (gpu_user.pid, gpu_user.user, gpu_user.device, gpu_user.cmdline))
 
 
-def _print_status(config, state):
+def _print_temp_config_path(status):
+    print("Temporary config: %s" % status["temp_config_path"])
+
+
+def _print_status(config, status):
     _print_version()
     print("")
-    _print_current_mode(state)
-    _print_next_mode(state)
+    _print_current_mode(status["state"])
+    _print_next_mode(status)
     _print_startup_mode(config)
-    _print_temp_config_path()
+    _print_temp_config_path(status)
 
 
-def _send_command(command):
-    msg = json.dumps(command).encode('utf-8')
+def _get_status_and_config():
+    # From the daemon in a single round trip, or read here if it isn't running.
+    # The config comes as `(config, None)`, or `(None, error)` if it can't be loaded:
+    # the state is reported first.
+    try:
+        status, config_dict = protocol.send_requests([
+            {"type": "get_status", "args": {}},
+            {"type": "get_config", "args": {}}
+        ])
+
+    except protocol.RequestError as error:
+        # Only loading the config fails
+        return get_status(load_state()), (None, ConfigError(str(error)))
+
+    except protocol.ProtocolError:
+        status = get_status(load_state())
+
+        try:
+            return status, (load_config(), None)
 
+        except ConfigError as error:
+            return status, (None, error)
+
+    return status, (config_from_dict(config_dict), None)
+
+
+def _send_command(command):
     try:
-        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        client.connect(envs.SOCKET_PATH)
-        client.send(msg)
-        client.close()
+        protocol.send_request(command)
+
+    except protocol.RequestError as error:
+        print("The daemon refused the command: %s" % str(error))
+        sys.exit(1)
 
-    except (ConnectionRefusedError, OSError):
-        print("Socket unavailable: %s" % envs.SOCKET_PATH)
+    except protocol.ProtocolError as error:
+        print(str(error))
         sys.exit(1)
 
 
@@ -13,6 +13,9 @@ def parse_args():
     parser.add_argument('--no-confirm', '--now', action='store_true',
                         help="Skips the confirmation for loggin out")
 
+    parser.add_argument('--dry-run', action='store_true',
+                        help="With --switch, prints the operations the switch would run, without switching")
+
     # PRINT OPTIONS
 
     parser.add_argument('--status', action='store_true',
@@ -27,6 +30,9 @@ def parse_args():
     parser.add_argument('--print-startup', '--startup-mode', action='store_true',
                         help="Prints the GPU mode that will be used on startup")
 
+    parser.add_argument('--gpu-users', action='store_true',
+                        help="Prints the processes using the Nvidia GPU")
+
     parser.add_argument('-v', '--version', action='store_true',
                         help='Prints the version')
 
@@ -12,7 +12,7 @@ def run_switch_checks(config, requested_mode):
 
 
 def _check_bbswitch_module(config):
-    if config["optimus"]["switching"] == "bbswitch" and not checks.is_module_available("bbswitch"):
+    if config.optimus.switching == "bbswitch" and not checks.is_module_available("bbswitch"):
         print("Not properly installed: bbswitch")
         sys.exit(1)
 
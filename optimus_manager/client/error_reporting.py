@@ -22,6 +22,7 @@ def report_errors(state):
 
     elif state["type"] == "pre_xorg_start_failed":
         print("GPU setup failed: Xorg pre-start hook failed")
+        _print_failed_step(state)
         print("Log at: %s/switch/switch-%s.log" % (envs.LOG_DIR_PATH, state["switch_id"]))
         return True
 
@@ -32,6 +33,7 @@ def report_errors(state):
 
     elif state["type"] == "post_xorg_start_failed":
         print("GPU setup failed: Xorg post-start hook failed")
+        _print_failed_step(state)
         print("Log at: %s/switch/switch-%s.log" % (envs.LOG_DIR_PATH, state["switch_id"]))
         return True
 
@@ -64,3 +66,8 @@ def report_errors(state):
 
     else:
         assert False
+
+
+def _print_failed_step(state):
+    if "failed_step" in state:
+        print("Timed out at: %s (see switch_timeout)" % state["failed_step"])
@@ -1,61 +1,113 @@
 import configparser
-import copy
 import json
 import os
 import shutil
 from pathlib import Path
 from . import envs
+from . import protocol
 from . import var
 from .log_utils import get_logger
 
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_schema.json")
+
+# Values still accepted from older configs, and what they are read as
+DEPRECATED_VALUES = {
+    ("optimus", "startup_mode"): {"intel": "integrated"},
+    ("optimus", "startup_auto_battery_mode"): {"intel": "integrated"},
+    ("optimus", "startup_auto_extpower_mode"): {"intel": "integrated"}
+}
+
+_compiled_schema = None
+
 
 class ConfigError(Exception):
     pass
 
 
+def get_config():
+    # The config held by the daemon, or parsed here if the daemon isn't running
+    try:
+        config_dict = protocol.send_request({"type": "get_config", "args": {}})
+
+    except protocol.RequestError as error:
+        raise ConfigError(str(error)) from error
+
+    except protocol.ProtocolError:
+        return load_config()
+
+    return config_from_dict(config_dict)
+
+
 def load_config():
-    config = _load_config()
-    config = _convert_deprecated(config)
+    # The default config, with the options set in the user config copy replacing its values.
+    # Invalid user values fall back to the default ones, invalid default values are fatal.
+    # The result is cached for as long as the config files and the schema don't change.
+    logger = get_logger()
+    files_key = _get_config_files_key()
+
+    try:
+        cache = var.read_compiled_config()
+
+    except var.VarError:
+        cache = None
+
+    if cache is not None and cache.get("key") == files_key:
+        return config_from_dict(cache["config"])
+
+    config = _compile_config()
+
+    if not var.is_files_key_racy(files_key):
+        try:
+            var.write_compiled_config({"key": files_key, "config": config.to_dict()})
+
+        except var.VarError as error:
+            logger.debug("Not caching the config: %s", str(error))
+
     return config
 
 
-def _load_config():
+def _compile_config():
     logger = get_logger()
-    base_config = configparser.ConfigParser()
-    base_config.read(envs.DEFAULT_CONFIG_PATH)
-    base_config = _parsed_config_to_dict(base_config)
-    _validate_config(base_config)
+    base_config = _read_config_file(envs.DEFAULT_CONFIG_PATH)
+    user_config = {}
+
+    if os.path.isfile(envs.USER_CONFIG_COPY_PATH):
+        try:
+            user_config = _read_config_file(envs.USER_CONFIG_COPY_PATH)
 
-    if not os.path.isfile(envs.USER_CONFIG_COPY_PATH):
-        return base_config
+        except configparser.Error as error:
+            logger.error(
+                "Falling back to default config: Defective user config: %s: %s",
+                envs.USER_CONFIG_COPY_PATH, str(error))
 
-    try:
-        user_config = configparser.ConfigParser()
-        user_config.read([envs.DEFAULT_CONFIG_PATH, envs.USER_CONFIG_COPY_PATH])
-        user_config = _parsed_config_to_dict(user_config)
+    return _build_config(base_config, user_config)
 
-    except configparser.ParsingError as error:
-        logger.error(
-            "Falling back to default config: Defective user config: %s: %s",
-            envs.USER_CONFIG_COPY_PATH, str(error))
 
-        return base_config
+def config_from_dict(config_dict):
+    # Inverse of `Config.to_dict`
+    return _build_config(config_dict, {})
 
-    corrected_config = _validate_config(user_config, fallback_config=base_config)
-    return corrected_config
 
+class Config:
+    # Typed values by section: `config.optimus.pci_power_control` is a bool, `config.nvidia.dpi`
+    # an int or None. `config["optimus"]["pci_power_control"]` is still the string "yes".
+    # The sections are attributes of a subclass made from the schema, see `_compile_schema`.
+    __slots__ = ["_raw"]
 
-def _convert_deprecated(config):
-    if config["optimus"]["startup_mode"] == "intel":
-        config["optimus"]["startup_mode"] = "integrated"
+    def __getitem__(self, section):
+        return self._raw[section]
 
-    if config["optimus"]["startup_auto_battery_mode"] == "intel":
-        config["optimus"]["startup_auto_battery_mode"] = "integrated"
+    def to_dict(self):
+        # The raw strings, by section then option
+        return {section: dict(options) for section, options in self._raw.items()}
 
-    if config["optimus"]["startup_auto_extpower_mode"] == "intel":
-        config["optimus"]["startup_auto_extpower_mode"] = "integrated"
 
-    return config
+class ConfigSection:
+    # The options are attributes of a subclass made per section
+    __slots__ = ["_raw"]
+
+    def __getitem__(self, option):
+        return self._raw[option]
 
 
 def copy_user_config():
@@ -87,140 +139,219 @@ def copy_user_config():
         shutil.copy(config_path, copy_path)
 
 
-def _validate_config(config, fallback_config=None):
-    logger = get_logger()
-    folder_path = os.path.dirname(os.path.abspath(__file__))
-    schema_path = os.path.join(folder_path, "config_schema.json")
+def _get_config_files_key():
+    # Changes whenever one of the files the config is compiled from does
+    return var.get_files_key([envs.DEFAULT_CONFIG_PATH, envs.USER_CONFIG_COPY_PATH, SCHEMA_PATH])
+
+
+def _read_config_file(path):
+    parser = configparser.ConfigParser()
+    parser.read(path)
+
+    return {
+        section: dict(parser[section])
+        for section in parser.sections()
+    }
 
-    with open(schema_path, "r") as schemapath:
-        schema = json.load(schemapath)
 
-    corrected_config = copy.deepcopy(config)
+def _build_config(base_config, user_config):
+    # Validates every option once, in a single pass over the compiled schema
+    logger = get_logger()
+    config_class, section_schemas = _get_compiled_schema()
+    config = config_class()
+    config._raw = {}
 
-    # Checking for required sections and options
-    for section in schema.keys():
-        if section not in config.keys():
+    for section, (section_class, validators, deprecated_values) in section_schemas.items():
+        if section not in base_config:
             raise ConfigError("No header for section: [%s]" % section)
 
-        for option in schema[section].keys():
-            if option not in config[section].keys():
+        base_section = base_config[section]
+        user_section = user_config.get(section, {})
+        config_section = section_class()
+        raw_section = {}
+
+        for option, validator in validators.items():
+            if option not in base_section:
                 raise ConfigError("Missing option \"%s\" in section \"[%s]\"" % (option, section))
 
-            valid, msg = _validate_option(schema[section][option], config[section][option])
+            raw_value = user_section.get(option, base_section[option])
 
-            if not valid:
-                error_msg = "Invalid option \"%s\" in section \"[%s]\": %s" % (option, section, msg)
+            try:
+                value = validator.parse(raw_value)
 
-                if fallback_config is not None:
-                    logger.error(error_msg)
-                    logger.info("Falling back to default value: %s", fallback_config[section][option])
-                    corrected_config[section][option] = fallback_config[section][option]
+            except ValueError as error:
+                error_msg = "Invalid option \"%s\" in section \"[%s]\": %s" % (option, section, str(error))
 
-                else:
-                    raise ConfigError(error_msg)
+                if option not in user_section:
+                    raise ConfigError(error_msg) from error
 
-    # Checking for unknown sections or options
-    for section in config.keys():
-        if section not in schema.keys():
-            logger.warning("Ignoring unknown section: [%s]", section)
-            continue
+                logger.error(error_msg)
+                logger.info("Falling back to default value: %s", base_section[option])
+                raw_value = base_section[option]
 
-        for option in config[section].keys():
-            if option not in schema[section].keys():
-                logger.warning("Ignoring unknown option \"%s\" in section \"[%s]\"", option, section)
-                del corrected_config[section][option]
+                try:
+                    value = validator.parse(raw_value)
 
-    return corrected_config
+                except ValueError as base_error:
+                    raise ConfigError("Invalid option \"%s\" in section \"[%s]\": %s" % (
+                        option, section, str(base_error))) from base_error
 
+            if option in deprecated_values and value in deprecated_values[option]:
+                raw_value = deprecated_values[option][value]
+                value = validator.parse(raw_value)
 
-def _parsed_config_to_dict(config):
-    config_dict = {}
+            setattr(config_section, option, value)
+            raw_section[option] = raw_value
 
-    for section in config.keys():
-        if section == "DEFAULT":
-            continue
+        config_section._raw = raw_section
+        setattr(config, section, config_section)
+        config._raw[section] = raw_section
 
-        config_dict[section] = {}
+        for option in (base_section.keys() | user_section.keys()) - validators.keys():
+            logger.warning("Ignoring unknown option \"%s\" in section \"[%s]\"", option, section)
 
-        for option in config[section].keys():
-            config_dict[section][option] = config[section][option]
+    for section in (base_config.keys() | user_config.keys()) - section_schemas.keys():
+        logger.warning("Ignoring unknown section: [%s]", section)
 
-    return config_dict
+    return config
 
 
-def _validate_option(schema_option_info, config_option_value):
+def _get_compiled_schema():
+    global _compiled_schema
+
+    if _compiled_schema is None:
+        with open(SCHEMA_PATH, "r") as schemafile:
+            _compiled_schema = _compile_schema(json.load(schemafile))
+
+    return _compiled_schema
+
+
+def _compile_schema(schema):
+    # Returns the `Config` subclass, and by section its `ConfigSection` subclass,
+    # option validators and deprecated values
+    config_class = type("SchemaConfig", (Config,), {"__slots__": list(schema.keys())})
+    section_schemas = {}
+
+    for section, options in schema.items():
+        section_class = type(
+            "%sConfigSection" % section.capitalize(), (ConfigSection,), {"__slots__": list(options.keys())})
+
+        validators = {
+            option: _make_validator(schema_option_info)
+            for option, schema_option_info in options.items()
+        }
+
+        deprecated_values = {
+            option: values
+            for (values_section, option), values in DEPRECATED_VALUES.items()
+            if values_section == section
+        }
+
+        section_schemas[section] = (section_class, validators, deprecated_values)
+
+    return config_class, section_schemas
+
+
+def _make_validator(schema_option_info):
     parameter_type = schema_option_info[0]
     assert parameter_type in ["multi_words", "single_word", "integer"]
 
     if parameter_type == "multi_words":
-        valid, msg = _validate_multi_words(schema_option_info, config_option_value)
+        _, allowed_values, can_be_blank = schema_option_info
+        return _MultiWordsValidator(allowed_values, can_be_blank)
 
     elif parameter_type == "single_word":
-        valid, msg = _validate_single_word(schema_option_info, config_option_value)
+        _, allowed_values, can_be_blank = schema_option_info
+        return _SingleWordValidator(allowed_values, can_be_blank)
 
-    elif parameter_type == "integer":
-        valid, msg = _validate_integer(schema_option_info, config_option_value)
+    else:
+        _, can_be_blank = schema_option_info
+        return _IntegerValidator(can_be_blank)
 
-    return valid, msg
 
+class _SingleWordValidator:
+    # yes/no options are read as bools, numbers as ints, other words as strings.
+    # Blank is None.
+    __slots__ = ["_values", "_can_be_blank"]
 
-def _validate_multi_words(schema_option_info, config_option_value):
-    parameter_type, allowed_values, can_be_blank = schema_option_info
-    assert parameter_type == "multi_words"
-    values = config_option_value.replace(" ", "").split(",")
+    def __init__(self, allowed_values, can_be_blank):
+        if sorted(allowed_values) == ["no", "yes"]:
+            self._values = {"yes": True, "no": False}
 
-    if values == ['']:
-        if not can_be_blank:
-            msg = "At least one parameter required"
-            return False, msg
+        elif all(value.isdigit() for value in allowed_values):
+            self._values = {value: int(value) for value in allowed_values}
 
-    else:
-        for value in values:
-            if value not in allowed_values:
-                msg = "Invalid value: %s" % value
-                return False, msg
+        else:
+            self._values = {value: value for value in allowed_values}
 
-    return True, None
+        self._can_be_blank = can_be_blank
 
+    def parse(self, raw_value):
+        value = raw_value.replace(" ", "")
 
-def _validate_single_word(schema_option_info, config_option_value):
-    parameter_type, allowed_values, can_be_blank = schema_option_info
-    assert parameter_type == "single_word"
-    val = config_option_value.replace(" ", "")
+        if value == "":
+            if not self._can_be_blank:
+                raise ValueError("Non-blank value required")
 
-    if val == "":
-        if not can_be_blank:
-            msg = "Non-blank value required"
-            return False, msg
+            return None
 
-    else:
-        if val not in allowed_values:
-            msg = "Invalid value: %s" % val
-            return False, msg
+        try:
+            return self._values[value]
 
-    return True, None
+        except KeyError:
+            raise ValueError("Invalid value: %s" % value) from None
 
 
-def _validate_integer(schema_option_info, config_option_value):
-    parameter_type, can_be_blank = schema_option_info
-    assert parameter_type == "integer"
-    value = config_option_value.replace(" ", "")
+class _MultiWordsValidator:
+    # Read as a tuple of strings, empty if blank
+    __slots__ = ["_allowed_values", "_can_be_blank"]
 
-    if value == "":
-        if not can_be_blank:
-            msg = "Value can't be blank"
-            return False, msg
+    def __init__(self, allowed_values, can_be_blank):
+        self._allowed_values = frozenset(allowed_values)
+        self._can_be_blank = can_be_blank
+
+    def parse(self, raw_value):
+        values = raw_value.replace(" ", "").split(",")
+
+        if values == [""]:
+            if not self._can_be_blank:
+                raise ValueError("At least one parameter required")
+
+            return ()
+
+        for value in values:
+            if value not in self._allowed_values:
+                raise ValueError("Invalid value: %s" % value)
+
+        return tuple(values)
+
+
+class _IntegerValidator:
+    # Blank is None
+    __slots__ = ["_can_be_blank"]
+
+    def __init__(self, can_be_blank):
+        self._can_be_blank = can_be_blank
+
+    def parse(self, raw_value):
+        value = raw_value.replace(" ", "")
+
+        if value == "":
+            if not self._can_be_blank:
+                raise ValueError("Value can't be blank")
+
+            return None
 
-    else:
         try:
-            v = int(value)
-            if v < 0:
+            integer = int(value)
+
+            if integer < 0:
                 raise ValueError
+
         except ValueError:
-            msg = f"Positive integer required: {value}"
-            return False, msg
+            raise ValueError(f"Positive integer required: {value}") from None
 
-    return True, None
+        return integer
 
 
 def load_extra_xorg_options():
@@ -1,13 +1,18 @@
 #! /usr/bin/env python3
-import json
+import asyncio
 import os
-import select
 import signal
-import socket
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from . import envs
+from . import protocol
 from . import var
+from .config import load_config
 from .log_utils import get_logger, set_logger_config
+from .uevent import FileWatcher
+
+# Answered from memory on the event loop, the other commands go to the worker thread.
+# The config is loaded again on the worker thread first if it changed.
+QUERY_TYPES = ["get_state", "get_status", "get_config"]
 
 
 def main():
@@ -29,86 +34,172 @@ def main():
             logger.warning(
                 "Created a new daemon ID: The daemon pre-start hook failed to do so")
 
-        server_socket = _open_server_socket(logger)
-        _setup_signal_handler(logger, server_socket)
-        logger.info("Ready to receive commands")
-
-        while True:
-            msg = _wait_for_command(server_socket)
-            logger.info("Received command: %s", msg)
-            _process_command(logger, msg)
+        asyncio.run(_serve(logger))
 
     # pylint: disable=W0703
     except Exception:
         logger.exception("Daemon crashed")
 
 
-def _open_server_socket(logger):
+async def _serve(logger):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signum, stop_event.set)
+
+    await _run_server(logger, stop_event)
+
+
+async def _run_server(logger, stop_event):
+    # Commands touching files run one at a time on a worker thread,
+    # so that a slow one doesn't hold up the other clients
+    loop = asyncio.get_running_loop()
+
     if os.path.exists(envs.SOCKET_PATH):
         logger.warning("Overwriting existing socket: %s" % envs.SOCKET_PATH)
         os.remove(envs.SOCKET_PATH)
 
-    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-    server_socket.settimeout(envs.SOCKET_TIMEOUT)
-    server_socket.bind(envs.SOCKET_PATH)
+    executor = ThreadPoolExecutor(max_workers=1)
+    state_store = _StateStore()
+    config_store = _ConfigStore(logger, loop, executor)
+    config_store.start_watching()
+    clients = set()
+
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: _handle_client(logger, executor, state_store, config_store, clients, reader, writer),
+        path=envs.SOCKET_PATH, backlog=envs.SOCKET_BACKLOG)
+
     os.chmod(envs.SOCKET_PATH, 0o666)
-    return server_socket
+    logger.info("Ready to receive commands")
 
+    try:
+        await stop_event.wait()
 
-def _setup_signal_handler(logger, server_socket):
-    handler = _SignalHandler(logger, server_socket)
-    signal.signal(signal.SIGTERM, handler.handler)
-    signal.signal(signal.SIGINT, handler.handler)
+    finally:
+        logger.info("Stopping daemon...")
+        server.close()
 
+        # `wait_closed` waits for the connections to end from Python 3.12 on, and clients
+        # may keep theirs open. A command already sent still runs, its reply is lost.
+        for writer in list(clients):
+            writer.close()
 
-def _wait_for_command(server_socket):
-    select.select([server_socket], [], [])
-    datagram = server_socket.recv(1024)
-    msg = datagram.decode('utf-8')
-    return msg
+        await server.wait_closed()
+        # Lets the commands already started finish
+        executor.shutdown(wait=True)
+        config_store.stop_watching()
+        os.remove(envs.SOCKET_PATH)
+        logger.info("Stopped")
 
 
-def _process_command(logger, msg):
-    try:
-        command = json.loads(msg)
-    except json.decoder.JSONDecodeError:
-        logger.error("JSON decode failed: Invalid command: %s" % msg)
-        return
+async def _handle_client(logger, executor, state_store, config_store, clients, reader, writer):
+    # Clients may keep their connection open and send several requests:
+    # each one is answered, in order, once it has been fully received
+    loop = asyncio.get_running_loop()
+    clients.add(writer)
 
     try:
-        if command["type"] == "switch":
-            mode = command["args"]["mode"]
-            logger.info("Writing requested GPU mode: %s" % mode)
-            state = var.load_state()
+        while True:
+            request = await protocol.read_message(reader)
 
-            if state is None:
-                logger.error("Unable to switch: State file doesn't exist")
-                return
+            if request is None:
+                break
 
-            new_state = {
-                "type": "pending_pre_xorg_start",
-                "requested_mode": mode,
-                "current_mode": state["current_mode"]
-            }
+            if request.get("type") == "get_config":
+                await config_store.refresh()
 
-            var.write_state(new_state)
+            if request.get("type") in QUERY_TYPES:
+                reply = _process_request(logger, state_store, config_store, request)
 
-        elif command["type"] == "temp_config":
-            if command["args"]["path"] == "":
-                logger.info("Removing temporary config file")
-                var.remove_temp_conf_path_var()
             else:
-                logger.info("Writing temporary config file: %s" % command["args"]["path"])
-                var.write_temp_conf_path_var(command["args"]["path"])
+                reply = await loop.run_in_executor(
+                    executor, _process_request, logger, state_store, config_store, request)
 
-        elif command["type"] == "user_config":
-            _replace_user_config(logger, command["args"]["content"])
+            writer.write(protocol.encode_message(reply))
+            await writer.drain()
 
-        else:
-            logger.error("Unkown command type: %s: %s" % (command["type"], msg))
+    except (OSError, protocol.ProtocolError) as error:
+        logger.warning("Dropping client: %s", str(error))
+
+    except asyncio.CancelledError:
+        # The event loop is closing
+        logger.debug("Dropping client: Daemon stopped")
+
+    finally:
+        clients.discard(writer)
+        writer.close()
+
+
+def _process_request(logger, state_store, config_store, request):
+    request_id = request.get("id")
+
+    if request.get("type") in QUERY_TYPES:
+        logger.debug("Received query: %s", request["type"])
+
+    else:
+        logger.info("Received command: %s", request.get("type"))
+
+    try:
+        result = _process_command(logger, state_store, config_store, request)
+
+    except protocol.RequestError as error:
+        logger.error("Command failed: %s", str(error))
+        return protocol.make_reply(request_id, error=str(error))
 
     except KeyError as error:
-        logger.error("Invalid command key: %s: %s" % (str(error), msg))
+        logger.error("Invalid command key: %s", str(error))
+        return protocol.make_reply(request_id, error="Invalid command key: %s" % str(error))
+
+    # pylint: disable=W0703
+    except Exception as error:
+        logger.exception("Command failed")
+        return protocol.make_reply(request_id, error=str(error))
+
+    return protocol.make_reply(request_id, result)
+
+
+def _process_command(logger, state_store, config_store, command):
+    if command["type"] == "get_state":
+        return state_store.get()
+
+    elif command["type"] == "get_config":
+        return config_store.get().to_dict()
+
+    elif command["type"] == "get_status":
+        return var.get_status(state_store.get())
+
+    elif command["type"] == "switch":
+        mode = command["args"]["mode"]
+        logger.info("Writing requested GPU mode: %s" % mode)
+        state = state_store.get()
+
+        if state is None:
+            raise protocol.RequestError("Unable to switch: State file doesn't exist")
+
+        new_state = {
+            "type": "pending_pre_xorg_start",
+            "requested_mode": mode,
+            "current_mode": state["current_mode"]
+        }
+
+        state_store.set(new_state)
+
+    elif command["type"] == "temp_config":
+        if command["args"]["path"] == "":
+            logger.info("Removing temporary config file")
+            var.remove_temp_conf_path_var()
+        else:
+            logger.info("Writing temporary config file: %s" % command["args"]["path"])
+            var.write_temp_conf_path_var(command["args"]["path"])
+
+    elif command["type"] == "user_config":
+        _replace_user_config(logger, command["args"]["content"])
+
+    else:
+        raise protocol.RequestError("Unknown command type: %s" % command["type"])
+
+    return None
 
 
 def _replace_user_config(logger, config_content):
@@ -118,18 +209,105 @@ def _replace_user_config(logger, config_content):
         f.write(config_content)
 
 
-class _SignalHandler:
-    def __init__(self, logger, server_socket):
-        self.logger = logger
-        self.server_socket = server_socket
+class _StateStore:
+    # The state as last read or written by the daemon. The hooks write it from their own
+    # processes, so it is read again from the file when a `stat` shows it was replaced.
+    # Read from the event loop and written from the worker thread: without a lock, so that
+    # queries never wait for a write. Both replace `_cached` at once, the file key with the state.
 
-    def handler(self, signum, frame):
-        #pylint: disable=unused-argument
-        self.logger.info("Stopping daemon...")
-        self.server_socket.close()
-        os.remove(envs.SOCKET_PATH)
-        self.logger.info("Stopped")
-        sys.exit(0)
+    def __init__(self):
+        self._cached = (None, None)
+
+    def get(self):
+        file_key = var.get_state_file_key()
+        cached_file_key, state = self._cached
+
+        if file_key is None or file_key != cached_file_key:
+            state = var.load_state()
+            self._cached = (file_key, state)
+
+        return state
+
+    def set(self, state):
+        self._cached = (var.write_state(state), state)
+
+
+class _ConfigStore:
+    # The validated config, loaded again only after inotify reported a change to one of its files.
+    # Without inotify, it is loaded for every request like the clients would.
+    # Loads run on the worker thread so that the event loop keeps answering the other clients:
+    # `refresh` is awaited before `get`. Only used from the event loop.
+
+    def __init__(self, logger, loop, executor):
+        self._logger = logger
+        self._loop = loop
+        self._executor = executor
+        self._result = None
+        self._loading = None
+        self._watcher = None
+
+    def start_watching(self):
+        # The folder of the user config copy is cleaned up on boot and may not exist yet
+        os.makedirs(os.path.dirname(envs.USER_CONFIG_COPY_PATH), exist_ok=True)
+
+        try:
+            self._watcher = FileWatcher([envs.DEFAULT_CONFIG_PATH, envs.USER_CONFIG_COPY_PATH])
+
+        except OSError as error:
+            self._logger.warning("Not watching the config files: %s", str(error))
+            return
+
+        self._loop.add_reader(self._watcher.fileno(), self._on_change)
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._loop.remove_reader(self._watcher.fileno())
+            self._watcher.close()
+            self._watcher = None
+
+    async def refresh(self):
+        # Concurrent requests wait for the same load. A change during a load makes it
+        # outdated: it is then started over.
+        if self._watcher is None:
+            self._result = None
+
+        while self._result is None:
+            if self._loading is None:
+                self._loading = self._loop.run_in_executor(self._executor, _try_load_config)
+
+            loading = self._loading
+            result = await asyncio.shield(loading)
+
+            if self._loading is loading:
+                self._loading = None
+                self._result = result
+
+    def get(self):
+        # As loaded by the last `refresh`: raises what loading it raised
+        config, error = self._result
+
+        if error is not None:
+            raise error
+
+        return config
+
+    def _on_change(self):
+        changed = self._watcher.read_changes()
+
+        if len(changed) > 0:
+            self._logger.info("Config changed: %s", ", ".join(sorted(changed)))
+            self._result = None
+            self._loading = None
+
+
+def _try_load_config():
+    # `(config, None)`, or `(None, error)` if it can't be loaded
+    try:
+        return load_config(), None
+
+    # pylint: disable=W0703
+    except Exception as error:
+        return None, error
 
 
 if __name__ == '__main__':
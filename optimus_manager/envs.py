@@ -3,26 +3,58 @@ VERSION = "0"
 LOG_DIR_PATH = "/var/log/optimus-manager"
 SOCKET_PATH = "/tmp/optimus-manager"
 SOCKET_TIMEOUT = 1.0
+SOCKET_REQUEST_TIMEOUT = 5.0
+SOCKET_BACKLOG = 64
 
-MODULES_UNLOAD_WAIT_MAX_TRIES = 5
-MODULES_UNLOAD_WAIT_PERIOD = 1
+MODULES_UNLOAD_TIMEOUT = 5.0
+MODULES_UNLOAD_INITIAL_POLL_PERIOD = 0.01
+MODULES_UNLOAD_MAX_POLL_PERIOD = 0.5
+
+PCI_LINK_DOWN_WAIT_TIMEOUT = 0.1
+PCI_LINK_WAIT_TIMEOUT = 1.0
+PCI_LINK_WAIT_PERIOD = 0.01
+PCI_APPEAR_WAIT_TIMEOUT = 5.0
+PCI_APPEAR_POLL_PERIOD = 0.25
+
+PLAN_MAX_WORKERS = 4
+
+COMMAND_TIMEOUT = 30.0
 
 DEFAULT_CONFIG_PATH = "/usr/share/optimus-manager/optimus-manager.conf"
 USER_CONFIG_PATH = "/etc/optimus-manager/optimus-manager.conf"
 XORG_CONF_PATH = "/etc/X11/xorg.conf.d/10-optimus-manager.conf"
 
+KERNEL_MODULES_PATH = "/lib/modules"
+PROC_MODULES_PATH = "/proc/modules"
+PROC_CPUINFO_PATH = "/proc/cpuinfo"
+PROC_CMDLINE_PATH = "/proc/cmdline"
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+BBSWITCH_PATH = "/proc/acpi/bbswitch"
+ACPI_CALL_PATH = "/proc/acpi/call"
+POWER_SUPPLY_PATH = "/sys/class/power_supply"
+ACPI_DEVICES_PATH = "/sys/bus/acpi/devices"
+DMI_ID_PATH = "/sys/class/dmi/id"
+SYS_MODULES_PATH = "/sys/module"
+PCI_DEVICES_PATH = "/sys/bus/pci/devices"
+PCI_RESCAN_PATH = "/sys/bus/pci/rescan"
+
 NVIDIA_MANUAL_ENABLE_SCRIPT_PATH = "/etc/optimus-manager/nvidia-enable.sh"
 NVIDIA_MANUAL_DISABLE_SCRIPT_PATH = "/etc/optimus-manager/nvidia-disable.sh"
 
 PERSISTENT_VARS_FOLDER_PATH = "/var/lib/optimus-manager/persistent"
 ACPI_CALL_STRING_VAR_PATH = "%s/acpi_call_strings.json" % PERSISTENT_VARS_FOLDER_PATH
 TEMP_CONFIG_PATH_VAR_PATH = "%s/temp_conf_path" % PERSISTENT_VARS_FOLDER_PATH
+MODULE_INDEX_CACHE_PATH = "%s/module_index.json" % PERSISTENT_VARS_FOLDER_PATH
+ACPI_CANDIDATES_CACHE_PATH = "%s/acpi_call_candidates.json" % PERSISTENT_VARS_FOLDER_PATH
+OPERATION_LATENCIES_PATH = "%s/operation_latencies.json" % PERSISTENT_VARS_FOLDER_PATH
 
 TMP_VARS_FOLDER_PATH = "/var/lib/optimus-manager/tmp"
 LAST_ACPI_CALL_STATE_VAR = "%s/last_acpi_call_state" % TMP_VARS_FOLDER_PATH
 STATE_FILE_PATH = "%s/state.json" % TMP_VARS_FOLDER_PATH
 USER_CONFIG_COPY_PATH = "%s/config_copy.conf" % TMP_VARS_FOLDER_PATH
 CURRENT_DAEMON_RUN_ID = "%s/daemon_run_id" % TMP_VARS_FOLDER_PATH
+HOST_FACTS_PATH = "%s/host_facts.json" % TMP_VARS_FOLDER_PATH
+COMPILED_CONFIG_PATH = "%s/compiled_config.json" % TMP_VARS_FOLDER_PATH
 
 
 EXTRA_XORG_OPTIONS_PATHS = {
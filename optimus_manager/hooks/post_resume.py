@@ -1,6 +1,6 @@
 import sys
 from .. import var
-from ..config import load_config
+from ..config import get_config
 from ..kernel import get_available_modules, nvidia_power_down
 from ..log_utils import get_logger, set_logger_config
 
@@ -19,8 +19,8 @@ def main():
     try:
         logger.info("Running post-resume hook")
         logger.info("Previous state was: %s", str(prev_state))
-        config = load_config()
-        switching_option = config["optimus"]["switching"]
+        config = get_config()
+        switching_option = config.optimus.switching
 
         if current_mode == "integrated":
             logger.info("Turning Nvidia GPU off again")
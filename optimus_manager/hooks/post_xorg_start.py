@@ -1,7 +1,9 @@
 import sys
 from .. import var
-from ..config import load_config
+from ..config import get_config
 from ..log_utils import get_logger, set_logger_config
+from ..pci import PciTopology
+from ..runner import DeadlineError, log_stats, start_deadline
 from ..xorg import do_xsetup, set_DPI
 
 
@@ -19,8 +21,9 @@ def main():
     try:
         logger.info("Running Xorg post-start hook")
         requested_mode = prev_state["requested_mode"]
-        do_xsetup(requested_mode)
-        config = load_config()
+        config = get_config()
+        start_deadline(config.optimus.switch_timeout)
+        do_xsetup(PciTopology(), requested_mode)
         set_DPI(config)
 
         state = {
@@ -31,6 +34,19 @@ def main():
 
         var.write_state(state)
 
+    except DeadlineError as error:
+        logger.error("Xorg post-start hook failed: %s", str(error))
+
+        state = {
+            "type": "post_xorg_start_failed",
+            "switch_id": switch_id,
+            "requested_mode": requested_mode,
+            "failed_step": error.step
+        }
+
+        var.write_state(state)
+        sys.exit(1)
+
     # pylint: disable=W0703
     except Exception:
         logger.exception("Xorg post-start hook failed")
@@ -45,6 +61,7 @@ def main():
         sys.exit(1)
 
     else:
+        log_stats()
         logger.info("Xorg post-start hook completed")
 
 
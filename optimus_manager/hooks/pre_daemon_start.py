@@ -26,25 +26,25 @@ def main():
             startup_mode = kernel_parameters["startup_mode"]
 
         else:
-            startup_mode = config["optimus"]["startup_mode"]
+            startup_mode = config.optimus.startup_mode
 
         logger.info("Startup mode is: %s", startup_mode)
 
         if startup_mode == "auto":
             if is_ac_power_connected():
-                eff_startup_mode = config["optimus"]["startup_auto_extpower_mode"]
+                eff_startup_mode = config.optimus.startup_auto_extpower_mode
 
             else:
-                eff_startup_mode = config["optimus"]["startup_auto_battery_mode"]
+                eff_startup_mode = config.optimus.startup_auto_battery_mode
 
             logger.info("Effective startup mode is: %s", eff_startup_mode)
 
         elif startup_mode == "auto_nvdisplay":
             if is_nvidia_display_connected():
-                eff_startup_mode = config["optimus"]["startup_auto_nvdisplay_on_mode"]
+                eff_startup_mode = config.optimus.startup_auto_nvdisplay_on_mode
 
             else:
-                eff_startup_mode = config["optimus"]["startup_auto_nvdisplay_off_mode"]
+                eff_startup_mode = config.optimus.startup_auto_nvdisplay_off_mode
 
             logger.info("Effective startup mode is: %s", eff_startup_mode)
 
@@ -1,10 +1,13 @@
 import os
 import sys
 from .. import var
-from ..config import load_config
-from ..kernel import setup_kernel_state
+from ..config import get_config
 from ..log_utils import get_logger, set_logger_config
-from ..xorg import cleanup_xorg_conf, configure_xorg, is_xorg_running
+from ..pci import PciTopology
+from ..plan import run_plan
+from ..runner import DeadlineError, log_stats, start_deadline
+from ..switch import compile_switch_plan
+from ..xorg import cleanup_xorg_conf, is_xorg_running
 
 
 def main():
@@ -36,12 +39,14 @@ def main():
         logger.info("Running Xorg pre-start hook")
         logger.info("Previous state was: %s", str(prev_state))
         logger.info("Requested mode is: %s", requested_mode)
-        config = load_config()
+        config = get_config()
+        start_deadline(config.optimus.switch_timeout)
+        topology = PciTopology()
 
-        if setup_kernel:
-            setup_kernel_state(config, prev_state, requested_mode)
+        plan = compile_switch_plan(
+            config, topology, prev_state["current_mode"], requested_mode, setup_kernel)
 
-        configure_xorg(config, requested_mode)
+        run_plan(plan)
 
         state = {
             "type": "pending_post_xorg_start",
@@ -51,6 +56,20 @@ def main():
 
         var.write_state(state)
 
+    except DeadlineError as error:
+        logger.error("Xorg pre-start hook failed: %s", str(error))
+        cleanup_xorg_conf()
+
+        state = {
+            "type": "pre_xorg_start_failed",
+            "switch_id": switch_id,
+            "requested_mode": requested_mode,
+            "failed_step": error.step
+        }
+
+        var.write_state(state)
+        sys.exit(1)
+
     # pylint: disable=W0703
     except Exception:
         logger.exception("Xorg pre-start hook failed")
@@ -66,6 +85,7 @@ def main():
         sys.exit(1)
 
     else:
+        log_stats()
         logger.info("Xorg pre-start hook completed")
 
 
@@ -0,0 +1,112 @@
+import os
+from collections import namedtuple
+from . import envs
+from . import var
+from .log_utils import get_logger
+
+STARTUP_PARAMETER_PREFIX = "optimus-manager.startup="
+DMI_FINGERPRINT_FIELDS = ["sys_vendor", "product_name", "board_vendor", "board_name", "bios_version"]
+
+HostFacts = namedtuple("HostFacts", ["boot_id", "cpu_flags", "kernel_parameters", "dmi_fingerprint"])
+
+_host_facts = None
+
+
+def get_host_facts():
+    # What can't change until the next boot, read once per boot then loaded
+    # from the tmp vars folder by every hook and client call with a single file read
+    global _host_facts
+    boot_id = _read_boot_id()
+
+    if _host_facts is not None and _host_facts.boot_id == boot_id:
+        return _host_facts
+
+    try:
+        facts_dict = var.read_host_facts()
+
+        if facts_dict["boot_id"] == boot_id:
+            _host_facts = HostFacts(**facts_dict)
+            return _host_facts
+
+    except (var.VarError, KeyError, TypeError):
+        pass
+
+    _host_facts = _collect_host_facts(boot_id)
+
+    try:
+        var.write_host_facts(_host_facts._asdict())
+
+    except var.VarError as error:
+        get_logger().info("Not caching host facts: %s", str(error))
+
+    return _host_facts
+
+
+def _collect_host_facts(boot_id):
+    with open(envs.PROC_CMDLINE_PATH, "r") as cmdfile:
+        cmdline = cmdfile.read()
+
+    return HostFacts(
+        boot_id=boot_id,
+        cpu_flags=_read_cpu_flags(),
+        kernel_parameters=_parse_kernel_parameters(cmdline),
+        dmi_fingerprint=_read_dmi_fingerprint())
+
+
+def _read_boot_id():
+    try:
+        with open(envs.BOOT_ID_PATH, "r") as bootidfile:
+            return bootidfile.read().strip()
+
+    except IOError:
+        return None
+
+
+def _read_cpu_flags():
+    # All CPUs have the same flags: only the first `flags` line matters
+    try:
+        with open(envs.PROC_CPUINFO_PATH, "r") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    return line.split(":", 1)[1].split()
+
+    except IOError:
+        pass
+
+    return []
+
+
+def _parse_kernel_parameters(cmdline):
+    logger = get_logger()
+    startup_mode = None
+
+    for parameter in cmdline.split():
+        if not parameter.startswith(STARTUP_PARAMETER_PREFIX):
+            continue
+
+        logger.info("Kernel parameter: %s", parameter)
+        potential_mode = parameter[len(STARTUP_PARAMETER_PREFIX):]
+
+        if potential_mode in ["auto", "hybrid", "integrated", "nvidia"]:
+            startup_mode = potential_mode
+            break
+
+        logger.error(
+            "Ignored invalid startup mode in kernel parameter: %s", potential_mode)
+
+    return {"startup_mode": startup_mode}
+
+
+def _read_dmi_fingerprint():
+    values = []
+
+    for field in DMI_FINGERPRINT_FIELDS:
+        try:
+            with open(os.path.join(envs.DMI_ID_PATH, field), "r") as dmifile:
+                values.append(dmifile.read().strip())
+
+        except IOError:
+            values.append("")
+
+    return "|".join(values)
+
@@ -1,181 +1,274 @@
-import subprocess
 import time
 from . import checks
 from . import envs
+from . import kmod
 from . import pci
+from . import processes
+from . import runner
 from . import var
-from .acpi_data import ACPI_STRINGS
+from .acpi import get_acpi_call_candidates
 from .log_utils import get_logger
+from .plan import make_operation, run_plan
+from .uevent import open_device_monitor
 
 
 class KernelSetupError(Exception):
     pass
 
 
-def setup_kernel_state(config, prev_state, requested_mode):
+MODULES = [
+    "nouveau", "bbswitch", "acpi_call", "nvidia",
+    "nvidia_drm", "nvidia_modeset", "nvidia_uvm"
+]
+
+NVIDIA_MODULES = ["nvidia_drm", "nvidia_modeset", "nvidia_uvm", "nvidia"]
+
+
+def plan_kernel_setup(config, topology, current_mode, requested_mode):
     assert requested_mode in ["hybrid", "integrated", "nvidia"]
-    assert prev_state["type"] == "pending_pre_xorg_start"
-    current_mode = prev_state["current_mode"]
 
     if current_mode in ["integrated", None] and requested_mode in ["nvidia", "hybrid"]:
-        _nvidia_up(config, hybrid=(requested_mode == "hybrid"))
+        return _plan_nvidia_up(config, topology, hybrid=(requested_mode == "hybrid"))
 
     elif current_mode in ["nvidia", "hybrid", None] and requested_mode == "integrated":
-        _nvidia_down(config)
+        return _plan_nvidia_down(config, topology)
+
+    return []
 
 
 def get_available_modules():
-    MODULES = [
-        "nouveau", "bbswitch", "acpi_call", "nvidia",
-        "nvidia_drm", "nvidia_modeset", "nvidia_uvm"
-    ]
+    logger = get_logger()
 
-    return [module for module in MODULES if checks.is_module_available(module)]
+    try:
+        index = kmod.load_module_index()
+
+    except kmod.KmodError as error:
+        logger.error("Unable to find available modules: %s", str(error))
+        return []
+
+    return [module for module in MODULES if index.is_available(module)]
 
 
 def nvidia_power_up(config, available_modules):
-    logger = get_logger()
-    switching_mode = config["optimus"]["switching"]
+    run_plan(_plan_power_switch(config, available_modules, "ON"))
 
-    if switching_mode == "bbswitch":
-        _try_load_bbswitch(available_modules)
-        _try_set_bbswitch_state("ON")
 
-    elif switching_mode == "acpi_call":
-        _try_load_acpi_call(available_modules)
-        _try_set_acpi_call_state("ON")
+def nvidia_power_down(config, available_modules):
+    run_plan(_plan_power_switch(config, available_modules, "OFF"))
 
-    elif switching_mode == "custom":
-        _try_custom_set_power_state("ON")
 
-    else:
-        logger.info("Skipping Nvidia power up: switching_mode=%s", switching_mode)
+def read_kernel_state(topology):
+    # What the steps of a switch would change, as it actually is,
+    # so that the ones already in the requested state can be skipped
+    module_state = _read_module_state()
 
+    try:
+        last_acpi_call_state = var.read_last_acpi_call_state()
 
-def nvidia_power_down(config, available_modules):
+    except var.VarError:
+        last_acpi_call_state = None
+
+    return {
+        "loaded_modules": [module for module in MODULES if module_state.is_loaded(module)],
+        "builtin_modules": [module for module in MODULES if module_state.is_builtin(module)],
+        "bbswitch": _read_bbswitch_state(),
+        "acpi_call": last_acpi_call_state,
+        "nvidia_visible": pci.is_nvidia_visible(topology),
+        "pci_power_control": _read_pci_power_state(topology)
+    }
+
+
+def _plan_power_switch(config, available_modules, state):
     logger = get_logger()
-    switching_mode = config["optimus"]["switching"]
+    switching_mode = config.optimus.switching
+    loaded_modules = _read_module_state()
+    plan = []
 
     if switching_mode == "bbswitch":
-        _try_load_bbswitch(available_modules)
-        _set_bbswitch_state("OFF")
+        if not loaded_modules.is_loaded("bbswitch"):
+            plan.append(make_operation("module_load", "bbswitch", _try_load_bbswitch, available_modules))
+
+        # Failing to power down is fatal, failing to power up is not
+        set_state = _try_set_bbswitch_state if state == "ON" else _set_bbswitch_state
+        plan.append(make_operation("sysfs_write", f"{envs.BBSWITCH_PATH} = {state}", set_state, state))
 
     elif switching_mode == "acpi_call":
-        _try_load_acpi_call(available_modules)
-        _try_set_acpi_call_state("OFF")
+        if not loaded_modules.is_loaded("acpi_call"):
+            plan.append(make_operation("module_load", "acpi_call", _try_load_acpi_call, available_modules))
+
+        plan.append(make_operation("acpi_call", f"Nvidia power {state}", _try_set_acpi_call_state, state))
 
     elif switching_mode == "custom":
-        _try_custom_set_power_state("OFF")
+        script_path = envs.NVIDIA_MANUAL_ENABLE_SCRIPT_PATH if state == "ON" else envs.NVIDIA_MANUAL_DISABLE_SCRIPT_PATH
+        plan.append(make_operation("script_run", script_path, _try_custom_set_power_state, state))
 
     else:
-        logger.info("Skipping Nvidia power down: switching_mode=%s", switching_mode)
+        logger.info(
+            "Skipping Nvidia power %s: switching_mode=%s", "up" if state == "ON" else "down", switching_mode)
 
+    return plan
 
-def _nvidia_up(config, hybrid):
+
+def _plan_nvidia_up(config, topology, hybrid):
     logger = get_logger()
     available_modules = get_available_modules()
     logger.info("Available modules: %s", str(available_modules))
-    _unload_nouveau(available_modules)
-    nvidia_power_up(config, available_modules)
+    kernel_state = read_kernel_state(topology)
+    logger.info("Kernel state: %s", str(kernel_state))
+    loaded_modules = kernel_state["loaded_modules"]
+    plan = []
+
+    if "nouveau" in kernel_state["builtin_modules"]:
+        logger.warning("Skipping nouveau unloading: Built into the kernel")
+
+    elif "nouveau" in loaded_modules:
+        plan.append(make_operation("module_unload", "nouveau", _unload_nouveau, available_modules))
 
-    if not pci.is_nvidia_visible():
-        logger.info("Nvidia card not visible in PCI bus: Rescanning...")
-        _try_rescan_pci()
+    if _is_power_switched(config, kernel_state, "ON"):
+        logger.info("Skipping Nvidia power up: Already on")
 
-    if config["optimus"]["pci_reset"] != "no":
-        _try_pci_reset(config, available_modules)
+    else:
+        plan += _plan_power_switch(config, available_modules, "ON")
+
+    if not kernel_state["nvidia_visible"]:
+        plan.append(make_operation("pci_rescan", "Bring Nvidia back into the PCI bus", _try_rescan_pci, topology))
+
+    nvidia_loaded = "nvidia" in loaded_modules and "nvidia_drm" in loaded_modules
+
+    if config.optimus.pci_reset != "no":
+        if nvidia_loaded:
+            logger.info("Skipping PCI reset: The nvidia modules are already loaded")
+
+        else:
+            plan.append(make_operation(
+                "pci_reset", config.optimus.pci_reset, _try_pci_reset, config, topology, available_modules))
 
     power_control = (
-        config["optimus"]["pci_power_control"] == "yes" or \
-        config["nvidia"]["dynamic_power_management"] != "no"
+        config.optimus.pci_power_control or \
+        config.nvidia.dynamic_power_management != "no"
     )
 
-    if power_control:
-        _try_set_pci_power_state("auto" if hybrid else "on")
+    pci_power_state = "auto" if hybrid else "on"
+
+    if power_control and kernel_state["pci_power_control"] != pci_power_state:
+        plan.append(make_operation(
+            "sysfs_write", f"Nvidia power/control = {pci_power_state}",
+            _try_set_pci_power_state, topology, pci_power_state))
+
+    if nvidia_loaded:
+        logger.info("Skipping nvidia modules loading: Already loaded")
+
+    else:
+        nvidia_options = _get_nvidia_options(config)
+        nvidia_drm_options = _get_nvidia_drm_options(config)
+
+        plan.append(make_operation(
+            "module_load", " ".join(["nvidia"] + nvidia_options),
+            _load_module, available_modules, "nvidia", nvidia_options))
+
+        plan.append(make_operation(
+            "module_load", " ".join(["nvidia_drm"] + nvidia_drm_options),
+            _load_module, available_modules, "nvidia_drm", nvidia_drm_options))
 
-    _load_nvidia_modules(config, available_modules)
+    return plan
 
 
-def _nvidia_down(config):
+def _plan_nvidia_down(config, topology):
     logger = get_logger()
     available_modules = get_available_modules()
     logger.info("Available modules: %s", str(available_modules))
-    _unload_nvidia_modules(available_modules)
-    nvidia_power_down(config, available_modules)
-    switching_mode = config["optimus"]["switching"]
+    kernel_state = read_kernel_state(topology)
+    logger.info("Kernel state: %s", str(kernel_state))
+    loaded_modules = kernel_state["loaded_modules"]
+    switching_mode = config.optimus.switching
+    plan = []
 
-    if switching_mode == "nouveau":
-        _try_load_nouveau(config, available_modules)
+    loaded_nvidia_modules = [module for module in NVIDIA_MODULES if module in loaded_modules]
 
-    if config["optimus"]["pci_remove"] == "yes":
+    if len(loaded_nvidia_modules) > 0:
+        plan.append(make_operation(
+            "module_unload", " ".join(loaded_nvidia_modules),
+            _unload_nvidia_modules, topology, available_modules))
+
+    if _is_power_switched(config, kernel_state, "OFF"):
+        logger.info("Skipping Nvidia power down: Already off")
+
+    else:
+        plan += _plan_power_switch(config, available_modules, "OFF")
+
+    if switching_mode == "nouveau" and "nouveau" not in loaded_modules:
+        nouveau_options = _get_nouveau_options(config)
+
+        plan.append(make_operation(
+            "module_load", " ".join(["nouveau"] + nouveau_options),
+            _try_load_nouveau, nouveau_options, available_modules))
+
+    if config.optimus.pci_remove:
         if switching_mode == "nouveau" or switching_mode == "bbswitch":
             logger.warning("Option ignored: pci_remove: due to switching_mode=%s", switching_mode)
 
+        elif not kernel_state["nvidia_visible"]:
+            logger.info("Skipping Nvidia removal: Not in the PCI bus")
+
         else:
-            logger.info("Removing Nvidia from PCI bus")
-            _try_remove_pci()
+            plan.append(make_operation("pci_remove", "Nvidia remove = 1", _try_remove_pci, topology))
 
     power_control = (
-        config["optimus"]["pci_power_control"] == "yes" or \
-        config["nvidia"]["dynamic_power_management"] != "no"
+        config.optimus.pci_power_control or \
+        config.nvidia.dynamic_power_management != "no"
     )
 
     if power_control:
-        switching_mode = config["optimus"]["switching"]
-
         if switching_mode == "bbswitch" or switching_mode == "acpi_call":
             logger.warning("Option ignored: pci_power_control: due to switching_mode=%s", switching_mode)
 
-        elif config["optimus"]["pci_remove"] == "yes":
+        elif config.optimus.pci_remove:
             logger.warning("Option ignored: pci_power_control: due to pci_remove=enabled")
 
+        elif kernel_state["pci_power_control"] == "auto":
+            logger.info("Skipping Nvidia PCI power state: Already auto")
+
         else:
-            _try_set_pci_power_state("auto")
+            plan.append(make_operation(
+                "sysfs_write", "Nvidia power/control = auto", _try_set_pci_power_state, topology, "auto"))
 
+    return plan
 
-def _load_nvidia_modules(config, available_modules):
-    logger = get_logger()
-    nvidia_options = []
 
-    ### nvidia module
+def _get_nvidia_options(config):
+    nvidia_options = []
 
-    if config["nvidia"]["pat"] == "yes" and checks.is_pat_available():
+    if config.nvidia.pat and checks.is_pat_available():
         nvidia_options.append("NVreg_UsePageAttributeTable=1")
 
-    if config["nvidia"]["dynamic_power_management"] == "coarse":
+    if config.nvidia.dynamic_power_management == "coarse":
         nvidia_options.append("NVreg_DynamicPowerManagement=0x01")
 
-    elif config["nvidia"]["dynamic_power_management"] == "fine":
+    elif config.nvidia.dynamic_power_management == "fine":
         nvidia_options.append("NVreg_DynamicPowerManagement=0x02")
 
-    mem_th = config["nvidia"]["dynamic_power_management_memory_threshold"]
+    mem_th = config.nvidia.dynamic_power_management_memory_threshold
 
-    if mem_th != "":
+    if mem_th is not None:
         nvidia_options.append(f"NVreg_DynamicPowerManagementVideoMemoryThreshold={mem_th}")
 
-    _load_module(available_modules, "nvidia", options=nvidia_options)
-
-    ### nvidia_drm module
+    return nvidia_options
 
-    nvidia_drm_options = []
 
-    if config["nvidia"]["modeset"] == "yes":
-        nvidia_drm_options.append("modeset=1")
+def _get_nvidia_drm_options(config):
+    return ["modeset=1"] if config.nvidia.modeset else []
 
-    _load_module(available_modules, "nvidia_drm", options=nvidia_drm_options)
 
-
-def _load_nouveau(config, available_modules):
+def _get_nouveau_options(config):
     # TODO: Move the option to [optimus]
-    nouveau_options = ["modeset=1"] if config["intel"]["modeset"] == "yes" else []
-    _load_module(available_modules, "nouveau", options=nouveau_options)
+    return ["modeset=1"] if config.intel.modeset else []
 
 
-def _try_load_nouveau(config, available_modules):
+def _try_load_nouveau(options, available_modules):
     logger = get_logger()
 
     try:
-        _load_nouveau(config, available_modules)
+        _load_module(available_modules, "nouveau", options=options)
 
     except KernelSetupError as error:
         logger.error(
@@ -204,8 +297,27 @@ def _try_load_acpi_call(available_modules):
             "Unable to load acpi_call: %s", str(error))
 
 
-def _unload_nvidia_modules(available_modules):
-    _unload_modules(available_modules, ["nvidia_drm", "nvidia_modeset", "nvidia_uvm", "nvidia"])
+def _unload_nvidia_modules(topology, available_modules):
+    if _read_module_state().is_loaded("nvidia"):
+        _log_gpu_users(topology)
+
+    _unload_modules(available_modules, NVIDIA_MODULES)
+
+
+def _log_gpu_users(topology):
+    logger = get_logger()
+
+    try:
+        gpu_users = processes.find_gpu_users(processes.get_nvidia_device_paths(topology))
+
+    except processes.ProcessesError as error:
+        logger.warning("Unable to look for processes using the Nvidia card: %s", str(error))
+        return
+
+    for gpu_user in gpu_users:
+        logger.warning(
+            "Process using the Nvidia card: PID %d (%s) on %s: %s",
+            gpu_user.pid, gpu_user.user, gpu_user.device, gpu_user.cmdline)
 
 
 def _unload_nouveau(available_modules):
@@ -230,6 +342,11 @@ def _unload_bbswitch(available_modules):
 def _load_module(available_modules, module, options=None):
     logger = get_logger()
     options = options or []
+
+    if _read_module_state().is_loaded(module):
+        logger.info("Module already loaded: %s", module)
+        return
+
     logger.info("Loading module: %s", module)
 
     if module not in available_modules:
@@ -237,43 +354,120 @@ def _load_module(available_modules, module, options=None):
             "Module not installed properly: %s" % module)
 
     try:
-        subprocess.check_call(
-            f"modprobe {module} {' '.join(options)}",
-            shell=True, text=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        kmod.get_backend().load(module, options)
 
-    except subprocess.CalledProcessError as error:
-        raise KernelSetupError(f"Failed to modprobe {module}: {error.stderr}") from error
+    except kmod.KmodError as error:
+        raise KernelSetupError(str(error)) from error
 
 
 def _unload_modules(available_modules, modules_list):
     logger = get_logger()
-    modules_to_unload = [module for module in modules_list if module in available_modules]
+    module_state = _read_module_state()
+
+    modules_to_unload = [
+        module for module in modules_list
+        if module in available_modules and module_state.is_loaded(module)
+    ]
 
     if len(modules_to_unload) == 0:
         return
 
     logger.info("Unloading modules: %s", str(modules_to_unload))
-    counter = 0
-    success = False
+    start_time = time.monotonic()
+    timeout = runner.get_timeout(envs.MODULES_UNLOAD_TIMEOUT)
+    deadline = start_time + timeout
+
+    # What limits the unload: the switch deadline, or the unload timeout alone
+    switch_timeout = timeout if timeout < envs.MODULES_UNLOAD_TIMEOUT else None
+
+    # In order, so that holders go before the modules they use
+    for module in modules_to_unload:
+        _unload_module_when_unused(module, deadline, switch_timeout)
+
+    logger.info("Unloaded modules in %.1fms", (time.monotonic() - start_time) * 1000)
+
+
+def _unload_module_when_unused(module, deadline, switch_timeout=None):
+    # Retries as soon as the module is no longer referenced,
+    # polling fast at first then backing off, until `deadline`.
+    # If `switch_timeout` is set, `deadline` is the switch deadline: DeadlineError is raised then.
+    logger = get_logger()
+    poll_period = envs.MODULES_UNLOAD_INITIAL_POLL_PERIOD
+    last_error = None
+
+    while True:
+        refcount = kmod.read_module_refcount(module)
+        holders = kmod.read_module_holders(module)
+
+        if refcount is None:
+            if _read_module_state().is_loaded(module):
+                raise KernelSetupError(f"Module is built into the kernel: {module}")
+
+            return
+
+        if not refcount and not holders:
+            try:
+                kmod.get_backend().unload(module)
+                return
 
-    while not success and counter < envs.MODULES_UNLOAD_WAIT_MAX_TRIES:
-        counter += 1
+            except kmod.KmodError as error:
+                last_error = error
 
-        try:
-            subprocess.check_call(
-                f"modprobe -r {' '.join(modules_to_unload)}",
-                shell=True, text=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-            success = True
+        remaining = deadline - time.monotonic()
 
-        except subprocess.CalledProcessError as error:
-            if counter >= envs.MODULES_UNLOAD_WAIT_MAX_TRIES:
-                logger.info(f"Max tries exceeded: {counter}")
-                raise KernelSetupError(f"Failed to unload modules: {modules_to_unload}: {error.stderr}") from error
+        if remaining <= 0:
+            busy_msg = "refcount %s, held by: %s" % (refcount, ", ".join(holders) or "nothing")
 
-            else:
-                logger.info(f"Failed to unload modules: {error.stderr}")
-                logger.info(f"Waiting {envs.MODULES_UNLOAD_WAIT_PERIOD}s and retrying...")
-                time.sleep(envs.MODULES_UNLOAD_WAIT_PERIOD)
+            if last_error is not None:
+                busy_msg += f": {last_error}"
+
+            logger.info("Module still in use: %s: %s", module, busy_msg)
+
+            if switch_timeout is not None:
+                raise runner.DeadlineError("unload %s" % module, switch_timeout)
+
+            raise KernelSetupError(f"Failed to unload module: {module}: {busy_msg}")
+
+        time.sleep(min(poll_period, remaining))
+        poll_period = min(poll_period * 2, envs.MODULES_UNLOAD_MAX_POLL_PERIOD)
+
+
+def _read_module_state():
+    try:
+        return kmod.read_module_state()
+
+    except kmod.KmodError as error:
+        raise KernelSetupError(f"Unable to read loaded modules: {error}") from error
+
+
+def _is_power_switched(config, kernel_state, state):
+    switching_mode = config.optimus.switching
+
+    if switching_mode == "bbswitch":
+        return kernel_state["bbswitch"] == state
+
+    if switching_mode == "acpi_call":
+        return kernel_state["acpi_call"] == state
+
+    return False
+
+
+def _read_bbswitch_state():
+    # Example: `0000:01:00.0 ON`
+    try:
+        with open(envs.BBSWITCH_PATH, "r") as bbfile:
+            return bbfile.read().split()[-1]
+
+    except (IOError, IndexError):
+        return None
+
+
+def _read_pci_power_state(topology):
+    try:
+        return pci.get_power_state(topology)
+
+    except pci.PCIError:
+        return None
 
 
 def _set_bbswitch_state(state):
@@ -282,14 +476,14 @@ def _set_bbswitch_state(state):
     logger.info("Setting power via bbswitch to: %s", state)
 
     try:
-        with open("/proc/acpi/bbswitch", "w") as bbfile:
+        with open(envs.BBSWITCH_PATH, "w") as bbfile:
             bbfile.write(state)
 
     except FileNotFoundError as error:
-        raise KernelSetupError("Unable to open: /proc/acpi/bbswitch") from error
+        raise KernelSetupError("Unable to open: %s" % envs.BBSWITCH_PATH) from error
 
     except IOError as error:
-        raise KernelSetupError("Unable to write to: /proc/acpi/bbswitch") from error
+        raise KernelSetupError("Unable to write to: %s" % envs.BBSWITCH_PATH) from error
 
 
 def _set_acpi_call_state(state):
@@ -301,8 +495,7 @@ def _set_acpi_call_state(state):
         acpi_strings_list = var.read_acpi_call_strings()
 
     except var.VarError:
-        acpi_strings_list = ACPI_STRINGS
-        logger.info("Trying all ACPI calls (may polute the kernel log)")
+        acpi_strings_list = get_acpi_call_candidates()
 
     working_strings = []
 
@@ -313,13 +506,13 @@ def _set_acpi_call_state(state):
             try:
                 logger.info("Sending ACPI call: %s", string)
 
-                with open("/proc/acpi/call", "w") as callwrite:
+                with open(envs.ACPI_CALL_PATH, "w") as callwrite:
                     callwrite.write(string)
-                with open("/proc/acpi/call", "r") as callread:
+                with open(envs.ACPI_CALL_PATH, "r") as callread:
                     output = callread.read()
 
             except FileNotFoundError as error:
-                raise KernelSetupError("Unable to open: /proc/acpi/call") from error
+                raise KernelSetupError("Unable to open: %s" % envs.ACPI_CALL_PATH) from error
 
             except IOError:
                 continue
@@ -332,48 +525,53 @@ def _set_acpi_call_state(state):
     var.write_acpi_call_strings(working_strings)
 
 
-def _try_remove_pci():
+def _try_remove_pci(topology):
     logger = get_logger()
 
+    # Powering the card down may have changed the bus since the plan was made
+    topology.invalidate()
+
     try:
-        pci.remove_nvidia()
+        pci.remove_nvidia(topology)
 
     except pci.PCIError as error:
         logger.error(
             "Unable to remove Nvidia from PCI bus: %s", str(error))
 
 
-def _try_rescan_pci():
+def _try_rescan_pci(topology):
     logger = get_logger()
 
     try:
-        pci.rescan()
-
-        if not pci.is_nvidia_visible():
-            logger.error("Nvidia card not showing up in PCI bus after rescan")
+        with open_device_monitor(envs.PCI_DEVICES_PATH) as monitor:
+            pci.rescan(topology)
+            appear_time = pci.wait_for_nvidia(topology, monitor, envs.PCI_APPEAR_WAIT_TIMEOUT)
 
     except pci.PCIError as error:
         logger.error("Unable to rescan PCI bus: %s", str(error))
 
+    else:
+        logger.info("Nvidia card showed up in PCI bus after %.1fms", appear_time * 1000)
+
 
-def _try_set_pci_power_state(state):
+def _try_set_pci_power_state(topology, state):
     logger = get_logger()
     logger.info("Setting Nvidia PCI power state to: %s", state)
 
     try:
-        pci.set_power_state(state)
+        pci.set_power_state(topology, state)
 
     except pci.PCIError as error:
         logger.error(
             "Unable to set PCI power state: %s", str(error))
 
 
-def _try_pci_reset(config, available_modules):
+def _try_pci_reset(config, topology, available_modules):
     logger = get_logger()
     logger.info("Resetting Nvidia PCI device")
 
     try:
-        _pci_reset(config, available_modules)
+        _pci_reset(config, topology, available_modules)
 
     except KernelSetupError as error:
         logger.error(
@@ -402,18 +600,18 @@ def _try_set_bbswitch_state(state):
             "Unable to set bbswitch_state to %s: %s", state, str(error))
 
 
-def _pci_reset(config, available_modules):
+def _pci_reset(config, topology, available_modules):
     logger = get_logger()
     _unload_bbswitch(available_modules)
 
     try:
-        if config["optimus"]["pci_reset"] == "function_level":
+        if config.optimus.pci_reset == "function_level":
             logger.info("Performing function-level reset of Nvidia")
-            pci.function_level_reset_nvidia()
+            pci.function_level_reset_nvidia(topology)
 
-        elif config["optimus"]["pci_reset"] == "hot_reset":
+        elif config.optimus.pci_reset == "hot_reset":
             logger.info("Starting hot reset of Nvidia")
-            pci.hot_reset_nvidia()
+            pci.hot_reset_nvidia(topology)
 
     except pci.PCIError as error:
         raise KernelSetupError(f"Unable to perform PCI reset: {error}") from error
@@ -431,8 +629,7 @@ def _try_custom_set_power_state(state):
     logger.info("Running custom power switching script: %s", script_path)
 
     try:
-        subprocess.check_call(
-            script_path, text=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        runner.run([script_path])
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         logger.error(f"Unable to run power switching script: {error.stderr}")
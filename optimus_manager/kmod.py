@@ -0,0 +1,394 @@
+import errno
+import os
+from collections import namedtuple
+from ctypes import byref, c_char_p, c_uint, c_void_p, CDLL
+from . import envs
+from . import runner
+from . import var
+from .log_utils import get_logger
+
+INDEX_FILES = ["modules.dep", "modules.builtin", "modules.alias"]
+
+# From `libkmod.h`
+KMOD_MODULE_BUILTIN = 0
+KMOD_REMOVE_NOWAIT = os.O_NONBLOCK
+
+
+LoadedModule = namedtuple("LoadedModule", ["name", "size", "refcount", "holders", "state", "address"])
+
+
+class KmodError(Exception):
+    pass
+
+
+class ModuleIndex:
+    # Which modules can be loaded for a kernel release,
+    # answered from the depmod index files instead of one `modinfo` per module
+
+    def __init__(self, modules, builtin, aliases):
+        self.modules = set(modules)
+        self.builtin = set(builtin)
+        self.aliases = dict(aliases)
+
+    def is_available(self, module_name):
+        name = _normalize_name(module_name)
+        name = self.aliases.get(name, name)
+        return name in self.modules or name in self.builtin
+
+    def to_dict(self):
+        return {
+            "modules": sorted(self.modules),
+            "builtin": sorted(self.builtin),
+            "aliases": self.aliases
+        }
+
+    @classmethod
+    def from_dict(cls, index_dict):
+        return cls(index_dict["modules"], index_dict["builtin"], index_dict["aliases"])
+
+
+class ModuleState:
+    # Snapshot of the loaded modules, from a single read of `/proc/modules`
+
+    def __init__(self, loaded_modules):
+        self.loaded_modules = {module.name: module for module in loaded_modules}
+
+    def is_loaded(self, module_name):
+        name = _normalize_name(module_name)
+
+        if name in self.loaded_modules:
+            return self.loaded_modules[name].state == "Live"
+
+        return self.is_builtin(name)
+
+    def is_builtin(self, module_name):
+        # Built-in modules aren't listed in `/proc/modules`,
+        # but those with parameters show in `/sys/module` without an `initstate`
+        name = _normalize_name(module_name)
+
+        if name in self.loaded_modules:
+            return False
+
+        module_path = os.path.join(envs.SYS_MODULES_PATH, name)
+        return os.path.isdir(module_path) and not os.path.exists(os.path.join(module_path, "initstate"))
+
+    def get_refcount(self, module_name):
+        module = self.loaded_modules.get(_normalize_name(module_name))
+        return module.refcount if module is not None else 0
+
+    def get_holders(self, module_name):
+        module = self.loaded_modules.get(_normalize_name(module_name))
+        return module.holders if module is not None else []
+
+
+_backend = None
+
+
+def get_backend():
+    # One backend, and so one libkmod context, for the whole process
+    global _backend
+
+    if _backend is None:
+        try:
+            _backend = LibkmodBackend()
+
+        except KmodError as error:
+            get_logger().info("Falling back to modprobe: %s", str(error))
+            _backend = ModprobeBackend()
+
+    return _backend
+
+
+def set_backend(backend):
+    # Any object with `load(module, options)` and `unload(module)`
+    global _backend
+    _backend = backend
+
+
+class LibkmodBackend:
+    # Loads and unloads modules in-process, with the same config modprobe would use
+
+    def __init__(self):
+        try:
+            self._lib = CDLL("libkmod.so.2")
+
+        except OSError as error:
+            raise KmodError("Missing library: libkmod.so.2") from error
+
+        lib = self._lib
+        lib.kmod_new.restype = c_void_p
+        lib.kmod_new.argtypes = [c_char_p, c_void_p]
+        lib.kmod_load_resources.argtypes = [c_void_p]
+        lib.kmod_unref.argtypes = [c_void_p]
+        lib.kmod_module_new_from_lookup.argtypes = [c_void_p, c_char_p, c_void_p]
+        lib.kmod_module_new_from_name.argtypes = [c_void_p, c_char_p, c_void_p]
+        lib.kmod_list_next.restype = c_void_p
+        lib.kmod_list_next.argtypes = [c_void_p, c_void_p]
+        lib.kmod_module_get_module.restype = c_void_p
+        lib.kmod_module_get_module.argtypes = [c_void_p]
+        lib.kmod_module_unref.argtypes = [c_void_p]
+        lib.kmod_module_unref_list.argtypes = [c_void_p]
+        lib.kmod_module_probe_insert_module.argtypes = [c_void_p, c_uint, c_char_p, c_void_p, c_void_p, c_void_p]
+        lib.kmod_module_remove_module.argtypes = [c_void_p, c_uint]
+        lib.kmod_module_get_initstate.argtypes = [c_void_p]
+        lib.kmod_module_get_refcnt.argtypes = [c_void_p]
+        lib.kmod_module_get_dependencies.restype = c_void_p
+        lib.kmod_module_get_dependencies.argtypes = [c_void_p]
+
+        self._ctx = lib.kmod_new(None, None)
+
+        if not self._ctx:
+            raise KmodError("Unable to create a libkmod context")
+
+        lib.kmod_load_resources(self._ctx)
+
+    def close(self):
+        if self._ctx:
+            self._lib.kmod_unref(self._ctx)
+            self._ctx = None
+
+    def load(self, module, options):
+        # Resolves aliases and loads dependencies, like `modprobe`
+        lib = self._lib
+        mod_list = c_void_p()
+        ret = lib.kmod_module_new_from_lookup(self._ctx, module.encode(), byref(mod_list))
+
+        if ret < 0 or not mod_list:
+            raise KmodError(f"Module not found: {module}")
+
+        try:
+            entry = mod_list.value
+
+            while entry:
+                mod = lib.kmod_module_get_module(entry)
+
+                try:
+                    ret = lib.kmod_module_probe_insert_module(
+                        mod, 0, " ".join(options).encode(), None, None, None)
+
+                finally:
+                    lib.kmod_module_unref(mod)
+
+                if ret < 0:
+                    raise KmodError(f"Failed to load {module}: {os.strerror(-ret)}")
+
+                entry = lib.kmod_list_next(mod_list, entry)
+
+        finally:
+            lib.kmod_module_unref_list(mod_list)
+
+    def unload(self, module):
+        # Also removes the dependencies left unused, like `modprobe -r`
+        lib = self._lib
+        mod = c_void_p()
+
+        if lib.kmod_module_new_from_name(self._ctx, module.encode(), byref(mod)) < 0:
+            raise KmodError(f"Module not found: {module}")
+
+        try:
+            self._remove(mod.value, module, is_dependency=False)
+
+        finally:
+            lib.kmod_module_unref(mod)
+
+    def _remove(self, mod, module, is_dependency):
+        lib = self._lib
+        initstate = lib.kmod_module_get_initstate(mod)
+
+        if initstate < 0:
+            return # Not loaded
+
+        if initstate == KMOD_MODULE_BUILTIN:
+            if is_dependency:
+                return
+
+            raise KmodError(f"Module is built into the kernel: {module}")
+
+        if is_dependency and lib.kmod_module_get_refcnt(mod) != 0:
+            return
+
+        deps = lib.kmod_module_get_dependencies(mod)
+
+        try:
+            ret = lib.kmod_module_remove_module(mod, KMOD_REMOVE_NOWAIT)
+
+            if ret < 0 and ret != -errno.ENOENT:
+                if is_dependency:
+                    return
+
+                raise KmodError(f"Failed to unload {module}: {os.strerror(-ret)}")
+
+            entry = deps
+
+            while entry:
+                dep = lib.kmod_module_get_module(entry)
+
+                try:
+                    self._remove(dep, module, is_dependency=True)
+
+                finally:
+                    lib.kmod_module_unref(dep)
+
+                entry = lib.kmod_list_next(deps, entry)
+
+        finally:
+            if deps:
+                lib.kmod_module_unref_list(deps)
+
+
+class ModprobeBackend:
+
+    def load(self, module, options):
+        try:
+            runner.run(["modprobe", module] + options)
+
+        except runner.CommandError as error:
+            raise KmodError(f"Failed to modprobe {module}: {error.stderr}") from error
+
+    def unload(self, module):
+        try:
+            runner.run(["modprobe", "-r", module])
+
+        except runner.CommandError as error:
+            raise KmodError(f"Failed to unload {module}: {error.stderr}") from error
+
+
+def read_module_state():
+    try:
+        with open(envs.PROC_MODULES_PATH, "r") as modulesfile:
+            lines = modulesfile.readlines()
+
+    except IOError as error:
+        raise KmodError(f"Unable to read: {envs.PROC_MODULES_PATH}") from error
+
+    return ModuleState(_parse_proc_modules_line(line) for line in lines if line.strip())
+
+
+def read_module_refcount(module_name):
+    # None if the module isn't loaded, or is built-in
+    refcnt_path = os.path.join(envs.SYS_MODULES_PATH, _normalize_name(module_name), "refcnt")
+
+    try:
+        with open(refcnt_path, "r") as refcntfile:
+            return int(refcntfile.read().strip())
+
+    except (IOError, ValueError):
+        return None
+
+
+def read_module_holders(module_name):
+    holders_path = os.path.join(envs.SYS_MODULES_PATH, _normalize_name(module_name), "holders")
+
+    try:
+        return sorted(os.listdir(holders_path))
+
+    except OSError:
+        return []
+
+
+def _parse_proc_modules_line(line):
+    # Example: `nvidia_drm 77824 2 nvidia_modeset, Live 0xffffffffc1c4e000 (POE)`
+    fields = line.split()
+    name, size, refcount, holders, state = fields[:5]
+    address = int(fields[5], 16) if len(fields) > 5 else None
+
+    return LoadedModule(
+        name=name,
+        size=int(size),
+        refcount=int(refcount) if refcount != "-" else 0,
+        holders=[holder for holder in holders.split(",") if holder not in ["", "-"]],
+        state=state,
+        address=address)
+
+
+def load_module_index(release=None):
+    # Cached on disk, keyed by the kernel release and the index files' mtimes,
+    # so that `depmod` (run by DKMS on rebuilds) invalidates it
+    logger = get_logger()
+    release = release or os.uname().release
+    modules_dir_path = os.path.join(envs.KERNEL_MODULES_PATH, release)
+    cache_key = _make_cache_key(release, modules_dir_path)
+
+    try:
+        cache = var.read_module_index_cache()
+
+        if cache["key"] == cache_key:
+            return ModuleIndex.from_dict(cache["index"])
+
+    except (var.VarError, KeyError, TypeError):
+        pass
+
+    logger.info("Building module index for kernel: %s", release)
+    index = _parse_module_index(modules_dir_path)
+
+    try:
+        var.write_module_index_cache({"key": cache_key, "index": index.to_dict()})
+
+    except var.VarError as error:
+        logger.info("Not caching module index: %s", str(error))
+
+    return index
+
+
+def _make_cache_key(release, modules_dir_path):
+    key = [release]
+
+    for filename in INDEX_FILES:
+        try:
+            key.append(os.stat(os.path.join(modules_dir_path, filename)).st_mtime_ns)
+
+        except FileNotFoundError:
+            key.append(None)
+
+    return key
+
+
+def _parse_module_index(modules_dir_path):
+    modules = []
+    builtin = []
+    aliases = {}
+
+    try:
+        with open(os.path.join(modules_dir_path, "modules.dep"), "r") as depfile:
+            for line in depfile:
+                module_path, sep, _ = line.partition(":")
+
+                if sep:
+                    modules.append(_module_name_from_path(module_path))
+
+    except FileNotFoundError as error:
+        raise KmodError(f"Missing module index: {modules_dir_path}/modules.dep: Run depmod") from error
+
+    except IOError as error:
+        raise KmodError(f"Unable to read module index: {modules_dir_path}/modules.dep") from error
+
+    try:
+        with open(os.path.join(modules_dir_path, "modules.builtin"), "r") as builtinfile:
+            builtin = [_module_name_from_path(line) for line in builtinfile if line.strip()]
+
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(os.path.join(modules_dir_path, "modules.alias"), "r") as aliasfile:
+            for line in aliasfile:
+                fields = line.split()
+
+                # Only plain name aliases matter here, not the device patterns
+                if len(fields) == 3 and fields[0] == "alias" and not any(c in fields[1] for c in "*?["):
+                    aliases[_normalize_name(fields[1])] = _normalize_name(fields[2])
+
+    except FileNotFoundError:
+        pass
+
+    return ModuleIndex(modules, builtin, aliases)
+
+
+def _module_name_from_path(module_path):
+    # Example: `updates/dkms/nvidia-drm.ko.zst` -> `nvidia_drm`
+    filename = os.path.basename(module_path.strip())
+    return _normalize_name(filename.split(".ko")[0])
+
+
+def _normalize_name(module_name):
+    return module_name.replace("-", "_")
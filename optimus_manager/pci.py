@@ -1,8 +1,11 @@
 import os
 import re
-import subprocess
-from pathlib import Path
+import threading
+import time
+from . import envs
+from . import runner
 from .log_utils import get_logger
+from .uevent import open_device_monitor
 
 VENDOR_IDS = {
     "nvidia": "10de",
@@ -11,83 +14,340 @@ VENDOR_IDS = {
 }
 
 GPU_PCI_CLASS_PATTERN = "03[0-9a-f]{2}"
-PCI_BRIDGE_PCI_CLASS_PATTERN = "0604"
+PCI_BUS_ID_PATTERN = "[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\\.[0-7]"
+
+# Bridge register toggled to hot reset the card behind it
+HOT_RESET_REGISTER = 0x488
+HOT_RESET_MASK = 0x2000000
+
+# From `linux/pci_regs.h`
+PCI_STATUS = 0x06
+PCI_STATUS_CAP_LIST = 0x10
+PCI_CAPABILITY_LIST = 0x34
+PCI_CAP_ID_EXP = 0x10
+PCI_EXP_LNKCAP = 0x0c
+PCI_EXP_LNKCAP_DLLLARC = 0x100000
+PCI_EXP_LNKSTA = 0x12
+PCI_EXP_LNKSTA_DLLLA = 0x2000
 
 
 class PCIError(Exception):
     pass
 
 
-def set_power_state(mode):
-    _write_to_nvidia_path("power/control", mode)
+class PciTopology:
+    # Snapshot of the GPUs, the PCI functions of the Nvidia card and its parent bridges.
+    # Built once per hook run and passed around, so that the bus is enumerated
+    # only again after an operation that changes it: rescan, removal or hot reset.
 
+    # Shared by the operations of a plan, which may run concurrently,
+    # so the snapshot is built and invalidated under a lock.
 
-def function_level_reset_nvidia():
-    _write_to_nvidia_path("reset", "1")
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._devices = None
+        self._bus_ids = None
+        self.enumerations_count = 0
+        self.enumerations_time = 0.0
 
+    def invalidate(self):
+        with self._lock:
+            self._devices = None
+            self._bus_ids = None
 
-def hot_reset_nvidia():
-    logger = get_logger()
-    bus_ids = get_gpus_bus_ids(notation_fix=False)
+    def get_gpus_bus_ids(self, notation_fix=True):
+        with self._lock:
+            if self._bus_ids is None:
+                self._bus_ids = _pick_gpus_bus_ids(self._get_devices())
+
+            bus_ids = self._bus_ids
+
+        if not notation_fix:
+            return dict(bus_ids)
+
+        return {
+            manufacturer: _to_xorg_bus_id(bus_id)
+            for manufacturer, bus_id in bus_ids.items()
+        }
+
+    def get_nvidia_functions(self):
+        # All PCI functions of the Nvidia card,
+        # in case it has an audio chipset or a Thunderbolt controller
+        bus_ids = self.get_gpus_bus_ids(notation_fix=False)
+
+        if "nvidia" not in bus_ids.keys():
+            raise PCIError("Nvidia isn't in the PCI bus")
+
+        nvidia_id = bus_ids["nvidia"]
+        res = re.fullmatch(r"([0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2})\.[0-9]", nvidia_id)
+
+        if res is None:
+            raise PCIError(f"Unexpected PCI ID format: {nvidia_id}")
+
+        partial_id = res.groups()[0]
+        # Bus ID minus the PCI function number
+
+        return [
+            bus_id
+            for bus_id, _, _, _ in self._get_devices()
+            if re.fullmatch(f"{partial_id}\\.([0-9])", bus_id)
+        ]
+
+    def get_nvidia_bridges(self):
+        # Ordered from the root port down to the bridge the card is plugged in
+        bus_ids = self.get_gpus_bus_ids(notation_fix=False)
+
+        if "nvidia" not in bus_ids.keys():
+            raise PCIError("Nvidia isn't in the PCI bus")
+
+        return _get_upstream_pci_bridges(bus_ids["nvidia"])
+
+    def _get_devices(self):
+        with self._lock:
+            if self._devices is None:
+                logger = get_logger()
+                start_time = time.monotonic()
+                self._devices = _list_pci_devices()
+                elapsed = time.monotonic() - start_time
+                self.enumerations_count += 1
+                self.enumerations_time += elapsed
+
+                logger.info(
+                    "Enumerated PCI bus: %d devices in %.1fms (enumeration #%d)",
+                    len(self._devices), elapsed * 1000, self.enumerations_count)
+
+            return self._devices
+
+
+def set_power_state(topology, mode):
+    _write_to_nvidia_path(topology, "power/control", mode)
+
+
+def get_power_state(topology):
+    bus_ids = topology.get_gpus_bus_ids(notation_fix=False)
 
     if "nvidia" not in bus_ids.keys():
-        raise PCIError("Nvidia isn't in the PCI bus")
+        return None
+
+    return _read_pci_path(os.path.join(envs.PCI_DEVICES_PATH, bus_ids["nvidia"], "power/control")).strip()
+
+
+def function_level_reset_nvidia(topology):
+    _write_to_nvidia_path(topology, "reset", "1")
 
-    nvidia_pci_bridges_ids_list = _get_connected_pci_bridges(bus_ids["nvidia"])
+
+def hot_reset_nvidia(topology):
+    logger = get_logger()
+    nvidia_pci_bridges_ids_list = topology.get_nvidia_bridges()
 
     if len(nvidia_pci_bridges_ids_list) == 0:
         raise PCIError("Unable to PCI hot reset: Unable to find the PCI bridge connected to the Nvidia card")
 
-    if len(nvidia_pci_bridges_ids_list) > 1:
-        raise PCIError("Unable to PCI hot reset: Found more than one PCI bridge connected to the Nvidia card")
-
-    nvidia_pci_bridge = nvidia_pci_bridges_ids_list[0]
+    logger.info("PCI bridges above the Nvidia card: %s", " -> ".join(nvidia_pci_bridges_ids_list))
+    nvidia_pci_bridge = nvidia_pci_bridges_ids_list[-1]
     logger.info("Removing Nvidia from PCI bridge")
-    remove_nvidia()
+    remove_nvidia(topology)
     logger.info("Triggering PCI hot reset of bridge: %s", nvidia_pci_bridge)
+    config_path = os.path.join(envs.PCI_DEVICES_PATH, nvidia_pci_bridge, "config")
 
     try:
-        subprocess.check_call(
-            f"setpci -s {nvidia_pci_bridge} 0x488.l=0x2000000:0x2000000",
-            shell=True, text=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        with PciConfigSpace(config_path) as config_space:
+            config_space.write_masked(HOT_RESET_REGISTER, HOT_RESET_MASK, HOT_RESET_MASK, size=4)
+            link_time = _wait_for_link(config_space, envs.PCI_LINK_WAIT_TIMEOUT)
+
+    except OSError as error:
+        raise PCIError(f"Unable to access PCI config space: {config_path}: {str(error)}") from error
 
-    except subprocess.CalledProcessError as error:
-        raise PCIError(f"Failed to run setpci: {e.stderr}") from error
+    if link_time is not None:
+        logger.info("Bridge link back up %.1fms after the reset", link_time * 1000)
 
     logger.info("Rescanning PCI bus")
-    rescan()
 
-    if not is_nvidia_visible():
-        raise PCIError("Failed to bring the Nvidia card back")
+    with open_device_monitor(envs.PCI_DEVICES_PATH) as monitor:
+        rescan(topology)
 
+        try:
+            appear_time = wait_for_nvidia(topology, monitor, envs.PCI_APPEAR_WAIT_TIMEOUT)
 
-def remove_nvidia():
-    _write_to_nvidia_path("remove", "1")
+        except PCIError as error:
+            raise PCIError(f"Failed to bring the Nvidia card back: {str(error)}") from error
 
+    logger.info("Nvidia card back in the PCI bus after %.1fms", appear_time * 1000)
+
+
+def remove_nvidia(topology):
+    try:
+        _write_to_nvidia_path(topology, "remove", "1")
 
-def is_nvidia_visible():
-    bus_ids = get_gpus_bus_ids(notation_fix=False)
+    finally:
+        topology.invalidate()
+
+
+def is_nvidia_visible(topology):
+    bus_ids = topology.get_gpus_bus_ids(notation_fix=False)
 
     if "nvidia" not in bus_ids.keys():
         return False
 
-    pci_path = "/sys/bus/pci/devices/0000:%s/" % bus_ids["nvidia"]
+    pci_path = os.path.join(envs.PCI_DEVICES_PATH, bus_ids["nvidia"])
     return os.path.isdir(pci_path)
 
 
-def rescan():
-    _write_to_pci_path("/sys/bus/pci/rescan", "1")
+def rescan(topology):
+    try:
+        _write_to_pci_path(envs.PCI_RESCAN_PATH, "1")
+
+    finally:
+        topology.invalidate()
+
+
+def wait_for_nvidia(topology, monitor, timeout):
+    # Blocks until the Nvidia card shows up in the PCI bus and returns the time it took.
+    # The bus is checked again on every device event that may be the card,
+    # and at least every `PCI_APPEAR_POLL_PERIOD` in case events are missed.
+    # Cut short by the switch deadline, which raises DeadlineError.
+    start_time = time.monotonic()
+    wait_timeout = runner.get_timeout(timeout)
+
+    while not is_nvidia_visible(topology):
+        remaining = wait_timeout - (time.monotonic() - start_time)
+
+        if remaining <= 0:
+            if wait_timeout < timeout:
+                raise runner.DeadlineError("wait for Nvidia in PCI bus", wait_timeout)
+
+            raise PCIError(f"Nvidia card not showing up in PCI bus after {timeout}s")
+
+        poll_deadline = time.monotonic() + min(remaining, envs.PCI_APPEAR_POLL_PERIOD)
+        wait_time = poll_deadline - time.monotonic()
+
+        while wait_time > 0:
+            if any(_may_be_nvidia_event(event) for event in monitor.wait(wait_time)):
+                break
+
+            wait_time = poll_deadline - time.monotonic()
+
+        topology.invalidate()
+
+    return time.monotonic() - start_time
+
+
+class PciConfigSpace:
+    # Masked register access to a PCI config space file,
+    # like `setpci` does, without spawning it
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR)
+        return self
 
+    def __exit__(self, *args):
+        os.close(self._fd)
+        self._fd = None
 
-def get_gpus_bus_ids(notation_fix=True):
+    def read(self, offset, size=4):
+        data = os.pread(self._fd, size, offset)
+
+        if len(data) != size:
+            raise OSError(f"Short read at offset {offset:#x}")
+
+        return int.from_bytes(data, "little")
+
+    def write_masked(self, offset, value, mask, size=4):
+        current = self.read(offset, size)
+        new_value = (current & ~mask) | (value & mask)
+        os.pwrite(self._fd, new_value.to_bytes(size, "little"), offset)
+
+    def find_capability(self, cap_id):
+        if not self.read(PCI_STATUS, 2) & PCI_STATUS_CAP_LIST:
+            return None
+
+        offset = self.read(PCI_CAPABILITY_LIST, 1) & ~0x3
+        visited = set()
+
+        # The list lives after the standard header and can't loop in valid hardware
+        while offset >= 0x40 and offset not in visited:
+            visited.add(offset)
+
+            if self.read(offset, 1) == cap_id:
+                return offset
+
+            offset = self.read(offset + 1, 1) & ~0x3
+
+        return None
+
+
+def _wait_for_link(config_space, timeout):
+    # Polls the Data Link Layer Link Active bit of the bridge: first until the reset brought
+    # the link down, for at most `PCI_LINK_DOWN_WAIT_TIMEOUT`, then until the link is back.
+    # Returns the time since the reset, or None if the bridge can't report it.
+    # Cut short by the switch deadline, which raises DeadlineError.
+    logger = get_logger()
+    cap_offset = config_space.find_capability(PCI_CAP_ID_EXP)
+
+    if cap_offset is None:
+        logger.info("Not waiting for the bridge link: No PCI Express capability")
+        return None
+
+    if not config_space.read(cap_offset + PCI_EXP_LNKCAP, 4) & PCI_EXP_LNKCAP_DLLLARC:
+        logger.info("Not waiting for the bridge link: Link state reporting unsupported")
+        return None
+
+    lnksta_offset = cap_offset + PCI_EXP_LNKSTA
+    start_time = time.monotonic()
+    wait_timeout = runner.get_timeout(timeout)
+
+    if not _poll_link(config_space, lnksta_offset, False, min(envs.PCI_LINK_DOWN_WAIT_TIMEOUT, wait_timeout)):
+        logger.warning(
+            "Bridge link not going down after %.0fms: Not waiting for it", envs.PCI_LINK_DOWN_WAIT_TIMEOUT * 1000)
+        return None
+
+    logger.info("Bridge link down after %.1fms", (time.monotonic() - start_time) * 1000)
+
+    if not _poll_link(config_space, lnksta_offset, True, wait_timeout - (time.monotonic() - start_time)):
+        if wait_timeout < timeout:
+            raise runner.DeadlineError("wait for the PCI bridge link", wait_timeout)
+
+        raise PCIError(f"Bridge link still down after {timeout}s")
+
+    return time.monotonic() - start_time
+
+
+def _poll_link(config_space, lnksta_offset, active, timeout):
+    # Returns False if the link isn't in the `active` state after `timeout`
+    start_time = time.monotonic()
+
+    while bool(config_space.read(lnksta_offset, 2) & PCI_EXP_LNKSTA_DLLLA) != active:
+        if time.monotonic() - start_time > timeout:
+            return False
+
+        time.sleep(envs.PCI_LINK_WAIT_PERIOD)
+
+    return True
+
+
+def _may_be_nvidia_event(event):
+    if event.get("ACTION") != "add":
+        return False
+
+    if event.get("SUBSYSTEM", "pci") != "pci":
+        return False
+
+    # Events without a PCI ID (inotify) can't be told apart
+    pci_id = event.get("PCI_ID", VENDOR_IDS["nvidia"])
+    return pci_id.lower().startswith(VENDOR_IDS["nvidia"])
+
+
+def _pick_gpus_bus_ids(devices):
     logger = get_logger()
     bus_ids = {}
+    ids_by_vendor = _search_bus_ids(devices, GPU_PCI_CLASS_PATTERN, notation_fix=False)
 
     for manufacturer, vendor_id in VENDOR_IDS.items():
-        ids_list = _search_bus_ids(
-            match_pci_class=GPU_PCI_CLASS_PATTERN,
-            match_vendor_id=vendor_id,
-            notation_fix=notation_fix)
+        ids_list = ids_by_vendor.get(vendor_id, [])
 
         if len(ids_list) > 1:
             logger.warning(f"Multiple {manufacturer} GPUs found: Picking the last one")
@@ -105,64 +365,79 @@ def get_gpus_bus_ids(notation_fix=True):
     return bus_ids
 
 
-def _search_bus_ids(match_pci_class, match_vendor_id, notation_fix=True):
+def _search_bus_ids(devices, match_pci_class, notation_fix=True):
+    # Returns the matching bus IDs of every vendor at once, grouped by vendor ID
+    ids_by_vendor = {}
+
+    for bus_id, pci_class, vendor_id, _ in devices:
+        if not re.fullmatch(match_pci_class, pci_class):
+            continue
+
+        if notation_fix:
+            bus_id = _to_xorg_bus_id(bus_id)
+
+        ids_by_vendor.setdefault(vendor_id, []).append(bus_id)
+
+    return ids_by_vendor
+
+
+def _list_pci_devices():
+    # Single pass over sysfs instead of forking `lspci -n`.
+    # Returns `(bus_id, pci_class, vendor_id, device_id)` sorted by bus ID,
+    # with the bus ID in full kernel notation (`0000:3c:00.0`)
+    # and the class trimmed to `lspci -n` length (`0x030000` -> `0300`)
+
     try:
-        out = subprocess.check_output(
-            "lspci -n", shell=True, text=True, stderr=subprocess.PIPE).strip()
+        bus_ids_list = sorted(os.listdir(envs.PCI_DEVICES_PATH))
 
-    except subprocess.CalledProcessError as error:
-        raise PCIError(f"Unable to run lspci -n: {error.stderr}") from error
+    except OSError as error:
+        raise PCIError(f"Unable to list PCI devices: {envs.PCI_DEVICES_PATH}: {str(error)}") from error
 
-    bus_ids_list = []
+    devices = []
 
-    for line in out.splitlines():
-        items = line.split(" ")
-        bus_id = items[0]
+    for bus_id in bus_ids_list:
+        device_path = os.path.join(envs.PCI_DEVICES_PATH, bus_id)
 
-        if notation_fix:
-            # Example: `3c:00:0` (kernel hexadecimal) -> `PCI:60:0:0` (xorg decimal)
+        try:
+            pci_class = _read_hex_attribute(device_path, "class")[:4]
+            vendor_id = _read_hex_attribute(device_path, "vendor")
+            device_id = _read_hex_attribute(device_path, "device")
 
-            # If there are devices with different number
-            # `lspci -n` can sometimes output domain number
+        except OSError:
+            # Removed while scanning
+            continue
 
-            bus_id = "PCI:" + ":".join(
-                str(int(field, 16)) for field in re.split("[.:]", bus_id)[-3:]
-            )
+        devices.append((bus_id, pci_class, vendor_id, device_id))
 
-        pci_class = items[1][:-1]
-        vendor_id, _ = items[2].split(":")
+    return devices
 
-        if re.fullmatch(match_pci_class, pci_class) and re.fullmatch(match_vendor_id, vendor_id):
-            bus_ids_list.append(bus_id)
 
-    return bus_ids_list
+def _read_hex_attribute(device_path, name):
+    with open(os.path.join(device_path, name), "r") as attrfile:
+        value = attrfile.read().strip().lower()
 
+    return value[2:] if value.startswith("0x") else value
 
-def _write_to_nvidia_path(relative_path, string):
-    logger = get_logger()
-    bus_ids = get_gpus_bus_ids(notation_fix=False)
 
-    if "nvidia" not in bus_ids.keys():
-        raise PCIError("Nvidia isn't in the PCI bus")
+def _to_xorg_bus_id(bus_id):
+    # Example: `0000:3c:00.0` (kernel hexadecimal) -> `PCI:60:0:0` (xorg decimal)
+    # Non-zero domains use the xorg `bus@domain` syntax: `0001:3c:00.0` -> `PCI:60@1:0:0`
+
+    domain, bus, device, function = (int(field, 16) for field in re.split("[.:]", bus_id))
 
-    nvidia_id = bus_ids["nvidia"]
-    res = re.fullmatch(r"([0-9a-f]{2}:[0-9a-f]{2})\.[0-9]", nvidia_id)
+    if domain == 0:
+        return f"PCI:{bus}:{device}:{function}"
 
-    if res is None:
-        raise PCIError(f"Unexpected PCI ID format: {nvidia_id}")
+    return f"PCI:{bus}@{domain}:{device}:{function}"
 
-    partial_id = res.groups()[0]
-    # Bus ID minus the PCI function number
 
-    # Applied to all PCI functions of the Nvidia card
-    # in case they have an audio chipset or a Thunderbolt controller
-    for device_path in Path("/sys/bus/pci/devices/").iterdir():
-        device_id = device_path.name
+def _write_to_nvidia_path(topology, relative_path, string):
+    logger = get_logger()
 
-        if re.fullmatch(f"0000:{partial_id}\\.([0-9])", device_id):
-            write_path = device_path / relative_path
-            logger.info(f"Writing \"{string}\" to: {write_path}")
-            _write_to_pci_path(write_path, string)
+    for device_id in topology.get_nvidia_functions():
+        write_path = os.path.join(envs.PCI_DEVICES_PATH, device_id, relative_path)
+        logger.info(f"Writing \"{string}\" to: {write_path}")
+        _write_to_pci_path(write_path, string)
 
 
 def _write_to_pci_path(pci_path, string):
@@ -191,25 +466,18 @@ def _read_pci_path(pci_path):
     return string
 
 
-def _get_connected_pci_bridges(pci_id):
-    bridges = _search_bus_ids(
-        match_pci_class=PCI_BRIDGE_PCI_CLASS_PATTERN,
-        match_vendor_id=".+",
-        notation_fix=False)
-
-    connected_bridges = []
-
-    for bridge in bridges:
-        path = "/sys/bus/pci/devices/0000:%s/" % bridge
-        directories = os.listdir(path)
-        index = 0
-
-        while not connected_bridges and index < len(directories):
-            dir_path = os.path.join(path, directories[index])
+def _get_upstream_pci_bridges(pci_id):
+    # The sysfs device path of a PCI function goes through every bridge
+    # up to the root complex: `/sys/devices/pci0000:00/0000:00:01.0/0000:01:00.0`
+    device_path = os.path.realpath(os.path.join(envs.PCI_DEVICES_PATH, pci_id))
 
-            if os.path.isdir(dir_path) and directories[index] == "0000:%s" % pci_id:
-                connected_bridges.append(bridge)
+    bus_ids_list = [
+        component
+        for component in device_path.split(os.sep)
+        if re.fullmatch(PCI_BUS_ID_PATTERN, component)
+    ]
 
-            index += 1
+    if len(bus_ids_list) == 0 or bus_ids_list[-1] != pci_id:
+        raise PCIError(f"Unable to resolve the sysfs path of PCI device: {pci_id}: {device_path}")
 
-    return connected_bridges
+    return bus_ids_list[:-1]
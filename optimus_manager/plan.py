@@ -0,0 +1,206 @@
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from . import envs
+from . import runner
+from . import var
+from .log_utils import get_logger
+
+OPERATION_KINDS = [
+    "module_load", "module_unload", "sysfs_write", "pci_rescan", "pci_remove",
+    "pci_reset", "pci_enumerate", "acpi_call", "script_run", "file_read",
+    "xorg_conf_render", "xorg_conf_write"
+]
+
+Operation = namedtuple("Operation", ["kind", "description", "func", "args", "requires"])
+
+# Placeholder argument, replaced by what an earlier operation returned
+ResultOf = namedtuple("ResultOf", ["operation"])
+
+
+def make_operation(kind, description, func, *args, requires=None):
+    # `requires` lists the operations to run this one after. If None, it runs after
+    # all the operations before it in the plan, which is what the kernel steps need.
+    # Operations passed as `ResultOf` arguments are required too.
+    assert kind in OPERATION_KINDS
+    return Operation(kind, description, func, args, None if requires is None else list(requires))
+
+
+def run_plan(plan):
+    # Runs the operations on a thread pool, each one as soon as those it requires are done.
+    # After a failure no other operation is started, and the first error is raised.
+    # Their latencies are recorded to estimate the cost of future plans.
+    logger = get_logger()
+    dependencies = _resolve_dependencies(plan)
+    pending = list(range(len(plan)))
+    running = {}
+    results = {}
+    latencies = []
+    errors = []
+    start_time = time.monotonic()
+
+    try:
+        with ThreadPoolExecutor(max_workers=envs.PLAN_MAX_WORKERS) as executor:
+            while pending or running:
+                ready = [] if errors else [index for index in pending if dependencies[index] <= results.keys()]
+
+                for index in ready:
+                    try:
+                        runner.check_deadline("%s: %s" % (plan[index].kind, plan[index].description))
+
+                    except runner.DeadlineError as error:
+                        errors.append(error)
+                        break
+
+                    pending.remove(index)
+                    args = _resolve_args(plan, plan[index], results)
+                    running[executor.submit(_run_operation, plan[index], args)] = index
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index = running.pop(future)
+                    result, elapsed, error = future.result()
+                    latencies.append((plan[index].kind, elapsed))
+
+                    if error is not None:
+                        errors.append(error)
+
+                    else:
+                        results[index] = result
+
+    finally:
+        _record_latencies(latencies)
+
+    if len(plan) > 0:
+        logger.info(
+            "Plan done in %.1fms: %d of %d operations, %.1fms of operations",
+            (time.monotonic() - start_time) * 1000, len(latencies), len(plan),
+            sum(elapsed for _, elapsed in latencies) * 1000)
+
+    if errors:
+        raise errors[0]
+
+
+def format_plan(plan):
+    latencies = load_latencies()
+    dependencies = _resolve_dependencies(plan)
+    finish_times = []
+    lines = []
+
+    for index, operation in enumerate(plan):
+        estimate = latencies.get(operation.kind)
+        estimate_str = "?" if estimate is None else "~%.1fms" % (estimate * 1000)
+
+        # Operations not starting right after the previous one say what they wait for
+        if operation.requires is None and not _has_result_args(operation):
+            after_str = ""
+
+        else:
+            after_str = "after " + (", ".join(str(dep + 1) for dep in sorted(dependencies[index])) or "nothing")
+
+        lines.append(("%2d. %-16s %-48s %-10s %s" % (
+            index + 1, operation.kind, operation.description, estimate_str, after_str)).rstrip())
+
+        start = max((finish_times[dep] for dep in dependencies[index]), default=0.0)
+        finish_times.append(start + (estimate or 0.0))
+
+    if len(plan) == 0:
+        lines.append("Nothing to do")
+
+    lines.append("Estimated total: ~%.1fms" % (max(finish_times, default=0.0) * 1000))
+    return "\n".join(lines)
+
+
+def _resolve_dependencies(plan):
+    # Set of the indices in `plan` each operation must wait for
+    index_by_id = {id(operation): index for index, operation in enumerate(plan)}
+    dependencies = []
+
+    for index, operation in enumerate(plan):
+        if operation.requires is None:
+            required = set(range(index))
+
+        else:
+            required = {index_by_id[id(dep)] for dep in operation.requires}
+
+        required |= {index_by_id[id(arg.operation)] for arg in operation.args if isinstance(arg, ResultOf)}
+        assert all(dep < index for dep in required)
+        dependencies.append(required)
+
+    return dependencies
+
+
+def _has_result_args(operation):
+    return any(isinstance(arg, ResultOf) for arg in operation.args)
+
+
+def _resolve_args(plan, operation, results):
+    index_by_id = {id(plan_operation): index for index, plan_operation in enumerate(plan)}
+
+    return [
+        results[index_by_id[id(arg.operation)]] if isinstance(arg, ResultOf) else arg
+        for arg in operation.args
+    ]
+
+
+def _run_operation(operation, args):
+    # In a worker thread: errors are handed back to `run_plan`
+    logger = get_logger()
+    logger.info("Running operation: %s: %s", operation.kind, operation.description)
+    start_time = time.monotonic()
+    result = None
+    error = None
+
+    try:
+        result = operation.func(*args)
+
+    # pylint: disable=W0703
+    except Exception as exception:
+        error = exception
+
+    elapsed = time.monotonic() - start_time
+    logger.info("Operation done in %.1fms: %s: %s", elapsed * 1000, operation.kind, operation.description)
+    return result, elapsed, error
+
+
+def load_latencies():
+    # Mean latency in seconds of every operation kind measured so far
+    try:
+        stats = var.read_operation_latencies()
+
+    except var.VarError:
+        return {}
+
+    return {
+        kind: kind_stats["total"] / kind_stats["count"]
+        for kind, kind_stats in stats.items()
+        if kind_stats.get("count", 0) > 0
+    }
+
+
+def _record_latencies(latencies):
+    logger = get_logger()
+
+    if len(latencies) == 0:
+        return
+
+    try:
+        stats = var.read_operation_latencies()
+
+    except var.VarError:
+        stats = {}
+
+    for kind, elapsed in latencies:
+        kind_stats = stats.setdefault(kind, {"count": 0, "total": 0.0})
+        kind_stats["count"] += 1
+        kind_stats["total"] += elapsed
+
+    try:
+        var.write_operation_latencies(stats)
+
+    except var.VarError as error:
+        logger.warning("Unable to record operation latencies: %s", str(error))
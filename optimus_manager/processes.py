@@ -1,6 +1,17 @@
-import subprocess
+import glob
+import os
+import pwd
+from collections import namedtuple
+from . import envs
+from . import pci
+from . import runner
 from .log_utils import get_logger
 
+PROC_PATH = "/proc"
+DEV_PATH = "/dev"
+
+GpuUser = namedtuple("GpuUser", ["pid", "user", "device", "cmdline"])
+
 
 class ProcessesError(Exception):
     pass
@@ -12,10 +23,9 @@ def get_PIDs_from_process_names(processes_names_list):
 
     for p_name in processes_names_list:
         try:
-            process_PIDs_str = subprocess.check_output(
-                f"pidof {p_name}", shell=True, text=True).strip()
+            process_PIDs_str = runner.run(["pidof", p_name], capture_output=True).stdout.strip()
 
-        except subprocess.CalledProcessError:
+        except runner.CommandError:
             continue
 
         try:
@@ -35,10 +45,9 @@ def get_PIDs_from_process_names(processes_names_list):
 
 def get_PID_user(PID_value):
     try:
-        user = subprocess.check_output(
-            f"ps -o uname= -p {PID_value}", shell=True, text=True).strip()
+        user = runner.run(["ps", "-o", "uname=", "-p", str(PID_value)], capture_output=True).stdout.strip()
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         raise ProcessesError("PID doesn't exist: %d" % PID_value) from error
 
     return user
@@ -46,9 +55,115 @@ def get_PID_user(PID_value):
 
 def kill_PID(PID_value, signal):
     try:
-        subprocess.check_call(
-            f"kill {signal} {PID_value}", shell=True, text=True,
-            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        runner.run(["kill", signal, str(PID_value)])
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         raise ProcessesError(f"Unable to kill PID {PID_value}: {error.stderr}") from error
+
+
+def get_nvidia_device_paths(topology):
+    # `/dev/nvidia*`, plus the DRM render node of the Nvidia card if it has one
+    logger = get_logger()
+    device_paths = set(glob.glob(os.path.join(DEV_PATH, "nvidia*")))
+
+    try:
+        bus_ids = topology.get_gpus_bus_ids(notation_fix=False)
+
+    except pci.PCIError as error:
+        logger.warning("Unable to find the Nvidia render node: %s", str(error))
+        return device_paths
+
+    if "nvidia" in bus_ids:
+        drm_path = os.path.join(envs.PCI_DEVICES_PATH, bus_ids["nvidia"], "drm")
+
+        try:
+            for name in os.listdir(drm_path):
+                if name.startswith("renderD"):
+                    device_paths.add(os.path.join(DEV_PATH, "dri", name))
+
+        except OSError:
+            pass
+
+    return device_paths
+
+
+def find_gpu_users(device_paths):
+    # Single pass over `/proc`: open file descriptors first, then memory mappings.
+    # Stops at the first match of each process. Processes of other users are
+    # skipped when not running as root.
+    device_paths = set(device_paths)
+    users_cache = {}
+    gpu_users = []
+
+    try:
+        entries = [entry.name for entry in os.scandir(PROC_PATH) if entry.name.isdigit()]
+
+    except OSError as error:
+        raise ProcessesError(f"Unable to list processes: {PROC_PATH}: {str(error)}") from error
+
+    for pid_str in entries:
+        process_path = os.path.join(PROC_PATH, pid_str)
+        device = _find_process_fd_device(process_path, device_paths) or \
+            _find_process_mapped_device(process_path, device_paths)
+
+        if device is None:
+            continue
+
+        try:
+            uid = os.stat(process_path).st_uid
+
+            with open(os.path.join(process_path, "cmdline"), "rb") as cmdfile:
+                cmdline = cmdfile.read().replace(b"\0", b" ").decode("utf-8", errors="replace").strip()
+
+        except OSError:
+            # Exited meanwhile
+            continue
+
+        if uid not in users_cache:
+            try:
+                users_cache[uid] = pwd.getpwuid(uid).pw_name
+
+            except KeyError:
+                users_cache[uid] = str(uid)
+
+        gpu_users.append(GpuUser(int(pid_str), users_cache[uid], device, cmdline))
+
+    return sorted(gpu_users)
+
+
+def _find_process_fd_device(process_path, device_paths):
+    fd_dir_path = os.path.join(process_path, "fd")
+
+    try:
+        fds = os.listdir(fd_dir_path)
+
+    except OSError:
+        return None
+
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir_path, fd))
+
+        except OSError:
+            continue
+
+        if target in device_paths:
+            return target
+
+    return None
+
+
+def _find_process_mapped_device(process_path, device_paths):
+    try:
+        with open(os.path.join(process_path, "maps"), "r") as mapsfile:
+            for line in mapsfile:
+                # Example: `7f3c2a000000-7f3c2a001000 rw-s 00000000 00:05 1042   /dev/nvidiactl`
+                fields = line.split(maxsplit=5)
+
+                if len(fields) == 6 and fields[5].rstrip("\n") in device_paths:
+                    return fields[5].rstrip("\n")
+
+    except OSError:
+        pass
+
+    return None
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import socket
+import struct
+import time
+from . import envs
+
+# Every message is a JSON object, prefixed by its length as a 4-bytes big-endian integer.
+# Requests: {"id": 1, "type": "switch", "args": {...}}
+# Replies: {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": "..."}
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RequestError(Exception):
+    # The daemon received the request but refused or failed it
+    pass
+
+
+def encode_message(message):
+    payload = json.dumps(message).encode('utf-8')
+
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ProtocolError("Message too big: %d bytes" % len(payload))
+
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_messages(buffer):
+    # Splits the complete messages off the start of `buffer`: returns them and what is left
+    messages = []
+    offset = 0
+
+    while len(buffer) - offset >= HEADER.size:
+        size, = HEADER.unpack_from(buffer, offset)
+
+        if size > MAX_MESSAGE_SIZE:
+            raise ProtocolError("Message too big: %d bytes" % size)
+
+        start = offset + HEADER.size
+
+        if len(buffer) - start < size:
+            break
+
+        try:
+            messages.append(json.loads(buffer[start:start + size].decode('utf-8')))
+
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError) as error:
+            raise ProtocolError("Invalid message: %s" % str(error)) from error
+
+        offset = start + size
+
+    return messages, buffer[offset:]
+
+
+async def read_message(reader):
+    # From an asyncio stream: None if it ends between two messages
+    try:
+        header = await reader.readexactly(HEADER.size)
+
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise ProtocolError("Truncated message header") from error
+
+        return None
+
+    size, = HEADER.unpack(header)
+
+    if size > MAX_MESSAGE_SIZE:
+        raise ProtocolError("Message too big: %d bytes" % size)
+
+    try:
+        payload = await reader.readexactly(size)
+
+    except asyncio.IncompleteReadError as error:
+        raise ProtocolError("Truncated message") from error
+
+    try:
+        return json.loads(payload.decode('utf-8'))
+
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError) as error:
+        raise ProtocolError("Invalid message: %s" % str(error)) from error
+
+
+def make_reply(request_id, result=None, error=None):
+    if error is not None:
+        return {"id": request_id, "ok": False, "error": error}
+
+    return {"id": request_id, "ok": True, "result": result}
+
+
+def send_requests(requests, socket_path=None, timeout=envs.SOCKET_REQUEST_TIMEOUT):
+    # Sends all the requests on one connection, then waits for their replies.
+    # Returns their results in order, or raises RequestError for the first that failed.
+    socket_path = socket_path or envs.SOCKET_PATH
+
+    requests = [
+        dict(request, id=request_id)
+        for request_id, request in enumerate(requests, start=1)
+    ]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC) as client:
+            client.settimeout(timeout)
+            _connect(client, socket_path, timeout)
+            client.sendall(b"".join(encode_message(request) for request in requests))
+            replies = _receive_replies(client, len(requests))
+
+    except socket.timeout as error:
+        raise ProtocolError("No reply from the daemon at: %s" % socket_path) from error
+
+    except OSError as error:
+        raise ProtocolError("Socket unavailable: %s: %s" % (socket_path, error.strerror or str(error))) from error
+
+    results = []
+
+    for request in requests:
+        reply = replies.get(request["id"])
+
+        if reply is None:
+            raise ProtocolError("No reply to request: %s" % request["type"])
+
+        if not reply.get("ok"):
+            raise RequestError(reply.get("error", "Unknown error"))
+
+        results.append(reply.get("result"))
+
+    return results
+
+
+def send_request(request, socket_path=None, timeout=envs.SOCKET_REQUEST_TIMEOUT):
+    return send_requests([request], socket_path, timeout)[0]
+
+
+def _connect(client, socket_path, timeout):
+    # With a timeout, connecting to a Unix socket fails at once while the daemon's backlog
+    # is full, instead of waiting for it to accept: tried again until the timeout
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            client.connect(socket_path)
+            return
+
+        except BlockingIOError:
+            if time.monotonic() > deadline:
+                raise socket.timeout("Connection backlog full") from None
+
+            time.sleep(0.001)
+
+
+def _receive_replies(client, count):
+    replies = {}
+    buffer = b""
+
+    while len(replies) < count:
+        data = client.recv(65536)
+
+        if not data:
+            break
+
+        messages, buffer = decode_messages(buffer + data)
+
+        for message in messages:
+            replies[message.get("id")] = message
+
+    return replies
@@ -0,0 +1,246 @@
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from . import envs
+from .log_utils import get_logger
+
+# Exit code of a shell for a command that doesn't exist
+COMMAND_NOT_FOUND_CODE = 127
+PIPE_READ_SIZE = 65536
+
+# How often the exit of a command is checked for, where it can't be waited for on a pidfd
+EXIT_POLL_PERIOD = 0.01
+
+# Each command in its own process group: `process_group` is Python 3.11+
+PROCESS_GROUP_ARGS = {"process_group": 0} if sys.version_info >= (3, 11) else {"preexec_fn": os.setpgrp}
+
+CommandResult = namedtuple("CommandResult", ["returncode", "stdout", "stderr"])
+
+
+class CommandError(Exception):
+    # The command failed, or couldn't be started if `returncode` is None
+
+    def __init__(self, args, returncode, stderr):
+        if returncode is None:
+            msg = "Unable to run: %s: %s" % (" ".join(args), stderr)
+
+        else:
+            msg = "Command failed with code %d: %s: %s" % (returncode, " ".join(args), stderr.strip())
+
+        super().__init__(msg)
+        self.command = args
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class DeadlineError(Exception):
+    # A step of the switch didn't finish in time: `step` says which one
+
+    def __init__(self, step, timeout):
+        super().__init__("Timed out after %.1fs: %s" % (timeout, step))
+        self.step = step
+
+
+_deadline = None
+
+# Number of commands and their total wall time, per calling function
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def start_deadline(budget):
+    # Every command run from now on gets at most what is left of `budget` seconds.
+    # 0 means no deadline.
+    global _deadline
+    _deadline = time.monotonic() + budget if budget > 0 else None
+
+
+def get_remaining_time():
+    # None if there is no deadline
+    if _deadline is None:
+        return None
+
+    return max(_deadline - time.monotonic(), 0.0)
+
+
+def check_deadline(step):
+    remaining = get_remaining_time()
+
+    if remaining is not None and remaining <= 0:
+        raise DeadlineError(step, 0.0)
+
+
+def get_timeout(timeout):
+    # `timeout`, capped by the remaining time of the deadline
+    remaining = get_remaining_time()
+    return timeout if remaining is None else min(timeout, remaining)
+
+
+def run(args, check=True, capture_output=False, env=None, timeout=envs.COMMAND_TIMEOUT):
+    # Runs the argv list `args`, without a shell, in a new process group which is killed whole
+    # if the command outlives `timeout` or the deadline: scripts may fork.
+    # stderr is always captured for error messages, stdout only with `capture_output`.
+    # With `check`, a failure raises CommandError, else its code is returned
+    # like a shell would: 127 for a missing command.
+    assert isinstance(args, list)
+    step = " ".join(args)
+    caller = _get_caller()
+    timeout = get_timeout(timeout)
+
+    if timeout <= 0:
+        raise DeadlineError(step, 0.0)
+
+    start_time = time.monotonic()
+
+    try:
+        try:
+            process = subprocess.Popen(
+                args, env=env, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+                stderr=subprocess.PIPE, **PROCESS_GROUP_ARGS)
+
+        except OSError as error:
+            if check:
+                raise CommandError(args, None, error.strerror) from error
+
+            return CommandResult(COMMAND_NOT_FOUND_CODE, "", error.strerror)
+
+        with process:
+            try:
+                stdout, stderr = _communicate(process, timeout)
+
+            except subprocess.TimeoutExpired as error:
+                get_logger().error("Killing command after %.1fs: %s", timeout, step)
+                _kill_process_group(process)
+                raise DeadlineError(step, timeout) from error
+
+            except BaseException:
+                # Interrupted, the command must not outlive the hook
+                _kill_process_group(process)
+                raise
+
+    finally:
+        _record_call(caller, time.monotonic() - start_time)
+
+    if check and process.returncode != 0:
+        raise CommandError(args, process.returncode, stderr)
+
+    return CommandResult(process.returncode, stdout, stderr)
+
+
+def get_stats():
+    # {caller: (count, total wall time in seconds)}
+    with _stats_lock:
+        return dict(_stats)
+
+
+def log_stats():
+    logger = get_logger()
+
+    for caller, (count, total_time) in sorted(get_stats().items()):
+        logger.info("Commands run from %s: %d in %.1fms", caller, count, total_time * 1000)
+
+
+def _get_caller():
+    # Example: `optimus_manager.checks:get_integrated_provider`
+    frame = sys._getframe(2)
+    return "%s:%s" % (frame.f_globals.get("__name__"), frame.f_code.co_name)
+
+
+def _record_call(caller, elapsed):
+    # Commands may be run from the threads of a plan
+    with _stats_lock:
+        count, total_time = _stats.get(caller, (0, 0.0))
+        _stats[caller] = (count + 1, total_time + elapsed)
+
+
+def _communicate(process, timeout):
+    # Reads the output pipes until the process exits, which is waited for on a pidfd,
+    # or polled for every `EXIT_POLL_PERIOD` without one.
+    # Unlike `Popen.communicate`, doesn't wait for the pipes to be closed:
+    # they may be held by children a script left running in the background.
+    endtime = time.monotonic() + timeout
+    pipes = [pipe for pipe in [process.stdout, process.stderr] if pipe is not None]
+    chunks = {pipe.fileno(): [] for pipe in pipes}
+    pidfd = _open_pidfd(process.pid)
+
+    try:
+        with selectors.DefaultSelector() as selector:
+            if pidfd is not None:
+                selector.register(pidfd, selectors.EVENT_READ)
+
+            for pipe in pipes:
+                os.set_blocking(pipe.fileno(), False)
+                selector.register(pipe.fileno(), selectors.EVENT_READ)
+
+            exited = False
+
+            while not exited:
+                remaining = endtime - time.monotonic()
+
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(process.args, timeout)
+
+                select_timeout = remaining if pidfd is not None else min(remaining, EXIT_POLL_PERIOD)
+
+                for key, _ in selector.select(select_timeout):
+                    if key.fd == pidfd:
+                        exited = True
+
+                    elif not _read_available(key.fd, chunks[key.fd]):
+                        selector.unregister(key.fd)
+
+                if pidfd is None:
+                    exited = process.poll() is not None
+
+            # What was written right before exiting
+            for fd, fd_chunks in chunks.items():
+                _read_available(fd, fd_chunks)
+
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    process.wait()
+
+    return [
+        b"".join(chunks[pipe.fileno()]).decode(errors="replace") if pipe is not None else ""
+        for pipe in [process.stdout, process.stderr]
+    ]
+
+
+def _open_pidfd(pid):
+    # None where pidfds are unavailable: Python < 3.9 or Linux < 5.3
+    try:
+        return os.pidfd_open(pid)
+
+    except (AttributeError, OSError):
+        return None
+
+
+def _read_available(fd, fd_chunks):
+    # False once the pipe is closed
+    while True:
+        try:
+            data = os.read(fd, PIPE_READ_SIZE)
+
+        except BlockingIOError:
+            return True
+
+        if not data:
+            return False
+
+        fd_chunks.append(data)
+
+
+def _kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+
+    except ProcessLookupError:
+        pass
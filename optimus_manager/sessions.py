@@ -1,5 +1,5 @@
 import dbus
-from subprocess import CalledProcessError, check_call
+from . import runner
 from .log_utils import get_logger
 
 
@@ -46,22 +46,19 @@ def logout_current_desktop_session():
             except dbus.exceptions.DBusException:
                 pass
 
-    for cmd in [
-        "awesome-client \"awesome.quit()\"",  # AwesomeWM
-        "bspc quit",  # bspwm
-        "pkill -SIGTERM -f dwm",  # dwm
-        "herbstclient quit",  # herbstluftwm
-        "i3-msg exit",  # i3
-        "pkill -SIGTERM -f lightdm" # lightdm
-        "pkill -SIGTERM -f lxsession",  # LXDE
-        "openbox --exit",  # Openbox
-        "qtile cmd-obj -o cmd -f shutdown",  # qtile
-        "pkill -SIGTERM -f xmonad",  # Xmonad
+    for args in [
+        ["awesome-client", "awesome.quit()"],  # AwesomeWM
+        ["bspc", "quit"],  # bspwm
+        ["pkill", "-SIGTERM", "-f", "dwm"],  # dwm
+        ["herbstclient", "quit"],  # herbstluftwm
+        ["i3-msg", "exit"],  # i3
+        ["pkill", "-SIGTERM", "-f", "lightdm"],  # lightdm
+        ["pkill", "-SIGTERM", "-f", "lxsession"],  # LXDE
+        ["openbox", "--exit"],  # Openbox
+        ["qtile", "cmd-obj", "-o", "cmd", "-f", "shutdown"],  # qtile
+        ["pkill", "-SIGTERM", "-f", "xmonad"],  # Xmonad
     ]:
-        try:
-            check_call(cmd, shell=True)
-        except CalledProcessError:
-            pass
+        runner.run(args, check=False)
 
 
 def get_number_of_desktop_sessions(ignore_gdm=True):
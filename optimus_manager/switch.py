@@ -0,0 +1,36 @@
+from . import envs
+from .config import load_extra_xorg_options
+from .kernel import plan_kernel_setup
+from .plan import ResultOf, make_operation
+from .xorg import render_xorg_conf, write_xorg_conf
+
+# Kernel operations after which the GPUs bus IDs may have changed
+BUS_CHANGING_KINDS = ["pci_rescan", "pci_remove", "pci_reset"]
+
+
+def compile_switch_plan(config, topology, current_mode, requested_mode, setup_kernel=True):
+    # Every operation of a switch, decided upfront from the actual state of the machine,
+    # so that it can be shown with `--dry-run` before being run by the Xorg pre-start hook.
+    # The kernel operations run in order, the Xorg conf is prepared alongside them.
+    plan = []
+
+    if setup_kernel:
+        plan += plan_kernel_setup(config, topology, current_mode, requested_mode)
+
+    bus_changes = [operation for operation in plan if operation.kind in BUS_CHANGING_KINDS]
+
+    read_bus_ids = make_operation(
+        "pci_enumerate", "GPUs bus IDs", topology.get_gpus_bus_ids, requires=bus_changes)
+
+    load_extra = make_operation(
+        "file_read", "Extra Xorg options", load_extra_xorg_options, requires=[])
+
+    render = make_operation(
+        "xorg_conf_render", f"Xorg conf for {requested_mode} mode", render_xorg_conf,
+        config, ResultOf(read_bus_ids), ResultOf(load_extra), requested_mode, requires=[])
+
+    write = make_operation(
+        "xorg_conf_write", envs.XORG_CONF_PATH, write_xorg_conf, ResultOf(render), requires=[])
+
+    return plan + [read_bus_ids, load_extra, render, write]
+
@@ -0,0 +1,243 @@
+import errno
+import os
+import select
+import socket
+import struct
+import time
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from .log_utils import get_logger
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 16384
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CREATE = 0x100
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+
+# struct inotify_event, followed by `len` bytes of NUL-padded name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def open_device_monitor(watch_path):
+    # Must be opened before triggering the change to wait for, so that no event is missed.
+    # Falls back from kernel uevents to inotify on `watch_path`, then to plain polling.
+    logger = get_logger()
+
+    try:
+        return UeventMonitor()
+
+    except OSError as error:
+        logger.info("Kernel uevents unavailable: %s: Falling back to inotify", str(error))
+
+    try:
+        return InotifyMonitor(watch_path)
+
+    except OSError as error:
+        logger.info("inotify unavailable: %s: Falling back to polling", str(error))
+
+    return PollingMonitor()
+
+
+class UeventMonitor:
+    # Kernel uevents, as received by udev
+
+    def __init__(self):
+        self._socket = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC, NETLINK_KOBJECT_UEVENT)
+
+        try:
+            self._socket.bind((0, UEVENT_KERNEL_GROUP))
+
+        except OSError:
+            self._socket.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._socket.close()
+
+    def wait(self, timeout):
+        # Returns the events received within `timeout`, as dicts of the uevent keys
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+
+        if not readable:
+            return []
+
+        events = []
+
+        while True:
+            try:
+                datagram = self._socket.recv(UEVENT_BUFFER_SIZE, socket.MSG_DONTWAIT)
+
+            except BlockingIOError:
+                break
+
+            except OSError as error:
+                if error.errno != errno.ENOBUFS:
+                    raise
+
+                # The socket buffer overflowed and events were dropped:
+                # like with inotify, the caller has to look at the bus again
+                get_logger().info("Kernel uevents lost: Socket buffer full")
+                events.append({"ACTION": "add"})
+                continue
+
+            events.append(parse_uevent(datagram))
+
+        return events
+
+
+class InotifyMonitor:
+    # Directory entries created in `watch_path`
+
+    def __init__(self, watch_path):
+        libc = CDLL(find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self._fd < 0:
+            raise OSError(get_errno(), os.strerror(get_errno()))
+
+        if libc.inotify_add_watch(self._fd, os.fsencode(watch_path), IN_CREATE) < 0:
+            errno = get_errno()
+            os.close(self._fd)
+            raise OSError(errno, os.strerror(errno))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        os.close(self._fd)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+
+        if not readable:
+            return []
+
+        try:
+            os.read(self._fd, UEVENT_BUFFER_SIZE)
+
+        except BlockingIOError:
+            return []
+
+        # inotify doesn't say what was created: the caller has to look
+        return [{"ACTION": "add"}]
+
+
+class FileWatcher:
+    # Changes to the files in `file_paths`, written in place or replaced.
+    # Their folders are watched rather than the files, which may not exist yet.
+
+    def __init__(self, file_paths):
+        libc = CDLL(find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        self._names_by_wd = {}
+
+        if self._fd < 0:
+            raise OSError(get_errno(), os.strerror(get_errno()))
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        folders = {}
+
+        for file_path in file_paths:
+            folder, name = os.path.split(os.path.abspath(file_path))
+            folders.setdefault(folder, set()).add(name)
+
+        for folder, names in folders.items():
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(folder), mask)
+
+            if wd < 0:
+                errno = get_errno()
+                os.close(self._fd)
+                raise OSError(errno, "%s: %s" % (os.strerror(errno), folder))
+
+            self._names_by_wd[wd] = (folder, names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        os.close(self._fd)
+
+    def fileno(self):
+        # Readable when there are changes to read
+        return self._fd
+
+    def read_changes(self):
+        # Paths of the watched files changed since the last call
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self._fd, UEVENT_BUFFER_SIZE)
+
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                wd, _, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+
+                if wd in self._names_by_wd:
+                    folder, names = self._names_by_wd[wd]
+
+                    if name in names:
+                        changed.add(os.path.join(folder, name))
+
+        return changed
+
+
+class PollingMonitor:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return []
+
+
+def parse_uevent(datagram):
+    # Example: b"add@/devices/pci0000:00/0000:00:01.0/0000:01:00.0\0ACTION=add\0SUBSYSTEM=pci\0..."
+    fields = datagram.split(b"\0")
+    event = {}
+
+    for field in fields[1:]:
+        key, sep, value = field.decode("utf-8", errors="replace").partition("=")
+
+        if sep:
+            event[key] = value
+
+    if "ACTION" not in event and b"@" in fields[0]:
+        action, _, devpath = fields[0].decode("utf-8", errors="replace").partition("@")
+        event["ACTION"] = action
+        event["DEVPATH"] = devpath
+
+    return event
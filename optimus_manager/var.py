@@ -6,6 +6,10 @@ from pathlib import Path
 from . import envs
 from .log_utils import get_logger
 
+# Files modified this recently may be modified again within the same mtime tick,
+# with the same size: what is derived from them isn't cached
+RACY_DELAY_NS = 2 * 10**9
+
 
 class VarError(Exception):
     pass
@@ -71,6 +75,145 @@ def read_acpi_call_strings():
         raise VarError("Unable to read: %s" % str(filepath)) from error
 
 
+def write_module_index_cache(cache):
+    filepath = Path(envs.MODULE_INDEX_CACHE_PATH)
+
+    try:
+        os.makedirs(filepath.parent, exist_ok=True)
+
+        with open(filepath, 'w') as writefile:
+            json.dump(cache, writefile)
+
+    except IOError as error:
+        raise VarError("Unable to write to: %s" % str(filepath)) from error
+
+
+def read_module_index_cache():
+    filepath = Path(envs.MODULE_INDEX_CACHE_PATH)
+
+    try:
+        with open(filepath, 'r') as readfile:
+            return json.load(readfile)
+
+    except FileNotFoundError as error:
+        raise VarError("File doesn't exist: %s" % str(filepath)) from error
+
+    except (IOError, json.decoder.JSONDecodeError) as error:
+        raise VarError("Unable to read: %s" % str(filepath)) from error
+
+
+def write_acpi_candidates_cache(cache):
+    filepath = Path(envs.ACPI_CANDIDATES_CACHE_PATH)
+
+    try:
+        os.makedirs(filepath.parent, exist_ok=True)
+
+        with open(filepath, 'w') as writefile:
+            json.dump(cache, writefile)
+
+    except IOError as error:
+        raise VarError("Unable to write to: %s" % str(filepath)) from error
+
+
+def read_acpi_candidates_cache():
+    filepath = Path(envs.ACPI_CANDIDATES_CACHE_PATH)
+
+    try:
+        with open(filepath, 'r') as readfile:
+            return json.load(readfile)
+
+    except FileNotFoundError as error:
+        raise VarError("File doesn't exist: %s" % str(filepath)) from error
+
+    except (IOError, json.decoder.JSONDecodeError) as error:
+        raise VarError("Unable to read: %s" % str(filepath)) from error
+
+
+def write_operation_latencies(latencies):
+    filepath = Path(envs.OPERATION_LATENCIES_PATH)
+
+    try:
+        os.makedirs(filepath.parent, exist_ok=True)
+
+        with open(filepath, 'w') as writefile:
+            json.dump(latencies, writefile)
+
+    except IOError as error:
+        raise VarError("Unable to write to: %s" % str(filepath)) from error
+
+
+def read_operation_latencies():
+    filepath = Path(envs.OPERATION_LATENCIES_PATH)
+
+    try:
+        with open(filepath, 'r') as readfile:
+            return json.load(readfile)
+
+    except FileNotFoundError as error:
+        raise VarError("File doesn't exist: %s" % str(filepath)) from error
+
+    except (IOError, json.decoder.JSONDecodeError) as error:
+        raise VarError("Unable to read: %s" % str(filepath)) from error
+
+
+def write_host_facts(host_facts):
+    filepath = Path(envs.HOST_FACTS_PATH)
+
+    try:
+        os.makedirs(filepath.parent, exist_ok=True)
+
+        with open(filepath, 'w') as writefile:
+            json.dump(host_facts, writefile)
+
+    except IOError as error:
+        raise VarError("Unable to write to: %s" % str(filepath)) from error
+
+
+def read_host_facts():
+    filepath = Path(envs.HOST_FACTS_PATH)
+
+    try:
+        with open(filepath, 'r') as readfile:
+            return json.load(readfile)
+
+    except FileNotFoundError as error:
+        raise VarError("File doesn't exist: %s" % str(filepath)) from error
+
+    except (IOError, json.decoder.JSONDecodeError) as error:
+        raise VarError("Unable to read: %s" % str(filepath)) from error
+
+
+def write_compiled_config(compiled_config):
+    # Replaced in one go: the hooks and clients may read it while another process writes it
+    filepath = Path(envs.COMPILED_CONFIG_PATH)
+    temp_filepath = filepath.with_name("%s.%d.tmp" % (filepath.name, os.getpid()))
+
+    try:
+        os.makedirs(filepath.parent, exist_ok=True)
+
+        with open(temp_filepath, 'w') as writefile:
+            json.dump(compiled_config, writefile, separators=(",", ":"))
+
+        os.replace(temp_filepath, filepath)
+
+    except IOError as error:
+        raise VarError("Unable to write to: %s" % str(filepath)) from error
+
+
+def read_compiled_config():
+    filepath = Path(envs.COMPILED_CONFIG_PATH)
+
+    try:
+        with open(filepath, 'r') as readfile:
+            return json.load(readfile)
+
+    except FileNotFoundError as error:
+        raise VarError("File doesn't exist: %s" % str(filepath)) from error
+
+    except (IOError, json.decoder.JSONDecodeError) as error:
+        raise VarError("Unable to read: %s" % str(filepath)) from error
+
+
 def write_last_acpi_call_state(state):
     filepath = Path(envs.LAST_ACPI_CALL_STATE_VAR)
     os.makedirs(filepath.parent, exist_ok=True)
@@ -123,20 +266,29 @@ def load_daemon_run_id():
 
 
 def write_state(state):
+    # Replaced in one go, so that readers never see a partial state.
+    # The daemon and the hooks may write it at the same time: each from its own temp file.
+    # Returns the file key of what was written, see `get_state_file_key`.
     logger = get_logger()
     logger.info("Writing state: %s", str(state))
     filepath = Path(envs.STATE_FILE_PATH)
+    temp_filepath = filepath.with_name("%s.%d.tmp" % (filepath.name, os.getpid()))
     os.makedirs(filepath.parent, exist_ok=True)
 
-    with open(filepath, "w") as writefile:
+    with open(temp_filepath, "w") as writefile:
         json.dump(state, writefile)
 
     try:
-        os.chmod(filepath, mode=0o666)
+        os.chmod(temp_filepath, mode=0o666)
 
     except PermissionError:
         pass
 
+    # Kept by the rename, unlike a key taken after it, which another writer may have replaced
+    file_key = _get_state_file_key(os.stat(temp_filepath))
+    os.replace(temp_filepath, filepath)
+    return file_key
+
 
 def load_state():
     try:
@@ -147,5 +299,68 @@ def load_state():
         return None
 
 
+def get_state_file_key():
+    # Changes whenever the state file is replaced: None if it doesn't exist
+    try:
+        stat = os.stat(envs.STATE_FILE_PATH)
+
+    except FileNotFoundError:
+        return None
+
+    return _get_state_file_key(stat)
+
+
+def _get_state_file_key(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def get_files_key(paths):
+    # Changes whenever one of the files does, or is created or removed
+    key = []
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+
+        except FileNotFoundError:
+            key.append([path, None, None, None])
+            continue
+
+        key.append([path, stat.st_size, stat.st_mtime_ns, stat.st_ino])
+
+    return key
+
+
+def is_files_key_racy(files_key):
+    now = time.time_ns()
+
+    return any(
+        mtime_ns is not None and now - mtime_ns < RACY_DELAY_NS
+        for _, _, mtime_ns, _ in files_key)
+
+
+def get_status(state):
+    # What the client shows along with `state`
+    try:
+        temp_config_path = read_temp_conf_path_var()
+
+    except VarError:
+        temp_config_path = None
+
+    return {
+        "state": state,
+        "next_mode": get_next_mode(state),
+        "temp_config_path": temp_config_path
+    }
+
+
+def get_next_mode(state):
+    # None if the next login keeps the current mode
+    if state is not None and state["type"] == "pending_pre_xorg_start":
+        return state["requested_mode"]
+
+    return None
+
+
 def cleanup_tmp_vars():
     shutil.rmtree(envs.TMP_VARS_FOLDER_PATH, ignore_errors=True)
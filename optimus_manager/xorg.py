@@ -1,30 +1,51 @@
+import hashlib
 import os
-import subprocess
 import optimus_manager.checks as checks
 import optimus_manager.envs as envs
+import optimus_manager.runner as runner
+from collections import namedtuple
 from pathlib import Path
 from .config import load_extra_xorg_options
 from .log_utils import get_logger
-from .pci import get_gpus_bus_ids
+
+NVIDIA_MODULE_PATHS = [
+    "/usr/lib/nvidia",
+    "/usr/lib32/nvidia",
+    "/usr/lib32/nvidia/xorg/modules",
+    "/usr/lib32/xorg/modules",
+    "/usr/lib64/nvidia/xorg/modules",
+    "/usr/lib64/nvidia/xorg",
+    "/usr/lib64/xorg/modules"
+]
+
+# `entries` are tuples like ("Option", "DRI", "3"), rendered `Option "DRI" "3"` (ints aren't quoted),
+# or lines of the extra options files
+XorgSection = namedtuple("XorgSection", ["name", "entries"])
 
 
 class XorgSetupError(Exception):
     pass
 
 
-def configure_xorg(config, requested_gpu_mode):
-    bus_ids = get_gpus_bus_ids()
-    xorg_extra = load_extra_xorg_options()
+def configure_xorg(config, topology, requested_gpu_mode):
+    xorg_conf_text = render_xorg_conf(
+        config, topology.get_gpus_bus_ids(), load_extra_xorg_options(), requested_gpu_mode)
+
+    write_xorg_conf(xorg_conf_text)
 
+
+def render_xorg_conf(config, bus_ids, xorg_extra, requested_gpu_mode):
     if requested_gpu_mode == "nvidia" or not ("intel" in bus_ids or "amd" in bus_ids):
-        xorg_conf_text = _generate_nvidia(config, bus_ids, xorg_extra)
+        return _generate_nvidia(config, bus_ids, xorg_extra)
 
     elif requested_gpu_mode == "integrated":
-        xorg_conf_text = _generate_integrated(config, bus_ids, xorg_extra)
+        return _generate_integrated(config, bus_ids, xorg_extra)
 
     elif requested_gpu_mode == "hybrid":
-        xorg_conf_text = _generate_hybrid(config, bus_ids, xorg_extra)
+        return _generate_hybrid(config, bus_ids, xorg_extra)
+
 
+def write_xorg_conf(xorg_conf_text):
     _remove_conflicting_confs()
     _write_xorg_conf(xorg_conf_text)
 
@@ -34,16 +55,11 @@ def cleanup_xorg_conf():
 
 
 def is_xorg_running():
-    return any([
-        subprocess.run(
-            f"pidof {name}", shell=True, stdout=subprocess.DEVNULL
-        ).returncode == 0
-
-        for name in ["X", "Xorg"]
-    ])
+    # `pidof` succeeds if any of the programs runs
+    return runner.run(["pidof", "X", "Xorg"], check=False).returncode == 0
 
 
-def do_xsetup(requested_mode):
+def do_xsetup(topology, requested_mode):
     logger = get_logger()
 
     if requested_mode == "nvidia":
@@ -51,48 +67,40 @@ def do_xsetup(requested_mode):
         logger.info("Running xrandr commands")
 
         try:
-            for cmd in [
-                (f"xrandr --setprovideroutputsource \"{provider}\" NVIDIA-0"),
-                "xrandr --auto"
+            for args in [
+                ["xrandr", "--setprovideroutputsource", provider, "NVIDIA-0"],
+                ["xrandr", "--auto"]
             ]:
-                subprocess.check_call(
-                    cmd, shell=True, text=True, stderr=subprocess.PIPE,
-                    stdout=subprocess.DEVNULL)
+                runner.run(args)
 
-        except subprocess.CalledProcessError as error:
+        except runner.CommandError as error:
             logger.error(f"Unable to setup Prime: xrandr error: {error.stderr}")
 
-    script_path = _get_xsetup_script_path(requested_mode)
+    script_path = _get_xsetup_script_path(topology.get_gpus_bus_ids(), requested_mode)
     logger.info("Running script: %s", script_path)
 
     try:
-        subprocess.check_call(
-            script_path, text=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        runner.run([script_path])
 
-    except subprocess.CalledProcessError as e:
+    except runner.CommandError as e:
         logger.error(f"Unable to run script: {script_path}: {e.stderr}")
 
 
 def set_DPI(config):
     logger = get_logger()
-    dpi_str = config["nvidia"]["dpi"]
+    dpi = config.nvidia.dpi
 
-    if dpi_str == "":
+    if dpi is None:
         return
 
     try:
-        subprocess.check_call(
-            f"xrandr --dpi {dpi_str}", shell=True, text=True,
-            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        runner.run(["xrandr", "--dpi", str(dpi)])
 
-    except subprocess.CalledProcessError as error:
+    except runner.CommandError as error:
         logger.error(f"Unable to set DPI: xrandr error: {error.stderr}")
 
 
-def _get_xsetup_script_path(requested_mode):
-    logger = get_logger()
-    bus_ids = get_gpus_bus_ids()
-
+def _get_xsetup_script_path(bus_ids, requested_mode):
     if requested_mode == "nvidia" or not ("intel" in bus_ids or "amd" in bus_ids):
         script_name = "nvidia"
 
@@ -117,7 +125,7 @@ def _generate_nvidia(config, bus_ids, xorg_extra):
     integrated_gpu = "intel" if "intel" in bus_ids else "amd"
     driver = "modesetting"
 
-    if config[integrated_gpu]["driver"] != "modesetting" and config[integrated_gpu]["driver"] != "hybrid":
+    if getattr(config, integrated_gpu).driver not in ["modesetting", "hybrid"]:
 
         if "intel" in bus_ids and checks.is_xorg_intel_module_available():
             driver = "intel"
@@ -130,227 +138,174 @@ def _generate_nvidia(config, bus_ids, xorg_extra):
 
     xorg_extra_nvidia = xorg_extra["nvidia-mode"]["nvidia-gpu"]
     xorg_extra_integrated = xorg_extra["nvidia-mode"]["integrated-gpu"]
-    text = _make_modules_paths_section()
-
-    text += "Section \"ServerLayout\"\n" \
-            "\tIdentifier \"layout\"\n" \
-            "\tScreen 0 \"nvidia\"\n" \
-            "\tInactive \"integrated\"\n" \
-            "EndSection\n\n"
-
-    text += _make_nvidia_device_section(config, bus_ids, xorg_extra_nvidia)
-
-    text += "Section \"Screen\"\n" \
-            "\tIdentifier \"nvidia\"\n" \
-            "\tDevice \"nvidia\"\n" \
-            "\tOption \"AllowEmptyInitialConfiguration\"\n"
 
-    if config["nvidia"]["allow_external_gpus"] == "yes":
-        text += "\tOption \"AllowExternalGpus\"\n"
+    nvidia_screen = [("Identifier", "nvidia"), ("Device", "nvidia"), ("Option", "AllowEmptyInitialConfiguration")]
 
-    text += "EndSection\n\n"
+    if config.nvidia.allow_external_gpus:
+        nvidia_screen.append(("Option", "AllowExternalGpus"))
 
-    text += "Section \"Device\"\n" \
-            "\tIdentifier \"integrated\"\n" \
-            "\tDriver \"%s\"\n" % driver
+    integrated_device = [("Identifier", "integrated"), ("Driver", driver)]
 
     if driver == "modesetting":
-        text += "\tOption \"AccelMethod\" \"none\"\n"
-
-    text += "\tBusID \"%s\"\n" % bus_ids[integrated_gpu]
-
-    for line in xorg_extra_integrated:
-        text += ("\t" + line + "\n")
-
-    text += "EndSection\n\n"
-
-    text += "Section \"Screen\"\n" \
-            "\tIdentifier \"integrated\"\n" \
-            "\tDevice \"integrated\"\n" \
-            "EndSection\n\n"
-
-    text += _make_server_flags_section(config)
-    return text
+        integrated_device.append(("Option", "AccelMethod", "none"))
+
+    integrated_device.append(("BusID", bus_ids[integrated_gpu]))
+    integrated_device += xorg_extra_integrated
+
+    return render_sections([
+        _make_modules_paths_section(),
+        XorgSection("ServerLayout", [
+            ("Identifier", "layout"), ("Screen", 0, "nvidia"), ("Inactive", "integrated")]),
+        _make_nvidia_device_section(config, bus_ids, xorg_extra_nvidia),
+        XorgSection("Screen", nvidia_screen),
+        XorgSection("Device", integrated_device),
+        XorgSection("Screen", [("Identifier", "integrated"), ("Device", "integrated")]),
+        _make_server_flags_section(config)
+    ])
 
 
 def _generate_integrated(config, bus_ids, xorg_extra):
     xorg_extra_lines = xorg_extra["integrated-mode"]["integrated-gpu"]
 
-    text = "Section \"ServerLayout\"\n" \
-            "\tIdentifier \"layout\"\n" \
-            "\tScreen 0 \"integrated\"\n" \
-            "EndSection\n\n"
-
-    text += "Section \"Monitor\"\n" \
-            "\tIdentifier \"monitor0\"\n" \
-            "EndSection\n\n"
-
     if "intel" in bus_ids:
-        text += _make_intel_device_section(config, bus_ids, xorg_extra_lines)
+        integrated_device = _make_intel_device_section(config, bus_ids, xorg_extra_lines)
 
     else:
-        text += _make_amd_device_section(config, bus_ids, xorg_extra_lines)
-
-    text += "Section \"Screen\"\n" \
-            "\tIdentifier \"integrated\"\n" \
-            "\tDevice \"integrated\"\n" \
-            "\tMonitor \"monitor0\"\n" \
-            "EndSection\n\n"
+        integrated_device = _make_amd_device_section(config, bus_ids, xorg_extra_lines)
 
-    return text
+    return render_sections([
+        XorgSection("ServerLayout", [("Identifier", "layout"), ("Screen", 0, "integrated")]),
+        XorgSection("Monitor", [("Identifier", "monitor0")]),
+        integrated_device,
+        XorgSection("Screen", [("Identifier", "integrated"), ("Device", "integrated"), ("Monitor", "monitor0")])
+    ])
 
 
 def _generate_hybrid(config, bus_ids, xorg_extra):
     xorg_extra_lines_integrated = xorg_extra["hybrid-mode"]["integrated-gpu"]
     xorg_extra_lines_nvidia = xorg_extra["hybrid-mode"]["nvidia-gpu"]
-    text = _make_modules_paths_section()
-
-    text += "Section \"ServerLayout\"\n" \
-           "\tIdentifier \"layout\"\n" \
-           "\tScreen 0 \"integrated\"\n" \
-           "\tInactive \"nvidia\"\n" \
-           "\tOption \"AllowNVIDIAGPUScreens\"\n" \
-           "EndSection\n\n"
 
     if "intel" in bus_ids:
-        text += _make_intel_device_section(config, bus_ids, xorg_extra_lines_integrated)
+        integrated_device = _make_intel_device_section(config, bus_ids, xorg_extra_lines_integrated)
 
     else:
-        text += _make_amd_device_section(config, bus_ids, xorg_extra_lines_integrated)
+        integrated_device = _make_amd_device_section(config, bus_ids, xorg_extra_lines_integrated)
+
+    integrated_screen = [("Identifier", "integrated"), ("Device", "integrated")]
+
+    if config.nvidia.allow_external_gpus:
+        integrated_screen.append(("Option", "AllowExternalGpus"))
+
+    return render_sections([
+        _make_modules_paths_section(),
+        XorgSection("ServerLayout", [
+            ("Identifier", "layout"), ("Screen", 0, "integrated"), ("Inactive", "nvidia"),
+            ("Option", "AllowNVIDIAGPUScreens")]),
+        integrated_device,
+        XorgSection("Screen", integrated_screen),
+        _make_nvidia_device_section(config, bus_ids, xorg_extra_lines_nvidia),
+        XorgSection("Screen", [("Identifier", "nvidia"), ("Device", "nvidia")]),
+        _make_server_flags_section(config)
+    ])
 
-    text += "Section \"Screen\"\n" \
-           "\tIdentifier \"integrated\"\n" \
-           "\tDevice \"integrated\"\n"
 
-    if config["nvidia"]["allow_external_gpus"] == "yes":
-        text += "\tOption \"AllowExternalGpus\"\n"
+def render_sections(sections):
+    # In one join: None sections are left out
+    lines = []
 
-    text += "EndSection\n\n"
-    text += _make_nvidia_device_section(config, bus_ids, xorg_extra_lines_nvidia)
+    for section in sections:
+        if section is None:
+            continue
 
-    text += "Section \"Screen\"\n" \
-           "\tIdentifier \"nvidia\"\n" \
-           "\tDevice \"nvidia\"\n" \
-           "EndSection\n\n"
+        lines.append("Section \"%s\"\n" % section.name)
+        lines += ["\t%s\n" % _render_entry(entry) for entry in section.entries]
+        lines.append("EndSection\n\n")
 
-    text += _make_server_flags_section(config)
-    return text
+    return "".join(lines)
 
 
-def _make_modules_paths_section():
-    return "Section \"Files\"\n" \
-           "\tModulePath \"/usr/lib/nvidia\"\n" \
-           "\tModulePath \"/usr/lib32/nvidia\"\n" \
-           "\tModulePath \"/usr/lib32/nvidia/xorg/modules\"\n" \
-           "\tModulePath \"/usr/lib32/xorg/modules\"\n" \
-           "\tModulePath \"/usr/lib64/nvidia/xorg/modules\"\n" \
-           "\tModulePath \"/usr/lib64/nvidia/xorg\"\n" \
-           "\tModulePath \"/usr/lib64/xorg/modules\"\n" \
-           "EndSection\n\n"
+def _render_entry(entry):
+    # Strings are lines from the extra options files, kept as they are
+    if isinstance(entry, str):
+        return entry
 
+    keyword, *values = entry
+    return " ".join([keyword] + [str(value) if isinstance(value, int) else "\"%s\"" % value for value in values])
 
-def _make_nvidia_device_section(config, bus_ids, xorg_extra_lines):
-    options = config["nvidia"]["options"].replace(" ", "").split(",")
 
-    text = "Section \"Device\"\n" \
-           "\tIdentifier \"nvidia\"\n" \
-           "\tDriver \"nvidia\"\n"
+def _make_modules_paths_section():
+    return XorgSection("Files", [("ModulePath", path) for path in NVIDIA_MODULE_PATHS])
+
 
-    text += "\tBusID \"%s\"\n" % bus_ids["nvidia"]
+def _make_nvidia_device_section(config, bus_ids, xorg_extra_lines):
+    options = config.nvidia.options
+    entries = [("Identifier", "nvidia"), ("Driver", "nvidia"), ("BusID", bus_ids["nvidia"])]
 
     if "overclocking" in options:
-        text += "\tOption \"Coolbits\" \"28\"\n"
+        entries.append(("Option", "Coolbits", "28"))
 
     if "triple_buffer" in options:
-        text += "\tOption \"TripleBuffer\" \"true\"\n"
-
-    for line in xorg_extra_lines:
-        text += ("\t" + line + "\n")
+        entries.append(("Option", "TripleBuffer", "true"))
 
-    text += "EndSection\n\n"
-    return text
+    return XorgSection("Device", entries + xorg_extra_lines)
 
 
 def _make_intel_device_section(config, bus_ids, xorg_extra_lines):
     logger = get_logger()
 
-    if config["intel"]["driver"] == "intel" and not checks.is_xorg_intel_module_available():
+    if config.intel.driver == "intel" and not checks.is_xorg_intel_module_available():
         logger.warning("The Xorg module intel is not available. Defaulting to modesetting.")
         driver = "modesetting"
 
-    elif config["intel"]["driver"] == "hybrid":
+    elif config.intel.driver == "hybrid":
         driver = "intel"
 
     else:
-        driver = config["intel"]["driver"]
+        driver = config.intel.driver
 
-    dri = int(config["intel"]["dri"])
-    text = "Section \"Device\"\n" \
-           "\tIdentifier \"integrated\"\n"
-    text += "\tDriver \"%s\"\n" % driver
-    text += "\tBusID \"%s\"\n" % bus_ids["intel"]
+    entries = [("Identifier", "integrated"), ("Driver", driver), ("BusID", bus_ids["intel"])]
 
-    if config["intel"]["accel"] != "":
-        text += "\tOption \"AccelMethod\" \"%s\"\n" % config["intel"]["accel"]
+    if config.intel.accel is not None:
+        entries.append(("Option", "AccelMethod", config.intel.accel))
 
-    if config["intel"]["tearfree"] != "":
-        tearfree_enabled_str = {"yes": "true", "no": "false"}[config["intel"]["tearfree"]]
-        text += "\tOption \"TearFree\" \"%s\"\n" % tearfree_enabled_str
+    if config.intel.tearfree is not None:
+        entries.append(("Option", "TearFree", "true" if config.intel.tearfree else "false"))
 
-    if dri != 0:
-        text += "\tOption \"DRI\" \"%d\"\n" % dri
+    if config.intel.dri != 0:
+        entries.append(("Option", "DRI", str(config.intel.dri)))
 
-    for line in xorg_extra_lines:
-        text += ("\t" + line + "\n")
-
-    text += "EndSection\n\n"
-    return text
+    return XorgSection("Device", entries + xorg_extra_lines)
 
 
 def _make_amd_device_section(config, bus_ids, xorg_extra_lines):
     logger = get_logger()
 
-    if config["amd"]["driver"] == "amdgpu" and not checks.is_xorg_amdgpu_module_available():
+    if config.amd.driver == "amdgpu" and not checks.is_xorg_amdgpu_module_available():
         logger.warning("The Xorg module amdgpu is not available. Defaulting to modesetting.")
         driver = "modesetting"
 
-    elif config["amd"]["driver"] == "hybrid":
+    elif config.amd.driver == "hybrid":
         driver = "amdgpu"
 
     else:
-        driver = config["amd"]["driver"]
-
-    dri = int(config["amd"]["dri"])
-
-    text = "Section \"Device\"\n" \
-           "\tIdentifier \"integrated\"\n"
+        driver = config.amd.driver
 
-    text += "\tDriver \"%s\"\n" % driver
-    text += "\tBusID \"%s\"\n" % bus_ids["amd"]
+    entries = [("Identifier", "integrated"), ("Driver", driver), ("BusID", bus_ids["amd"])]
 
-    if config["amd"]["tearfree"] != "":
-        tearfree_enabled_str = {"yes": "true", "no": "false"}[config["amd"]["tearfree"]]
-        text += "\tOption \"TearFree\" \"%s\"\n" % tearfree_enabled_str
+    if config.amd.tearfree is not None:
+        entries.append(("Option", "TearFree", "true" if config.amd.tearfree else "false"))
 
-    if dri != 0:
-        text += "\tOption \"DRI\" \"%d\"\n" % dri
+    if config.amd.dri != 0:
+        entries.append(("Option", "DRI", str(config.amd.dri)))
 
-    for line in xorg_extra_lines:
-        text += ("\t" + line + "\n")
-
-    text += "EndSection\n\n"
-    return text
+    return XorgSection("Device", entries + xorg_extra_lines)
 
 
 def _make_server_flags_section(config):
-    if config["nvidia"]["ignore_abi"] == "yes":
-        return (
-            "Section \"ServerFlags\"\n"
-            "\tOption \"IgnoreABI\" \"1\"\n"
-            "EndSection\n\n"
-        )
+    if config.nvidia.ignore_abi:
+        return XorgSection("ServerFlags", [("Option", "IgnoreABI", "1")])
 
-    return ""
+    return None
 
 
 def _remove_conf(conf):
@@ -367,15 +322,52 @@ def _remove_conflicting_confs():
 
 
 def _write_xorg_conf(xorg_conf_text):
+    # Left alone if it already has this content, else replaced in one go:
+    # X never reads a half-written conf
     logger = get_logger()
     filepath = Path(envs.XORG_CONF_PATH)
+    data = xorg_conf_text.encode('utf-8')
+
+    if _get_file_hash(filepath) == hashlib.sha256(data).digest():
+        logger.info("Xorg conf unchanged: %s", envs.XORG_CONF_PATH)
+        return
+
+    temp_filepath = filepath.with_name(".%s.tmp" % filepath.name)
 
     try:
         os.makedirs(filepath.parent, mode=0o755, exist_ok=True)
+        logger.info("Writing Xorg conf: %s", envs.XORG_CONF_PATH)
+
+        with open(temp_filepath, 'wb') as writefile:
+            writefile.write(data)
+            writefile.flush()
+            os.fsync(writefile.fileno())
 
-        with open(filepath, 'w') as writefile:
-            logger.info("Writing Xorg conf: %s", envs.XORG_CONF_PATH)
-            writefile.write(xorg_conf_text)
+        os.chmod(temp_filepath, 0o644)
+        os.replace(temp_filepath, filepath)
+        _fsync_folder(filepath.parent)
 
     except IOError as error:
+        _remove_conf(temp_filepath)
         raise XorgSetupError("Unable to write Xorg conf: %s" % str(filepath)) from error
+
+
+def _get_file_hash(filepath):
+    # None if it can't be read
+    try:
+        with open(filepath, 'rb') as readfile:
+            return hashlib.sha256(readfile.read()).digest()
+
+    except IOError:
+        return None
+
+
+def _fsync_folder(folder_path):
+    # So that the rename itself survives a crash
+    fd = os.open(folder_path, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
@@ -14,7 +14,7 @@ setup(
     author='Robin Lange',
     author_email='robin.langenc@gmail.com',
     license='MIT',
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests", "tests.*"]),
     entry_points={
         'console_scripts': [
             'optimus-manager=optimus_manager.client:main',
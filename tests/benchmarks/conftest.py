@@ -0,0 +1,57 @@
+import time
+from collections import namedtuple
+import pytest
+
+# Benchmarks run with the tests, on the same fake trees, with sizes kept small enough
+# for that. Their timings are printed after the tests:
+# `python -m pytest tests/benchmarks -q` prints only them.
+
+Timing = namedtuple("Timing", ["name", "rounds", "median", "p99"])
+
+_timings = []
+
+
+class Benchmark:
+    # `benchmark(func, rounds)` calls `func` `rounds` times and returns its Timing,
+    # `benchmark.record(name, durations)` reports durations measured otherwise
+
+    def __init__(self, test_name):
+        self._test_name = test_name
+
+    def __call__(self, func, rounds=100, name=None):
+        durations = []
+
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start_time)
+
+        return self.record(name, durations)
+
+    def record(self, name, durations):
+        durations = sorted(durations)
+        name = self._test_name if name is None else "%s: %s" % (self._test_name, name)
+
+        timing = Timing(
+            name=name, rounds=len(durations),
+            median=durations[len(durations) // 2],
+            p99=durations[min(len(durations) - 1, int(len(durations) * 0.99))])
+
+        _timings.append(timing)
+        return timing
+
+
+@pytest.fixture
+def benchmark(request):
+    return Benchmark(request.node.name)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if len(_timings) == 0:
+        return
+
+    terminalreporter.section("benchmarks")
+
+    for timing in _timings:
+        terminalreporter.write_line("%-72s %9.1fus median %9.1fus p99 (%d rounds)" % (
+            timing.name, timing.median * 1e6, timing.p99 * 1e6, timing.rounds))
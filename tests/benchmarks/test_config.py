@@ -0,0 +1,61 @@
+import configparser
+import os
+import random
+from optimus_manager import config
+from optimus_manager import envs
+from optimus_manager import var
+from tests.fakes import DEFAULT_CONFIG_PATH
+
+# Values the generated user configs pick from, one in ten invalid
+USER_VALUES = {
+    ("optimus", "switching"): ["nouveau", "bbswitch", "acpi_call", "none", "foo"],
+    ("optimus", "pci_power_control"): ["yes", "no"],
+    ("optimus", "switch_timeout"): ["10", "30", "-1"],
+    ("optimus", "startup_mode"): ["integrated", "hybrid", "nvidia", "auto", "intel"],
+    ("intel", "accel"): ["sna", "uxa", ""],
+    ("intel", "dri"): ["2", "3"],
+    ("nvidia", "dpi"): ["", "96", "144"],
+    ("nvidia", "options"): ["overclocking", "overclocking, triple_buffer", "", "foo"],
+}
+
+
+def _generate_user_configs(count):
+    generator = random.Random(0)
+    user_configs = []
+
+    for _ in range(count):
+        user_config = {}
+
+        for (section, option), values in USER_VALUES.items():
+            if generator.random() < 0.5:
+                user_config.setdefault(section, {})[option] = generator.choice(values)
+
+        user_configs.append(user_config)
+
+    return user_configs
+
+
+def test_validate(monkeypatch, benchmark):
+    parser = configparser.ConfigParser()
+    parser.read(DEFAULT_CONFIG_PATH)
+    base_config = {section: dict(parser[section]) for section in parser.sections()}
+    user_configs = _generate_user_configs(1000)
+    # Without the errors logged for the invalid values
+    monkeypatch.setattr(config.get_logger(), "disabled", True)
+
+    benchmark(lambda: [config._build_config(base_config, user_config) for user_config in user_configs],
+              rounds=10, name="1000 user configs")
+
+
+def test_load_config(config_files, benchmark):
+    # Parsed and validated, then from the compiled config cache: validated again without parsing
+    def load_uncached():
+        os.remove(envs.COMPILED_CONFIG_PATH)
+        config.load_config()
+
+    config.load_config()
+    config_dict = var.read_compiled_config()["config"]
+
+    benchmark(load_uncached, rounds=50, name="cache miss")
+    benchmark(config.load_config, rounds=200, name="cache hit")
+    benchmark(lambda: config.config_from_dict(config_dict), rounds=200, name="cache hit, validation alone")
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import time
+from optimus_manager import envs
+from optimus_manager import protocol
+from optimus_manager import var
+from optimus_manager.config import get_config, load_config
+
+
+def _run_clients(socket_path, clients_count, requests_count, request):
+    # `clients_count` client processes at once, each sending `request` `requests_count` times,
+    # a connection per request: returns the duration of every request.
+    # Processes, so that the clients don't compete with the daemon for the GIL.
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(clients_count)
+    results = context.Queue()
+
+    def client():
+        durations = []
+        barrier.wait()
+
+        for _ in range(requests_count):
+            start_time = time.perf_counter()
+            protocol.send_request(request, socket_path)
+            durations.append(time.perf_counter() - start_time)
+
+        results.put(durations)
+
+    processes = [context.Process(target=client) for _ in range(clients_count)]
+
+    for process in processes:
+        process.start()
+
+    durations = []
+
+    for _ in processes:
+        durations += results.get(timeout=30.0)
+
+    for process in processes:
+        process.join()
+
+    return durations
+
+
+def test_concurrent_clients(daemon_socket, benchmark):
+    # Queries answered on the event loop, then a command going to the worker thread.
+    # Next to a single client: the processes share the CPUs with the daemon.
+    benchmark.record("1 client, get_state", _run_clients(
+        daemon_socket, 1, 200, {"type": "get_state", "args": {}}))
+
+    benchmark.record("100 clients, get_state", _run_clients(
+        daemon_socket, 100, 10, {"type": "get_state", "args": {}}))
+
+    benchmark.record("100 clients, get_config", _run_clients(
+        daemon_socket, 100, 10, {"type": "get_config", "args": {}}))
+
+    benchmark.record("100 clients, temp_config", _run_clients(
+        daemon_socket, 100, 5, {"type": "temp_config", "args": {"path": ""}}))
+
+
+def test_get_state(daemon_socket, benchmark):
+    # What the client used to do, read the state file itself, next to asking the daemon.
+    # Then the two round trips it made before it sent both queries at once.
+    var.write_state({"type": "done", "switch_id": "20261018T193052", "current_mode": "hybrid"})
+    benchmark(var.load_state, rounds=500, name="state file")
+    benchmark(lambda: protocol.send_request({"type": "get_state", "args": {}}, daemon_socket),
+              rounds=500, name="socket")
+
+    benchmark(lambda: [
+        protocol.send_request({"type": "get_status", "args": {}}, daemon_socket),
+        protocol.send_request({"type": "get_config", "args": {}}, daemon_socket)
+    ], rounds=200, name="status and config, 2 round trips")
+
+    benchmark(lambda: protocol.send_requests([
+        {"type": "get_status", "args": {}},
+        {"type": "get_config", "args": {}}
+    ], daemon_socket), rounds=200, name="status and config, 1 round trip")
+
+
+def test_get_config(daemon_socket, benchmark):
+    # What a hook spends on the config at startup: asking the daemon, next to loading it
+    # in-process from the compiled config cache, and without that cache
+    def load_uncached():
+        os.remove(envs.COMPILED_CONFIG_PATH)
+        load_config()
+
+    benchmark(get_config, rounds=200, name="daemon")
+    load_config()
+    benchmark(load_config, rounds=200, name="load_config, cache hit")
+    benchmark(load_uncached, rounds=50, name="load_config, cache miss")
@@ -0,0 +1,42 @@
+import os
+from optimus_manager import envs
+from optimus_manager import kernel
+from optimus_manager import kmod
+from optimus_manager import runner
+
+
+def _make_modules_tree(tmp_path, modules_count=5000, aliases_count=20000):
+    # The depmod index of a distribution kernel: the switch modules among thousands of others
+    release_path = tmp_path / "lib" / "modules" / os.uname().release
+    release_path.mkdir(parents=True)
+    modules = ["drivers/misc/module-%d" % index for index in range(modules_count)]
+    modules += ["updates/dkms/%s" % module.replace("_", "-") for module in kernel.MODULES]
+
+    (release_path / "modules.dep").write_text("".join(
+        "kernel/%s.ko.zst: kernel/drivers/misc/module-0.ko.zst\n" % module for module in modules))
+
+    (release_path / "modules.builtin").write_text("".join(
+        "kernel/drivers/builtin-%d.ko\n" % index for index in range(modules_count // 5)))
+
+    (release_path / "modules.alias").write_text("".join(
+        "alias pci:v%08Xd*sv*sd*bc*sc*i* module_%d\n" % (index, index % modules_count)
+        for index in range(aliases_count)))
+
+    return tmp_path / "lib" / "modules"
+
+
+def test_module_index(tmp_path, monkeypatch, fake_vars, benchmark):
+    monkeypatch.setattr(envs, "KERNEL_MODULES_PATH", str(_make_modules_tree(tmp_path)))
+    assert kernel.get_available_modules() == kernel.MODULES
+
+    def load_uncached():
+        os.remove(envs.MODULE_INDEX_CACHE_PATH)
+        kernel.get_available_modules()
+
+    benchmark(load_uncached, rounds=10, name="5000 modules, cache miss")
+    benchmark(kernel.get_available_modules, rounds=50, name="5000 modules, cache hit")
+
+
+def test_module_index_forks(benchmark):
+    # What the `modinfo -n` path cost at least: a shell per module, without `modinfo` itself
+    benchmark(lambda: [runner.run(["sh", "-c", ":"]) for _ in kernel.MODULES], rounds=20, name="7 shells")
@@ -0,0 +1,67 @@
+from optimus_manager import envs
+from optimus_manager import pci
+from optimus_manager import runner
+from optimus_manager.pci import PciTopology
+from tests.fakes import FakePciTree
+
+
+def _make_workstation_tree(tmp_path, monkeypatch, ports_count=40, functions_count=15):
+    # `ports_count` root ports with `functions_count` devices behind each, the GPUs behind the last one
+    tree = FakePciTree(tmp_path / "sys")
+
+    for port in range(ports_count):
+        port_id = "0000:00:%02x.%d" % (port // 8, port % 8)
+        tree.add_device(port_id, "060400", "8086")
+
+        for function in range(functions_count):
+            tree.add_device("0000:%02x:%02x.0" % (port + 1, function), "020000", "15b3", parent=port_id)
+
+    tree.add_device("0000:%02x:1f.0" % ports_count, "030000", "10de", "1f91", parent=port_id)
+    tree.add_device("0000:%02x:1f.0" % (ports_count + 1), "030000", "1002", "687f", parent=port_id)
+    monkeypatch.setattr(envs, "PCI_DEVICES_PATH", str(tree.devices_path))
+    return tree
+
+
+def test_enumeration(tmp_path, monkeypatch, benchmark):
+    _make_workstation_tree(tmp_path, monkeypatch)
+    assert len(pci._list_pci_devices()) == 40 * 16 + 2
+
+    benchmark(pci._list_pci_devices, rounds=20, name="640 devices")
+    benchmark(lambda: PciTopology().get_gpus_bus_ids(), rounds=20, name="640 devices, GPUs picked")
+
+
+def test_enumeration_laptop(pci_tree, benchmark):
+    benchmark(lambda: PciTopology().get_gpus_bus_ids(), rounds=100, name="4 devices, GPUs picked")
+
+
+def test_enumeration_forks(benchmark):
+    # What the enumeration replaced cost at least: a shell per vendor, without `lspci` itself
+    benchmark(lambda: [runner.run(["sh", "-c", ":"]) for _ in pci.VENDOR_IDS], rounds=20, name="3 shells")
+
+
+def _make_deep_tree(tmp_path, monkeypatch, depth, width=16):
+    # The card under `depth` bridges, each level with `width` more bridges beside the one leading to it
+    tree = FakePciTree(tmp_path / ("sys-%d" % depth))
+    parent = None
+
+    for level in range(depth):
+        for device in range(width, -1, -1):
+            tree.add_device("0000:%02x:%02x.0" % (level, device), "060400", "10b5", parent=parent)
+
+        parent = "0000:%02x:00.0" % level
+
+    nvidia_id = "0000:%02x:00.0" % depth
+    tree.add_device(nvidia_id, "030000", "10de", "1f91", parent=parent)
+    monkeypatch.setattr(envs, "PCI_DEVICES_PATH", str(tree.devices_path))
+    return nvidia_id
+
+
+def test_upstream_bridges_scaling(tmp_path, monkeypatch, benchmark):
+    # Resolved from the card's sysfs path alone: grows with the depth, not with the bridges count
+    for depth in [1, 4, 16]:
+        nvidia_id = _make_deep_tree(tmp_path, monkeypatch, depth)
+        assert len(pci._get_upstream_pci_bridges(nvidia_id)) == depth
+
+        benchmark(
+            lambda: pci._get_upstream_pci_bridges(nvidia_id), rounds=200,
+            name="depth %d, %d bridges" % (depth, depth * 17))
@@ -0,0 +1,17 @@
+from optimus_manager import processes
+
+
+def test_find_gpu_users(proc_tree, benchmark):
+    # A busy desktop: thousands of processes with open files and mapped libraries, two on the card
+    nvidia_path = proc_tree.add_device("nvidia0")
+    files = ["/home/user/.cache/file-%d" % index for index in range(8)]
+    libraries = ["/usr/lib/lib%d.so" % index for index in range(20)]
+
+    for pid in range(1000, 2000):
+        proc_tree.add_process(pid, "/usr/bin/worker --id %d" % pid, fds=files, maps=libraries)
+
+    proc_tree.add_process(2000, "blender", fds=files + [nvidia_path], maps=libraries)
+    proc_tree.add_process(2001, "glxgears", fds=files, maps=libraries + [nvidia_path])
+
+    assert [gpu_user.pid for gpu_user in processes.find_gpu_users([nvidia_path])] == [2000, 2001]
+    benchmark(lambda: processes.find_gpu_users([nvidia_path]), rounds=5, name="1000 processes")
@@ -0,0 +1,23 @@
+from optimus_manager import protocol
+
+
+def test_throughput(daemon_socket, benchmark):
+    # 100 queries, each on its own connection and pipelined on a single one
+    requests = [{"type": "get_state", "args": {}}] * 100
+
+    def one_connection_each():
+        for request in requests:
+            protocol.send_request(request, daemon_socket)
+
+    benchmark(one_connection_each, rounds=10, name="100 requests, a connection each")
+    benchmark(lambda: protocol.send_requests(requests, daemon_socket), rounds=10, name="100 requests, pipelined")
+
+
+def test_decode(benchmark):
+    # A buffer of replies as a client receives them, split from each other
+    data = b"".join(
+        protocol.encode_message(protocol.make_reply(request_id, {"type": "done", "current_mode": "hybrid"}))
+        for request_id in range(1000))
+
+    assert len(protocol.decode_messages(data)[0]) == 1000
+    benchmark(lambda: protocol.decode_messages(data), rounds=50, name="1000 messages")
@@ -0,0 +1,19 @@
+import os
+import shutil
+from optimus_manager import runner
+
+
+def _posix_spawn_true():
+    pid = os.posix_spawn(shutil.which("true"), ["true"], os.environ, setpgroup=0)
+    os.waitpid(pid, 0)
+
+
+def test_run(monkeypatch, benchmark):
+    # Without and with the shell the call sites used to go through, next to a bare `posix_spawn`.
+    # Then with `preexec_fn`, how commands are started before Python 3.11.
+    benchmark(lambda: runner.run(["true"]), rounds=200, name="argv")
+    benchmark(lambda: runner.run(["sh", "-c", "true"]), rounds=200, name="shell")
+    benchmark(_posix_spawn_true, rounds=200, name="posix_spawn alone")
+
+    monkeypatch.setattr(runner, "PROCESS_GROUP_ARGS", {"preexec_fn": os.setpgrp})
+    benchmark(lambda: runner.run(["true"]), rounds=200, name="argv, preexec_fn")
@@ -0,0 +1,119 @@
+import asyncio
+import shutil
+import threading
+import pytest
+from optimus_manager import daemon
+from optimus_manager import envs
+from optimus_manager import host
+from optimus_manager import kmod
+from optimus_manager import processes
+from optimus_manager import var
+from tests.fakes import (
+    DEFAULT_CONFIG_PATH, FakeAcpiTree, FakeHost, FakeKernel, FakePciTree, FakeProcTree, MODULE_DEPENDENCIES,
+    age_file, wait_for_daemon)
+
+VARS_ROOT_PATH = "/var/lib/optimus-manager"
+
+
+@pytest.fixture
+def pci_tree(tmp_path, monkeypatch):
+    # An Nvidia card behind a bridge, and an Intel GPU
+    tree = FakePciTree(tmp_path / "sys")
+    tree.add_device("0000:00:01.0", "060400", "8086")
+    tree.add_device("0000:00:02.0", "030000", "8086", "3e9b")
+    tree.add_device("0000:01:00.0", "030000", "10de", "1f91", parent="0000:00:01.0")
+    tree.add_device("0000:01:00.1", "040300", "10de", "10fa", parent="0000:00:01.0")
+    monkeypatch.setattr(envs, "PCI_DEVICES_PATH", str(tree.devices_path))
+    monkeypatch.setattr(envs, "PCI_RESCAN_PATH", str(tree.rescan_path))
+    return tree
+
+
+@pytest.fixture
+def fake_vars(tmp_path, monkeypatch):
+    # Every state and cache file of `var` under a tmp folder
+    vars_path = tmp_path / "vars"
+
+    for name, value in vars(envs).items():
+        if isinstance(value, str) and value.startswith(VARS_ROOT_PATH):
+            monkeypatch.setattr(envs, name, str(vars_path) + value[len(VARS_ROOT_PATH):])
+
+    return vars_path
+
+
+@pytest.fixture
+def fake_kernel(tmp_path, monkeypatch, fake_vars):
+    # Every module of the switches installed, none loaded
+    kernel = FakeKernel(tmp_path, ["nouveau", "bbswitch", "acpi_call"] + list(MODULE_DEPENDENCIES.keys()) + ["nvidia"])
+    monkeypatch.setattr(envs, "PROC_MODULES_PATH", str(kernel.proc_modules_path))
+    monkeypatch.setattr(envs, "SYS_MODULES_PATH", str(kernel.sys_modules_path))
+    monkeypatch.setattr(envs, "KERNEL_MODULES_PATH", str(kernel.kernel_modules_path))
+    monkeypatch.setattr(kmod, "_backend", kernel)
+    return kernel
+
+
+@pytest.fixture
+def fake_host(tmp_path, monkeypatch, fake_vars):
+    fake = FakeHost(tmp_path / "host")
+    monkeypatch.setattr(envs, "DMI_ID_PATH", str(fake.dmi_path))
+    monkeypatch.setattr(envs, "BOOT_ID_PATH", str(fake.boot_id_path))
+    monkeypatch.setattr(envs, "PROC_CMDLINE_PATH", str(fake.cmdline_path))
+    monkeypatch.setattr(envs, "PROC_CPUINFO_PATH", str(fake.cpuinfo_path))
+    monkeypatch.setattr(envs, "POWER_SUPPLY_PATH", str(fake.power_supply_path))
+    monkeypatch.setattr(host, "_host_facts", None)
+    return fake
+
+
+@pytest.fixture
+def acpi_tree(tmp_path, monkeypatch):
+    # The PCI root and the Nvidia card behind `PEG0`
+    tree = FakeAcpiTree(tmp_path / "acpi" / "devices")
+    tree.add_device("PNP0A08:00", "\\_SB_.PCI0", vendor_id="0x8086")
+    tree.add_device("device:02", "\\_SB_.PCI0.PEG0")
+    tree.add_device("device:03", "\\_SB_.PCI0.PEG0.PEGP", vendor_id="0x10de")
+    monkeypatch.setattr(envs, "ACPI_DEVICES_PATH", str(tree.devices_path))
+    return tree
+
+
+@pytest.fixture
+def proc_tree(tmp_path, monkeypatch):
+    tree = FakeProcTree(tmp_path / "processes")
+    monkeypatch.setattr(processes, "PROC_PATH", str(tree.proc_path))
+    monkeypatch.setattr(processes, "DEV_PATH", str(tree.dev_path))
+    return tree
+
+
+@pytest.fixture
+def daemon_paths(tmp_path, monkeypatch, fake_vars):
+    # The socket under a tmp folder, the shipped default config and no user config
+    socket_path = tmp_path / "socket"
+    monkeypatch.setattr(envs, "SOCKET_PATH", str(socket_path))
+    monkeypatch.setattr(envs, "DEFAULT_CONFIG_PATH", DEFAULT_CONFIG_PATH)
+    return socket_path
+
+
+@pytest.fixture
+def daemon_socket(daemon_paths):
+    # The daemon answering on its own thread: the signal handlers of `daemon._serve`
+    # need the main one, it is stopped like they would
+    loop = asyncio.new_event_loop()
+    stop_event = asyncio.Event()
+    thread = threading.Thread(
+        target=loop.run_until_complete, args=(daemon._run_server(daemon.get_logger(), stop_event),))
+
+    thread.start()
+    wait_for_daemon(str(daemon_paths))
+    yield str(daemon_paths)
+    loop.call_soon_threadsafe(stop_event.set)
+    thread.join()
+    loop.close()
+
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch, fake_vars):
+    # A copy of the shipped default config, modified long enough ago to be cached, and no user config
+    default_path = tmp_path / "optimus-manager.conf"
+    shutil.copy(DEFAULT_CONFIG_PATH, default_path)
+    age_file(default_path, var.RACY_DELAY_NS / 1e9 + 1)
+    monkeypatch.setattr(envs, "DEFAULT_CONFIG_PATH", str(default_path))
+    return default_path
@@ -0,0 +1,303 @@
+import configparser
+import os
+import shutil
+import time
+from optimus_manager import kmod
+from optimus_manager import protocol
+from optimus_manager.config import config_from_dict
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "optimus-manager.conf")
+
+# What each module uses, as `modules.dep` would say
+MODULE_DEPENDENCIES = {
+    "nvidia_drm": ["nvidia_modeset"],
+    "nvidia_modeset": ["nvidia"],
+    "nvidia_uvm": ["nvidia"]
+}
+
+
+def make_config(**sections):
+    # The default config, with the options of `sections` replaced.
+    # Example: `make_config(optimus={"switching": "bbswitch"})`
+    parser = configparser.ConfigParser()
+    parser.read(DEFAULT_CONFIG_PATH)
+    config_dict = {section: dict(parser[section]) for section in parser.sections()}
+
+    for section, options in sections.items():
+        config_dict[section].update(options)
+
+    return config_from_dict(config_dict)
+
+
+def age_file(path, seconds):
+    # Modified `seconds` earlier than it was
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - int(seconds * 1e9)))
+
+
+def wait_for_daemon(socket_path, timeout=5.0):
+    # Until it answers on `socket_path`
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            protocol.send_request({"type": "get_state", "args": {}}, socket_path)
+            return
+
+        except protocol.ProtocolError:
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.01)
+
+
+class FakePciTree:
+    # `/sys/bus/pci` and `/sys/devices` under a tmp folder: every device is a folder
+    # of the devices tree, linked from `bus/pci/devices` like sysfs does.
+    # Devices without a parent are under the root complex of their domain and bus.
+
+    def __init__(self, root):
+        self.devices_path = root / "bus" / "pci" / "devices"
+        self.rescan_path = root / "bus" / "pci" / "rescan"
+        self._tree_path = root / "devices"
+        self._device_paths = {}
+        self.devices_path.mkdir(parents=True)
+        self.rescan_path.write_text("")
+
+    def add_device(self, bus_id, pci_class, vendor_id, device_id="0000", parent=None, power_control="on"):
+        if parent is None:
+            parent_path = self._tree_path / ("pci" + bus_id[:7])
+        else:
+            parent_path = self._device_paths[parent]
+
+        device_path = parent_path / bus_id
+        (device_path / "power").mkdir(parents=True)
+        (device_path / "class").write_text("0x%s\n" % pci_class)
+        (device_path / "vendor").write_text("0x%s\n" % vendor_id)
+        (device_path / "device").write_text("0x%s\n" % device_id)
+        (device_path / "power" / "control").write_text("%s\n" % power_control)
+        (device_path / "remove").write_text("")
+        (device_path / "reset").write_text("")
+        (self.devices_path / bus_id).symlink_to(device_path)
+        self._device_paths[bus_id] = device_path
+
+    def remove_device(self, bus_id):
+        # Only unlinked from the bus, like after writing to its `remove` file
+        os.unlink(self.devices_path / bus_id)
+
+    def restore_device(self, bus_id):
+        # Back in the bus, like after a rescan
+        (self.devices_path / bus_id).symlink_to(self._device_paths[bus_id])
+
+    def read_attribute(self, bus_id, name):
+        return (self._device_paths[bus_id] / name).read_text().strip()
+
+    def write_attribute(self, bus_id, name, value):
+        (self._device_paths[bus_id] / name).write_text("%s\n" % value)
+
+    def write_config(self, bus_id, data):
+        # The `config` file of the device, returns its path
+        config_path = self._device_paths[bus_id] / "config"
+        config_path.write_bytes(data)
+        return str(config_path)
+
+
+class FakeKernel:
+    # `/proc/modules`, `/sys/module` and the depmod index of a kernel under a tmp folder.
+    # Also the module backend: loads and unloads like modprobe would, and records the calls.
+
+    def __init__(self, root, available):
+        self.calls = []
+        self.proc_modules_path = root / "proc" / "modules"
+        self.sys_modules_path = root / "sys" / "module"
+        self.kernel_modules_path = root / "lib" / "modules"
+        self._available = list(available)
+        self._builtin = set()
+        self._refcounts = {}
+        self._holders = {}
+        self._extra_refs = {}
+        self.proc_modules_path.parent.mkdir(parents=True)
+        self.sys_modules_path.mkdir(parents=True)
+        self._write_index()
+        self._write()
+
+    def set_builtin(self, module):
+        # Built into the kernel with parameters, instead of loadable
+        self._available.remove(module)
+        self._builtin.add(module)
+        self._write_index()
+        self._write()
+
+    def is_loaded(self, module):
+        return module in self._refcounts or module in self._builtin
+
+    def insert(self, module):
+        # With its dependencies, without recording it
+        for dep in MODULE_DEPENDENCIES.get(module, []):
+            if not self.is_loaded(dep):
+                self.insert(dep)
+
+            if dep in self._refcounts:
+                self._refcounts[dep] += 1
+                self._holders[dep].append(module)
+
+        self._refcounts[module] = 0
+        self._holders[module] = []
+        self._write()
+
+    def hold(self, module, count=1):
+        # References from outside the modules, like processes using the card
+        self._extra_refs[module] = self._extra_refs.get(module, 0) + count
+        self._refcounts[module] += count
+        self._write()
+
+    def release(self, module):
+        self._refcounts[module] -= self._extra_refs.pop(module, 0)
+        self._write()
+
+    def load(self, module, options):
+        self.calls.append(("load", module, list(options)))
+        self.insert(module)
+
+    def unload(self, module):
+        self.calls.append(("unload", module))
+
+        if module in self._builtin:
+            raise kmod.KmodError("Module is built into the kernel: %s" % module)
+
+        if self._refcounts.get(module, 0) > 0:
+            raise kmod.KmodError("Failed to unload %s: Resource temporarily unavailable" % module)
+
+        del self._refcounts[module]
+        del self._holders[module]
+
+        for dep in MODULE_DEPENDENCIES.get(module, []):
+            if dep in self._refcounts:
+                self._refcounts[dep] -= 1
+                self._holders[dep].remove(module)
+
+        self._write()
+
+    def _write_index(self):
+        release_path = self.kernel_modules_path / os.uname().release
+        release_path.mkdir(parents=True, exist_ok=True)
+
+        (release_path / "modules.dep").write_text("".join(
+            "kernel/drivers/%s.ko.zst:\n" % module.replace("_", "-") for module in self._available))
+
+        (release_path / "modules.builtin").write_text("".join(
+            "kernel/drivers/%s.ko\n" % module for module in sorted(self._builtin)))
+
+    def _write(self):
+        lines = []
+
+        for module, refcount in self._refcounts.items():
+            holders = "".join(holder + "," for holder in self._holders[module]) or "-"
+            lines.append("%s 16384 %d %s Live 0x0000000000000000 (POE)\n" % (module, refcount, holders))
+
+        self.proc_modules_path.write_text("".join(lines))
+
+        for module_path in self.sys_modules_path.iterdir():
+            for path in sorted(module_path.rglob("*"), reverse=True):
+                path.rmdir() if path.is_dir() else path.unlink()
+
+            module_path.rmdir()
+
+        for module in self._builtin:
+            (self.sys_modules_path / module / "parameters").mkdir(parents=True)
+
+        for module, refcount in self._refcounts.items():
+            module_path = self.sys_modules_path / module
+            (module_path / "holders").mkdir(parents=True)
+            (module_path / "initstate").write_text("live\n")
+            (module_path / "refcnt").write_text("%d\n" % refcount)
+
+            for holder in self._holders[module]:
+                (module_path / "holders" / holder).write_text("")
+
+
+class FakeProcTree:
+    # `/proc` and `/dev` under a tmp folder. Processes have their fds as symlinks
+    # to the paths they opened, like `/proc/<pid>/fd` has, and a `maps` file.
+
+    def __init__(self, root):
+        self.proc_path = root / "proc"
+        self.dev_path = root / "dev"
+        self.proc_path.mkdir(parents=True)
+        (self.dev_path / "dri").mkdir(parents=True)
+
+    def add_device(self, name):
+        # Returns its path, as the processes see it
+        (self.dev_path / name).write_text("")
+        return str(self.dev_path / name)
+
+    def add_process(self, pid, cmdline, fds=(), maps=()):
+        # `fds` and `maps` are the paths opened and mapped
+        process_path = self.proc_path / str(pid)
+        (process_path / "fd").mkdir(parents=True)
+        (process_path / "cmdline").write_bytes(b"\0".join(arg.encode() for arg in cmdline.split()) + b"\0")
+
+        for fd, target in enumerate(["/dev/null", "/dev/null", "/dev/null"] + list(fds)):
+            (process_path / "fd" / str(fd)).symlink_to(target)
+
+        (process_path / "maps").write_text("".join(
+            "7f3c2a%03x000-7f3c2a%03x000 rw-s 00000000 00:05 1042                       %s\n" % (index, index + 1, path)
+            for index, path in enumerate(["/usr/lib/libc.so.6"] + list(maps))))
+
+    def exit(self, pid):
+        shutil.rmtree(self.proc_path / str(pid))
+
+
+class FakeHost:
+    # The files host facts are read from, under a tmp folder: a machine with PAT and no battery
+
+    def __init__(self, root):
+        self.dmi_path = root / "dmi"
+        self.boot_id_path = root / "boot_id"
+        self.cmdline_path = root / "cmdline"
+        self.cpuinfo_path = root / "cpuinfo"
+        self.power_supply_path = root / "power_supply"
+        self._boot_count = 0
+        self.dmi_path.mkdir(parents=True)
+        self.power_supply_path.mkdir()
+        self.cmdline_path.write_text("BOOT_IMAGE=/vmlinuz-linux root=/dev/nvme0n1p2 rw quiet\n")
+        self.cpuinfo_path.write_text("processor\t: 0\nflags\t\t: fpu vme de pse tsc msr pae pat pse36\n")
+
+        for field, value in [
+                ("sys_vendor", "ASUSTeK COMPUTER INC."), ("product_name", "ROG Strix G531GT"),
+                ("board_vendor", "ASUSTeK COMPUTER INC."), ("board_name", "G531GT"), ("bios_version", "G531GT.304")]:
+            self.set_dmi(field, value)
+
+        self.reboot()
+
+    def set_dmi(self, field, value):
+        # Only read again after a reboot, like for a firmware update
+        (self.dmi_path / field).write_text(value + "\n")
+
+    def add_power_supply(self, name, supply_type, online):
+        supply_path = self.power_supply_path / name
+        supply_path.mkdir()
+        (supply_path / "type").write_text(supply_type + "\n")
+        (supply_path / "online").write_text("%d\n" % online)
+
+    def reboot(self):
+        self._boot_count += 1
+        self.boot_id_path.write_text("8c2d2d4e-0000-4000-8000-%012d\n" % self._boot_count)
+
+
+class FakeAcpiTree:
+    # `/sys/bus/acpi/devices` under a tmp folder
+
+    def __init__(self, root):
+        self.devices_path = root
+        self.devices_path.mkdir(parents=True)
+
+    def add_device(self, name, acpi_path, vendor_id=None):
+        # With a `physical_node` if `vendor_id` is set, like devices bound to a PCI function
+        device_path = self.devices_path / name
+        device_path.mkdir()
+        (device_path / "path").write_text(acpi_path + "\n")
+
+        if vendor_id is not None:
+            (device_path / "physical_node").mkdir()
+            (device_path / "physical_node" / "vendor").write_text(vendor_id + "\n")
@@ -0,0 +1,107 @@
+from optimus_manager import acpi
+from optimus_manager import envs
+from optimus_manager import var
+from optimus_manager.acpi_data import ACPI_STRINGS
+
+PEGP_STRINGS = [
+    ("\\_SB.PCI0.PEG0.PEGP._OFF", "\\_SB.PCI0.PEG0.PEGP._ON"),
+    ("\\_SB.PCI0.PEG0.PEGP.SGOF", "\\_SB.PCI0.PEG0.PEGP.SGON")
+]
+
+PUBS_STRINGS = [("\\_SB.PCI0.LPC.EC.PUBS._OFF", "\\_SB.PCI0.LPC.EC.PUBS._ON")]
+
+
+def _is_cache_saved():
+    try:
+        var.read_acpi_candidates_cache()
+
+    except var.VarError:
+        return False
+
+    return True
+
+
+def test_normalize_acpi_path():
+    assert acpi._normalize_acpi_path("\\_SB.PCI0.PEG0.PEGP") == "\\_SB_.PCI0.PEG0.PEGP"
+    assert acpi._normalize_acpi_path("\\_SB.PCI0.LPC.EC.PUBS") == "\\_SB_.PCI0.LPC_.EC__.PUBS"
+    assert acpi._normalize_acpi_path("\\_SB_.PCI0.PEG") == "\\_SB_.PCI0.PEG_"
+    assert acpi._normalize_acpi_path("_SB.PCI0") == "\\_SB_.PCI0"
+
+
+def test_rank_candidates_strips_method():
+    # `_OFF`, `DOFF` and `DGOF` are methods of the device before them
+    acpi_strings = [
+        ("\\_SB.PCI0.PEG0.GFX0.DOFF", "\\_SB.PCI0.PEG0.GFX0.DON"),
+        ("\\_SB.PCI0.XVR0.Z01I.DGOF", "\\_SB.PCI0.XVR0.Z01I.DGON"),
+        ("\\_SB.PCI0.PEG0._OFF", "\\_SB.PCI0.PEG0._ON")
+    ]
+
+    acpi_devices = {"\\_SB_.PCI0.PEG0.GFX0": False, "\\_SB_.PCI0.PEG0": False}
+
+    assert acpi._rank_candidates(acpi_strings, acpi_devices) == [acpi_strings[0], acpi_strings[2]]
+
+
+def test_rank_candidates_nvidia_first():
+    acpi_devices = {"\\_SB_.PCI0.LPC_.EC__.PUBS": False, "\\_SB_.PCI0.PEG0.PEGP": True}
+    assert acpi._rank_candidates(ACPI_STRINGS, acpi_devices) == PEGP_STRINGS + PUBS_STRINGS
+
+
+def test_rank_candidates_missing_devices():
+    acpi_devices = {"\\_SB_.PCI0": False, "\\_SB_.PCI0.PEG0": False, "\\_SB_.PCI0.RP05": True}
+    assert acpi._rank_candidates(ACPI_STRINGS, acpi_devices) == []
+
+
+def test_read_acpi_devices(acpi_tree):
+    acpi_tree.add_device("device:04", "\\_SB_.PCI0.LPC_")
+
+    assert acpi._read_acpi_devices() == {
+        "\\_SB_.PCI0": False,
+        "\\_SB_.PCI0.PEG0": False,
+        "\\_SB_.PCI0.PEG0.PEGP": True,
+        "\\_SB_.PCI0.LPC_": False
+    }
+
+
+def test_read_acpi_devices_same_path(acpi_tree):
+    # Bound to the Nvidia card if any of the devices with that path is
+    acpi_tree.add_device("device:05", "\\_SB_.PCI0.PEG0", vendor_id="0x10DE")
+    assert acpi._read_acpi_devices()["\\_SB_.PCI0.PEG0"]
+
+
+def test_read_acpi_devices_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(envs, "ACPI_DEVICES_PATH", str(tmp_path / "acpi"))
+    assert acpi._read_acpi_devices() is None
+
+
+def test_candidates(acpi_tree, fake_host):
+    acpi_tree.add_device("device:06", "\\_SB_.PCI0.LPC_.EC__.PUBS")
+    assert acpi.get_acpi_call_candidates() == PEGP_STRINGS + PUBS_STRINGS
+
+
+def test_candidates_none_matching(acpi_tree, fake_host):
+    # Every call is tried, and that isn't cached
+    acpi_tree.add_device("device:07", "\\_SB_.PCI0.RP01.PXSX", vendor_id="0x10de")
+    (acpi_tree.devices_path / "device:03" / "path").write_text("\\_SB_.PCI0.PEG0.GFX1\n")
+
+    assert acpi.get_acpi_call_candidates() == ACPI_STRINGS
+    assert not _is_cache_saved()
+
+
+def test_candidates_no_acpi_tree(tmp_path, monkeypatch, fake_host):
+    monkeypatch.setattr(envs, "ACPI_DEVICES_PATH", str(tmp_path / "acpi"))
+    assert acpi.get_acpi_call_candidates() == ACPI_STRINGS
+
+
+def test_candidates_cached_per_machine(acpi_tree, fake_host):
+    assert acpi.get_acpi_call_candidates() == PEGP_STRINGS
+
+    # Same board and firmware: the tree isn't read again
+    acpi_tree.add_device("device:06", "\\_SB_.PCI0.LPC_.EC__.PUBS")
+    fake_host.reboot()
+    assert acpi.get_acpi_call_candidates() == PEGP_STRINGS
+
+    # Firmware updated
+    fake_host.set_dmi("bios_version", "G531GT.305")
+    fake_host.reboot()
+    assert acpi.get_acpi_call_candidates() == PEGP_STRINGS + PUBS_STRINGS
+    assert len(var.read_acpi_candidates_cache()) == 2
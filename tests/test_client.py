@@ -0,0 +1,53 @@
+import pytest
+from optimus_manager import envs
+from optimus_manager import protocol
+from optimus_manager import var
+from optimus_manager.config import ConfigError
+
+# The client logs out desktop sessions through D-Bus
+pytest.importorskip("dbus")
+from optimus_manager import client  # pylint: disable=C0413
+
+
+def test_status_and_config(daemon_socket, monkeypatch):
+    # Both in a single round trip
+    round_trips = []
+    send_requests = protocol.send_requests
+
+    def counting_send_requests(requests, *args, **kwargs):
+        round_trips.append([request["type"] for request in requests])
+        return send_requests(requests, *args, **kwargs)
+
+    monkeypatch.setattr(protocol, "send_requests", counting_send_requests)
+    var.write_state({"type": "pending_pre_xorg_start", "requested_mode": "nvidia", "current_mode": "integrated"})
+    status, (config, error) = client._get_status_and_config()
+
+    assert round_trips == [["get_status", "get_config"]]
+    assert status["state"]["current_mode"] == "integrated"
+    assert status["next_mode"] == "nvidia"
+    assert error is None
+    assert config.optimus.switching == "none"
+
+
+def test_status_and_config_config_error(daemon_socket, tmp_path, monkeypatch):
+    # The state is still reported
+    default_path = tmp_path / "optimus-manager.conf"
+    default_path.write_text("[optimus]\nswitching=foo\n")
+    monkeypatch.setattr(envs, "DEFAULT_CONFIG_PATH", str(default_path))
+    var.write_state({"type": "done", "current_mode": "integrated"})
+    status, (config, error) = client._get_status_and_config()
+
+    assert status["state"] == {"type": "done", "current_mode": "integrated"}
+    assert config is None
+    assert isinstance(error, ConfigError)
+
+
+def test_status_and_config_no_daemon(daemon_paths):
+    var.write_state({"type": "done", "current_mode": "hybrid"})
+    var.write_temp_conf_path_var("/tmp/test.conf")
+    status, (config, error) = client._get_status_and_config()
+
+    assert status == {"state": {"type": "done", "current_mode": "hybrid"}, "next_mode": None,
+                      "temp_config_path": "/tmp/test.conf"}
+    assert error is None
+    assert config.optimus.switching == "none"
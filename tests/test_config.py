@@ -0,0 +1,194 @@
+import configparser
+import logging
+import os
+import pytest
+from optimus_manager import config
+from optimus_manager import envs
+from optimus_manager import var
+from optimus_manager.config import ConfigError
+from tests.fakes import DEFAULT_CONFIG_PATH, age_file
+
+
+def _read_default_config():
+    parser = configparser.ConfigParser()
+    parser.read(DEFAULT_CONFIG_PATH)
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def _build_config(base_options=None, user_options=None):
+    # The default config with `base_options` replaced, by (section, option), and `user_options` as the user config
+    base_config = _read_default_config()
+    user_config = {}
+
+    for (section, option), value in (base_options or {}).items():
+        base_config[section][option] = value
+
+    for (section, option), value in (user_options or {}).items():
+        user_config.setdefault(section, {})[option] = value
+
+    return config._build_config(base_config, user_config)
+
+
+def test_integer_validator():
+    validator = config._IntegerValidator(can_be_blank=False)
+    assert validator.parse(" 96 ") == 96
+    assert validator.parse("0") == 0
+
+    with pytest.raises(ValueError, match="Positive integer required: -1"):
+        validator.parse("-1")
+
+    with pytest.raises(ValueError, match="Positive integer required: 1.5"):
+        validator.parse("1.5")
+
+    with pytest.raises(ValueError, match="Value can't be blank"):
+        validator.parse(" ")
+
+    assert config._IntegerValidator(can_be_blank=True).parse("") is None
+
+
+def test_boolean_validator():
+    validator = config._SingleWordValidator(["yes", "no"], can_be_blank=False)
+    assert validator.parse("yes") is True
+    assert validator.parse(" no") is False
+
+    with pytest.raises(ValueError, match="Invalid value: true"):
+        validator.parse("true")
+
+    with pytest.raises(ValueError, match="Non-blank value required"):
+        validator.parse("")
+
+    assert config._SingleWordValidator(["yes", "no"], can_be_blank=True).parse("") is None
+
+
+def test_enum_validator():
+    validator = config._SingleWordValidator(["nouveau", "bbswitch", "none"], can_be_blank=False)
+    assert validator.parse("bbswitch") == "bbswitch"
+
+    with pytest.raises(ValueError, match="Invalid value: Nouveau"):
+        validator.parse("Nouveau")
+
+    # Numbers are read as ints
+    assert config._SingleWordValidator(["0", "2", "3"], can_be_blank=False).parse("3") == 3
+
+
+def test_multi_words_validator():
+    validator = config._MultiWordsValidator(["overclocking", "triple_buffer"], can_be_blank=False)
+    assert validator.parse("overclocking, triple_buffer") == ("overclocking", "triple_buffer")
+
+    with pytest.raises(ValueError, match="Invalid value: foo"):
+        validator.parse("overclocking,foo")
+
+    with pytest.raises(ValueError, match="At least one parameter required"):
+        validator.parse(" ")
+
+    assert config._MultiWordsValidator(["overclocking"], can_be_blank=True).parse("") == ()
+
+
+def test_typed_values():
+    built = _build_config(user_options={("nvidia", "dpi"): "144", ("nvidia", "options"): "overclocking"})
+
+    assert built.optimus.pci_power_control is False
+    assert built.intel.dri == 3
+    assert built.nvidia.dpi == 144
+    assert built.nvidia.options == ("overclocking",)
+    assert built["nvidia"]["dpi"] == "144"
+
+
+def test_invalid_user_value(caplog):
+    # Falls back to the default value
+    with caplog.at_level(logging.INFO):
+        built = _build_config(user_options={("optimus", "switching"): "foo"})
+
+    assert built.optimus.switching == "none"
+    assert built["optimus"]["switching"] == "none"
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert "Invalid option \"switching\" in section \"[optimus]\": Invalid value: foo" in messages
+    assert "Falling back to default value: none" in messages
+
+
+def test_invalid_default_value():
+    with pytest.raises(ConfigError, match="Invalid option \"switch_timeout\" in section \"\\[optimus\\]\": "
+                                          "Positive integer required: -5"):
+        _build_config(base_options={("optimus", "switch_timeout"): "-5"})
+
+
+def test_invalid_default_value_overridden():
+    # Only reported when it is used
+    built = _build_config(
+        base_options={("optimus", "switch_timeout"): "-5"}, user_options={("optimus", "switch_timeout"): "30"})
+
+    assert built.optimus.switch_timeout == 30
+
+    with pytest.raises(ConfigError, match="Positive integer required: -5"):
+        _build_config(
+            base_options={("optimus", "switch_timeout"): "-5"}, user_options={("optimus", "switch_timeout"): "-1"})
+
+
+def test_missing_option():
+    base_config = _read_default_config()
+    del base_config["nvidia"]["dpi"]
+
+    with pytest.raises(ConfigError, match="Missing option \"dpi\" in section \"\\[nvidia\\]\""):
+        config._build_config(base_config, {})
+
+
+def test_deprecated_value():
+    built = _build_config(user_options={("optimus", "startup_mode"): "intel"})
+    assert built.optimus.startup_mode == "integrated"
+
+
+def test_to_dict():
+    # A copy, that `config_from_dict` reads back
+    built = _build_config(user_options={("nvidia", "dpi"): "144"})
+    config_dict = built.to_dict()
+    config_dict["nvidia"]["dpi"] = "96"
+
+    assert built["nvidia"]["dpi"] == "144"
+    assert config.config_from_dict(built.to_dict()).nvidia.dpi == 144
+
+
+def test_load_config_cached(config_files, monkeypatch):
+    built = config.load_config()
+    assert var.read_compiled_config() == {"key": config._get_config_files_key(), "config": built.to_dict()}
+
+    # Not parsed again
+    monkeypatch.setattr(config, "_compile_config", None)
+    assert config.load_config().to_dict() == built.to_dict()
+
+
+def test_load_config_user_config_changes(config_files):
+    assert config.load_config().optimus.switching == "none"
+
+    # Created
+    os.makedirs(os.path.dirname(envs.USER_CONFIG_COPY_PATH), exist_ok=True)
+    with open(envs.USER_CONFIG_COPY_PATH, "w") as f:
+        f.write("[optimus]\nswitching=bbswitch\n")
+
+    age_file(envs.USER_CONFIG_COPY_PATH, var.RACY_DELAY_NS / 1e9 + 1)
+    assert config.load_config().optimus.switching == "bbswitch"
+
+    # Edited
+    with open(envs.USER_CONFIG_COPY_PATH, "w") as f:
+        f.write("[optimus]\nswitching=nouveau\n")
+
+    assert config.load_config().optimus.switching == "nouveau"
+
+    # Removed
+    os.remove(envs.USER_CONFIG_COPY_PATH)
+    assert config.load_config().optimus.switching == "none"
+
+
+def test_load_config_racy(config_files):
+    # Not cached while the files may still change within the same mtime tick
+    with open(config_files, "a") as f:
+        f.write("\n")
+
+    config.load_config()
+
+    with pytest.raises(var.VarError):
+        var.read_compiled_config()
+
+    age_file(config_files, var.RACY_DELAY_NS / 1e9 + 1)
+    config.load_config()
+    assert var.read_compiled_config()["key"] == config._get_config_files_key()
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from optimus_manager import daemon
+from optimus_manager import envs
+from optimus_manager import protocol
+from optimus_manager import var
+from optimus_manager.config import ConfigError
+from tests.fakes import wait_for_daemon
+
+
+class FakeLoader:
+    # Stands in for `load_config`: returns or raises what it is given in turn, once `release` is set
+
+    def __init__(self, results):
+        self.threads = []
+        self.release = threading.Event()
+        self.release.set()
+        self._results = list(results)
+
+    def __call__(self):
+        self.threads.append(threading.get_ident())
+        self.release.wait(5.0)
+        result = self._results.pop(0)
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+
+@pytest.fixture
+def config_paths(tmp_path, monkeypatch):
+    default_path = tmp_path / "optimus-manager.conf"
+    user_path = tmp_path / "config_copy" / "optimus-manager.conf"
+    default_path.write_text("[optimus]\n")
+    monkeypatch.setattr(envs, "DEFAULT_CONFIG_PATH", str(default_path))
+    monkeypatch.setattr(envs, "USER_CONFIG_COPY_PATH", str(user_path))
+    return default_path
+
+
+def _run_with_store(test, loader, monkeypatch, watching=True):
+    # Runs `test(store, changes)` on an event loop, `changes` counts the reported config changes
+    monkeypatch.setattr(daemon, "load_config", loader)
+    changes = []
+
+    async def main():
+        store = daemon._ConfigStore(daemon.get_logger(), asyncio.get_running_loop(), executor)
+        on_change = store._on_change
+
+        def counting_on_change():
+            on_change()
+
+            if store._result is None and store._loading is None:
+                changes.append(1)
+
+        store._on_change = counting_on_change
+
+        if watching:
+            store.start_watching()
+
+        try:
+            await test(store, changes)
+        finally:
+            store.stop_watching()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(main())
+
+
+async def _wait_for_change(changes):
+    for _ in range(200):
+        if len(changes) > 0:
+            return
+
+        await asyncio.sleep(0.01)
+
+    raise AssertionError("No config change reported")
+
+
+def test_loaded_on_worker_thread(config_paths, monkeypatch):
+    loader = FakeLoader(["first", "second"])
+
+    async def test(store, changes):
+        await store.refresh()
+        assert store.get() == "first"
+
+        # Served from memory until a change
+        await store.refresh()
+        assert store.get() == "first"
+        assert len(loader.threads) == 1
+        assert loader.threads[0] != threading.get_ident()
+
+        config_paths.write_text("[optimus]\nswitching=none\n")
+        await _wait_for_change(changes)
+        await store.refresh()
+        assert store.get() == "second"
+
+    _run_with_store(test, loader, monkeypatch)
+
+
+def test_loop_not_blocked(config_paths, monkeypatch):
+    # Other clients are answered while the config loads, and wait for the same load
+    loader = FakeLoader(["config"])
+    loader.release.clear()
+
+    async def test(store, changes):
+        first = asyncio.ensure_future(store.refresh())
+        second = asyncio.ensure_future(store.refresh())
+        await asyncio.sleep(0.05)
+        assert not first.done()
+
+        loader.release.set()
+        await asyncio.gather(first, second)
+        assert store.get() == "config"
+        assert len(loader.threads) == 1
+
+    _run_with_store(test, loader, monkeypatch)
+
+
+def test_change_during_load(config_paths, monkeypatch):
+    # The outdated load isn't kept
+    loader = FakeLoader(["before", "after"])
+    loader.release.clear()
+
+    async def test(store, changes):
+        refresh = asyncio.ensure_future(store.refresh())
+        await asyncio.sleep(0.05)
+        config_paths.write_text("[optimus]\nswitching=none\n")
+        await _wait_for_change(changes)
+
+        loader.release.set()
+        await refresh
+        assert store.get() == "after"
+
+    _run_with_store(test, loader, monkeypatch)
+
+
+def test_load_error(config_paths, monkeypatch):
+    loader = FakeLoader([ConfigError("Invalid value for switching"), "fixed"])
+
+    async def test(store, changes):
+        await store.refresh()
+
+        with pytest.raises(ConfigError, match="Invalid value"):
+            store.get()
+
+        config_paths.write_text("[optimus]\nswitching=none\n")
+        await _wait_for_change(changes)
+        await store.refresh()
+        assert store.get() == "fixed"
+
+    _run_with_store(test, loader, monkeypatch)
+
+
+def test_not_watching(config_paths, monkeypatch):
+    # Loaded again for every request
+    loader = FakeLoader(["first", "second"])
+
+    async def test(store, changes):
+        await store.refresh()
+        assert store.get() == "first"
+        await store.refresh()
+        assert store.get() == "second"
+
+    _run_with_store(test, loader, monkeypatch, watching=False)
+
+
+def test_state_store(fake_vars):
+    store = daemon._StateStore()
+    assert store.get() is None
+
+    store.set({"type": "done", "current_mode": "integrated"})
+    assert store.get() == {"type": "done", "current_mode": "integrated"}
+
+    # Written by a hook
+    var.write_state({"type": "done", "current_mode": "nvidia"})
+    assert store.get() == {"type": "done", "current_mode": "nvidia"}
+
+
+def test_state_store_not_blocked_by_write(fake_vars, monkeypatch):
+    # Queries are answered from the previous state while a write is slow
+    store = daemon._StateStore()
+    store.set({"type": "done", "current_mode": "integrated"})
+    writing = threading.Event()
+    release = threading.Event()
+    write_state = var.write_state
+
+    def slow_write_state(state):
+        writing.set()
+        release.wait(5.0)
+        return write_state(state)
+
+    monkeypatch.setattr(var, "write_state", slow_write_state)
+    setting = threading.Thread(target=store.set, args=({"type": "done", "current_mode": "nvidia"},))
+    setting.start()
+    assert writing.wait(5.0)
+
+    assert store.get() == {"type": "done", "current_mode": "integrated"}
+    release.set()
+    setting.join()
+    assert store.get() == {"type": "done", "current_mode": "nvidia"}
+
+
+def test_requests(daemon_socket):
+    state = {"type": "done", "current_mode": "integrated"}
+    assert protocol.send_request({"type": "get_state", "args": {}}, daemon_socket) is None
+
+    var.write_state(state)
+    assert protocol.send_requests([
+        {"type": "get_state", "args": {}},
+        {"type": "get_status", "args": {}}
+    ], daemon_socket) == [state, {"state": state, "next_mode": None, "temp_config_path": None}]
+
+    protocol.send_request({"type": "switch", "args": {"mode": "nvidia"}}, daemon_socket)
+    assert protocol.send_request({"type": "get_status", "args": {}}, daemon_socket)["next_mode"] == "nvidia"
+
+    with pytest.raises(protocol.RequestError, match="Unknown command type: foo"):
+        protocol.send_request({"type": "foo", "args": {}}, daemon_socket)
+
+
+def test_stop_with_client_connected(daemon_paths):
+    # A client keeping its connection open doesn't hold up SIGTERM
+    def connect_and_stop():
+        wait_for_daemon(str(daemon_paths))
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(5.0)
+        client.connect(str(daemon_paths))
+        client.sendall(protocol.encode_message({"id": 1, "type": "get_state", "args": {}}))
+        messages, _ = protocol.decode_messages(client.recv(65536))
+        assert messages == [protocol.make_reply(1)]
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        return client
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        connecting = executor.submit(connect_and_stop)
+        asyncio.run(asyncio.wait_for(daemon._serve(daemon.get_logger()), 5.0))
+
+        with connecting.result() as client:
+            assert client.recv(1) == b""
+
+    assert not daemon_paths.exists()
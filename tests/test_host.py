@@ -0,0 +1,70 @@
+from optimus_manager import checks
+from optimus_manager import envs
+from optimus_manager import host
+from optimus_manager import var
+from optimus_manager.kernel_parameters import get_kernel_parameters
+
+
+def test_host_facts(fake_host):
+    facts = host.get_host_facts()
+
+    assert facts.boot_id == "8c2d2d4e-0000-4000-8000-000000000001"
+    assert "pat" in facts.cpu_flags
+    assert facts.kernel_parameters == {"startup_mode": None}
+    assert facts.dmi_fingerprint == "ASUSTeK COMPUTER INC.|ROG Strix G531GT|ASUSTeK COMPUTER INC.|G531GT|G531GT.304"
+
+
+def test_host_facts_once_per_boot(fake_host):
+    # Served from memory, then from the tmp vars folder in another process, until a reboot
+    fake_host.cmdline_path.write_text("root=/dev/nvme0n1p2 optimus-manager.startup=nvidia\n")
+    assert get_kernel_parameters() == {"startup_mode": "nvidia"}
+
+    fake_host.cmdline_path.write_text("root=/dev/nvme0n1p2 optimus-manager.startup=hybrid\n")
+    assert get_kernel_parameters() == {"startup_mode": "nvidia"}
+
+    host._host_facts = None
+    assert get_kernel_parameters() == {"startup_mode": "nvidia"}
+
+    fake_host.reboot()
+    assert get_kernel_parameters() == {"startup_mode": "hybrid"}
+    assert var.read_host_facts()["kernel_parameters"] == {"startup_mode": "hybrid"}
+
+
+def test_host_facts_outdated_file(fake_host):
+    # Written by an older version, with other fields
+    facts_dict = host.get_host_facts()._asdict()
+    var.write_host_facts(dict(facts_dict, kernel_release="6.9.1-arch1-1"))
+    host._host_facts = None
+
+    assert host.get_host_facts()._asdict() == facts_dict
+    assert var.read_host_facts() == facts_dict
+
+
+def test_kernel_parameters():
+    assert host._parse_kernel_parameters("quiet optimus-manager.startup=integrated splash") == \
+        {"startup_mode": "integrated"}
+    assert host._parse_kernel_parameters("optimus-manager.startup=intel") == {"startup_mode": None}
+    assert host._parse_kernel_parameters("optimus-manager.startup=bad optimus-manager.startup=auto") == \
+        {"startup_mode": "auto"}
+
+
+def test_cpu_flags_without_pat(fake_host):
+    fake_host.cpuinfo_path.write_text("processor\t: 0\nflags\t\t: fpu vme\nprocessor\t: 1\nflags\t\t: pat\n")
+    assert not checks.is_pat_available()
+
+
+def test_ac_power(fake_host):
+    fake_host.add_power_supply("BAT0", "Battery", online=1)
+    fake_host.add_power_supply("ACAD", "Mains", online=0)
+    host.get_host_facts()
+    assert not checks.is_ac_power_connected()
+
+    # Plugged in after the host facts were read
+    fake_host.add_power_supply("ucsi-source-psy-USBC000:001", "USB", online=0)
+    fake_host.add_power_supply("ucsi-source-psy-USBC000:002", "Mains", online=1)
+    assert checks.is_ac_power_connected()
+
+
+def test_ac_power_without_supplies(fake_host, monkeypatch):
+    monkeypatch.setattr(envs, "POWER_SUPPLY_PATH", str(fake_host.power_supply_path / "missing"))
+    assert not checks.is_ac_power_connected()
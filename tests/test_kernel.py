@@ -0,0 +1,320 @@
+import pytest
+from optimus_manager import envs
+from optimus_manager import kernel
+from optimus_manager import runner
+from optimus_manager import var
+from optimus_manager.pci import PciTopology
+from optimus_manager.plan import run_plan
+from tests.fakes import make_config
+
+
+class FakeClock:
+    # Stands in for the `time` module of `kernel`: sleeping only moves the clock forward.
+    # `on_sleep` is called after every sleep with the number of sleeps so far.
+
+    def __init__(self, on_sleep=None):
+        self.sleeps = []
+        self._now = 1000.0
+        self._on_sleep = on_sleep
+
+    def monotonic(self):
+        return self._now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self._now += duration
+
+        if self._on_sleep is not None:
+            self._on_sleep(len(self.sleeps))
+
+
+NVIDIA_UP_LOADS = [
+    ("module_load", "nvidia NVreg_DynamicPowerManagement=0x02"),
+    ("module_load", "nvidia_drm modeset=1")
+]
+
+
+@pytest.fixture
+def bbswitch(tmp_path, monkeypatch):
+    path = tmp_path / "bbswitch"
+    monkeypatch.setattr(envs, "BBSWITCH_PATH", str(path))
+    return path
+
+
+def _unloaded(fake_kernel):
+    return [call[1] for call in fake_kernel.calls if call[0] == "unload"]
+
+
+def _make_config(switching, dynamic_power_management="fine", **optimus):
+    return make_config(
+        optimus=dict(optimus, switching=switching),
+        nvidia={"pat": "no", "dynamic_power_management": dynamic_power_management})
+
+
+def _plan(config, current_mode, requested_mode):
+    plan = kernel.plan_kernel_setup(config, PciTopology(), current_mode, requested_mode)
+    return [(operation.kind, operation.description) for operation in plan]
+
+
+def test_load_order(pci_tree, fake_kernel):
+    config = make_config(optimus={"switching": "none"}, nvidia={"pat": "no", "dynamic_power_management": "no"})
+    run_plan(kernel.plan_kernel_setup(config, PciTopology(), "integrated", "nvidia"))
+
+    assert fake_kernel.calls == [("load", "nvidia", []), ("load", "nvidia_drm", ["modeset=1"])]
+    assert fake_kernel.is_loaded("nvidia_modeset")
+
+
+def test_load_options(pci_tree, fake_kernel):
+    config = make_config(optimus={"switching": "none"}, nvidia={"pat": "no", "modeset": "no"})
+    run_plan(kernel.plan_kernel_setup(config, PciTopology(), "integrated", "hybrid"))
+
+    assert fake_kernel.calls == [
+        ("load", "nvidia", ["NVreg_DynamicPowerManagement=0x02"]),
+        ("load", "nvidia_drm", [])
+    ]
+
+
+def test_load_not_installed(fake_kernel):
+    with pytest.raises(kernel.KernelSetupError, match="not installed"):
+        kernel._load_module(["nvidia"], "nvidia_drm")
+
+    assert fake_kernel.calls == []
+
+
+def test_unload_order(fake_kernel):
+    # Holders first, so that every module is unused when its turn comes
+    fake_kernel.insert("nvidia_drm")
+    fake_kernel.insert("nvidia_uvm")
+    kernel._unload_modules(kernel.MODULES, kernel.NVIDIA_MODULES)
+
+    assert _unloaded(fake_kernel) == ["nvidia_drm", "nvidia_modeset", "nvidia_uvm", "nvidia"]
+    assert not any(fake_kernel.is_loaded(module) for module in kernel.NVIDIA_MODULES)
+
+
+def test_unload_only_loaded(fake_kernel):
+    fake_kernel.insert("nvidia_modeset")
+    kernel._unload_modules(kernel.MODULES, kernel.NVIDIA_MODULES)
+
+    assert _unloaded(fake_kernel) == ["nvidia_modeset", "nvidia"]
+
+
+def test_unload_only_available(fake_kernel):
+    fake_kernel.insert("nvidia_drm")
+    kernel._unload_modules(["nvidia_drm"], kernel.NVIDIA_MODULES)
+
+    assert _unloaded(fake_kernel) == ["nvidia_drm"]
+
+
+def test_unload_waits_for_refcount(fake_kernel, monkeypatch):
+    # Polled fast, then backing off until the card is released
+    fake_kernel.insert("nvidia")
+    fake_kernel.hold("nvidia")
+
+    def release_after_three(count):
+        if count == 3:
+            fake_kernel.release("nvidia")
+
+    clock = FakeClock(release_after_three)
+    monkeypatch.setattr(kernel, "time", clock)
+    kernel._unload_modules(kernel.MODULES, ["nvidia"])
+
+    assert clock.sleeps == [0.01, 0.02, 0.04]
+    assert fake_kernel.calls == [("unload", "nvidia")]
+
+
+def test_unload_backoff_capped(fake_kernel, monkeypatch):
+    monkeypatch.setattr(envs, "MODULES_UNLOAD_MAX_POLL_PERIOD", 0.03)
+    fake_kernel.insert("nvidia")
+    fake_kernel.hold("nvidia")
+
+    def release_after_five(count):
+        if count == 5:
+            fake_kernel.release("nvidia")
+
+    clock = FakeClock(release_after_five)
+    monkeypatch.setattr(kernel, "time", clock)
+    kernel._unload_modules(kernel.MODULES, ["nvidia"])
+
+    assert clock.sleeps == [0.01, 0.02, 0.03, 0.03, 0.03]
+    assert not fake_kernel.is_loaded("nvidia")
+
+
+def test_unload_timeout(fake_kernel, monkeypatch):
+    fake_kernel.insert("nvidia")
+    fake_kernel.hold("nvidia")
+    clock = FakeClock()
+    monkeypatch.setattr(kernel, "time", clock)
+
+    with pytest.raises(kernel.KernelSetupError, match="refcount 1, held by: nothing"):
+        kernel._unload_modules(kernel.MODULES, ["nvidia"])
+
+    assert sum(clock.sleeps) == pytest.approx(envs.MODULES_UNLOAD_TIMEOUT)
+    assert max(clock.sleeps) == envs.MODULES_UNLOAD_MAX_POLL_PERIOD
+    assert fake_kernel.calls == []
+
+
+def test_unload_switch_deadline(fake_kernel, monkeypatch):
+    # Less left of the switch budget than the unload timeout: reported as the step that overran
+    fake_kernel.insert("nvidia")
+    fake_kernel.hold("nvidia")
+    clock = FakeClock()
+    monkeypatch.setattr(kernel, "time", clock)
+    monkeypatch.setattr(runner, "_deadline", runner.time.monotonic() + 0.5)
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        kernel._unload_modules(kernel.MODULES, ["nvidia"])
+
+    assert excinfo.value.step == "unload nvidia"
+    assert sum(clock.sleeps) == pytest.approx(0.5, abs=0.01)
+
+
+def test_unload_held_by_module(fake_kernel, monkeypatch):
+    # Out of order: nvidia is still used by nvidia_modeset
+    fake_kernel.insert("nvidia_modeset")
+    monkeypatch.setattr(kernel, "time", FakeClock())
+
+    with pytest.raises(kernel.KernelSetupError, match="held by: nvidia_modeset"):
+        kernel._unload_modules(kernel.MODULES, ["nvidia"])
+
+
+def test_unload_builtin(fake_kernel):
+    fake_kernel.set_builtin("nouveau")
+
+    with pytest.raises(kernel.KernelSetupError, match="built into the kernel"):
+        kernel._unload_modules(kernel.MODULES, ["nouveau"])
+
+    assert fake_kernel.calls == []
+
+
+def test_plan_up_unloaded(pci_tree, fake_kernel):
+    pci_tree.write_attribute("0000:01:00.0", "power/control", "auto")
+    config = _make_config("none", pci_reset="function_level")
+
+    assert _plan(config, "integrated", "nvidia") == [
+        ("pci_reset", "function_level"),
+        ("sysfs_write", "Nvidia power/control = on")
+    ] + NVIDIA_UP_LOADS
+
+
+def test_plan_up_unloads_nouveau(pci_tree, fake_kernel):
+    fake_kernel.insert("nouveau")
+    config = _make_config("nouveau")
+
+    assert _plan(config, "integrated", "nvidia") == [("module_unload", "nouveau")] + NVIDIA_UP_LOADS
+
+
+def test_plan_up_already_loaded(pci_tree, fake_kernel):
+    # No PCI reset under the loaded modules
+    fake_kernel.insert("nvidia_drm")
+    pci_tree.write_attribute("0000:01:00.0", "power/control", "auto")
+    config = _make_config("none", pci_reset="hot_reset")
+
+    assert _plan(config, "integrated", "hybrid") == []
+    assert _plan(config, None, "nvidia") == [("sysfs_write", "Nvidia power/control = on")]
+
+
+def test_plan_up_partly_loaded(pci_tree, fake_kernel):
+    # nvidia_drm missing: both are loaded, the loaded one is skipped when run
+    fake_kernel.insert("nvidia")
+    config = _make_config("none", pci_reset="function_level")
+
+    assert _plan(config, "integrated", "nvidia") == [("pci_reset", "function_level")] + NVIDIA_UP_LOADS
+
+
+def test_plan_up_powered_on(pci_tree, fake_kernel, bbswitch):
+    fake_kernel.insert("bbswitch")
+    fake_kernel.insert("nvidia_drm")
+    bbswitch.write_text("0000:01:00.0 ON\n")
+
+    assert _plan(_make_config("bbswitch"), "integrated", "nvidia") == []
+
+
+def test_plan_up_powered_off_bbswitch(pci_tree, fake_kernel, bbswitch):
+    # Powered off and removed from the bus
+    fake_kernel.insert("bbswitch")
+    bbswitch.write_text("0000:01:00.0 OFF\n")
+    pci_tree.remove_device("0000:01:00.0")
+    config = _make_config("bbswitch", pci_reset="hot_reset")
+
+    assert _plan(config, "integrated", "nvidia") == [
+        ("sysfs_write", "%s = ON" % envs.BBSWITCH_PATH),
+        ("pci_rescan", "Bring Nvidia back into the PCI bus"),
+        ("pci_reset", "hot_reset"),
+        ("sysfs_write", "Nvidia power/control = on")
+    ] + NVIDIA_UP_LOADS
+
+
+def test_plan_up_powered_off_acpi_call(pci_tree, fake_kernel):
+    var.write_last_acpi_call_state("OFF")
+    config = _make_config("acpi_call")
+
+    assert _plan(config, "integrated", "hybrid") == [
+        ("module_load", "acpi_call"),
+        ("acpi_call", "Nvidia power ON"),
+        ("sysfs_write", "Nvidia power/control = auto")
+    ] + NVIDIA_UP_LOADS
+
+
+def test_plan_up_builtin_nouveau(pci_tree, fake_kernel):
+    # Can't be unloaded: loading nvidia fails later if nouveau holds the card
+    fake_kernel.set_builtin("nouveau")
+
+    assert _plan(_make_config("nouveau"), "integrated", "nvidia") == NVIDIA_UP_LOADS
+
+
+def test_plan_down_loaded(pci_tree, fake_kernel, bbswitch):
+    fake_kernel.insert("bbswitch")
+    fake_kernel.insert("nvidia_drm")
+    fake_kernel.insert("nvidia_uvm")
+    bbswitch.write_text("0000:01:00.0 ON\n")
+
+    assert _plan(_make_config("bbswitch"), "nvidia", "integrated") == [
+        ("module_unload", "nvidia_drm nvidia_modeset nvidia_uvm nvidia"),
+        ("sysfs_write", "%s = OFF" % envs.BBSWITCH_PATH)
+    ]
+
+
+def test_plan_down_unloaded(pci_tree, fake_kernel):
+    config = _make_config("none")
+    assert _plan(config, "hybrid", "integrated") == [("sysfs_write", "Nvidia power/control = auto")]
+
+    pci_tree.write_attribute("0000:01:00.0", "power/control", "auto")
+    assert _plan(config, "hybrid", "integrated") == []
+
+
+def test_plan_down_powered_off(pci_tree, fake_kernel, bbswitch):
+    fake_kernel.insert("bbswitch")
+    bbswitch.write_text("0000:01:00.0 OFF\n")
+
+    assert _plan(_make_config("bbswitch"), "nvidia", "integrated") == []
+
+
+def test_plan_down_already_removed(pci_tree, fake_kernel):
+    config = _make_config("none", pci_remove="yes")
+    assert _plan(config, "nvidia", "integrated") == [("pci_remove", "Nvidia remove = 1")]
+
+    pci_tree.remove_device("0000:01:00.0")
+    assert _plan(config, "nvidia", "integrated") == []
+
+
+def test_plan_down_loads_nouveau(pci_tree, fake_kernel):
+    fake_kernel.insert("nvidia_drm")
+    config = _make_config("nouveau", dynamic_power_management="no")
+
+    assert _plan(config, "nvidia", "integrated") == [
+        ("module_unload", "nvidia_drm nvidia_modeset nvidia"),
+        ("module_load", "nouveau modeset=1")
+    ]
+
+
+def test_plan_down_builtin_nouveau(pci_tree, fake_kernel):
+    fake_kernel.insert("nvidia_drm")
+    fake_kernel.set_builtin("nouveau")
+    config = _make_config("nouveau", dynamic_power_management="no")
+
+    assert _plan(config, "nvidia", "integrated") == [("module_unload", "nvidia_drm nvidia_modeset nvidia")]
+
+
+def test_plan_same_mode(pci_tree, fake_kernel):
+    assert _plan(_make_config("none"), "hybrid", "nvidia") == []
+    assert _plan(_make_config("none"), "integrated", "integrated") == []
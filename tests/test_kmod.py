@@ -0,0 +1,208 @@
+import os
+import pytest
+from optimus_manager import envs
+from optimus_manager import kmod
+from optimus_manager.kmod import LoadedModule
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def module_fixtures(monkeypatch):
+    # Loaded Nvidia modules, bbswitch loading, acpi_call unloading, nouveau built-in with parameters
+    monkeypatch.setattr(envs, "PROC_MODULES_PATH", os.path.join(FIXTURES_PATH, "proc_modules"))
+    monkeypatch.setattr(envs, "SYS_MODULES_PATH", os.path.join(FIXTURES_PATH, "sys_module"))
+
+
+def test_parse_proc_modules_line():
+    line = "nvidia 56455168 3 nvidia_uvm,nvidia_modeset, Live 0xffffffffc1c4e000 (POE)\n"
+
+    assert kmod._parse_proc_modules_line(line) == LoadedModule(
+        name="nvidia", size=56455168, refcount=3, holders=["nvidia_uvm", "nvidia_modeset"],
+        state="Live", address=0xffffffffc1c4e000)
+
+
+def test_parse_proc_modules_line_no_holders():
+    module = kmod._parse_proc_modules_line("nvidia_drm 77824 2 - Live 0x0000000000000000 (POE)")
+
+    assert module.holders == []
+    assert module.refcount == 2
+    assert module.address == 0
+
+
+def test_parse_proc_modules_line_no_refcount():
+    # Modules that can't be unloaded
+    module = kmod._parse_proc_modules_line("vboxdrv 593920 - - Live 0xffffffffc0b00000 (OE)")
+
+    assert module.refcount == 0
+    assert module.holders == []
+
+
+def test_parse_proc_modules_line_not_tainted():
+    module = kmod._parse_proc_modules_line("i915 3403776 42 - Live 0xffffffffc0d8d000")
+
+    assert module.refcount == 42
+    assert module.address == 0xffffffffc0d8d000
+
+
+def test_parse_proc_modules_line_transient_states():
+    assert kmod._parse_proc_modules_line("bbswitch 16384 0 - Loading 0xffffffffc0a1e000 (OE)").state == "Loading"
+    assert kmod._parse_proc_modules_line("acpi_call 16384 0 - Unloading 0xffffffffc0a19000 (OE)").state == "Unloading"
+
+
+def test_read_module_state(module_fixtures):
+    module_state = kmod.read_module_state()
+
+    assert len(module_state.loaded_modules) == 9
+    assert module_state.loaded_modules["nvidia_modeset"].holders == ["nvidia_drm"]
+    assert module_state.loaded_modules["drm_kms_helper"].holders == ["nvidia_drm", "i915"]
+
+
+def test_read_module_state_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(envs, "PROC_MODULES_PATH", str(tmp_path / "modules"))
+
+    with pytest.raises(kmod.KmodError):
+        kmod.read_module_state()
+
+
+def test_is_loaded(module_fixtures):
+    module_state = kmod.read_module_state()
+
+    assert module_state.is_loaded("nvidia")
+    assert module_state.is_loaded("nvidia-drm")
+    assert module_state.is_loaded("vboxdrv")
+    assert not module_state.is_loaded("bbswitch")
+    assert not module_state.is_loaded("acpi_call")
+    assert not module_state.is_loaded("nvidia_peermem")
+
+
+def test_is_loaded_builtin(module_fixtures):
+    # Only shows in `/sys/module`, without an `initstate`
+    module_state = kmod.read_module_state()
+
+    assert "nouveau" not in module_state.loaded_modules
+    assert module_state.is_loaded("nouveau")
+    assert module_state.is_builtin("nouveau")
+    assert not module_state.is_builtin("nvidia")
+    assert not module_state.is_builtin("bbswitch")
+    assert not module_state.is_builtin("nvidia_peermem")
+
+
+def test_refcount_and_holders(module_fixtures):
+    module_state = kmod.read_module_state()
+
+    assert module_state.get_refcount("nvidia") == 3
+    assert module_state.get_refcount("nouveau") == 0
+    assert module_state.get_holders("nvidia") == ["nvidia_uvm", "nvidia_modeset"]
+    assert module_state.get_holders("nvidia_drm") == []
+
+
+def test_read_module_refcount(module_fixtures):
+    assert kmod.read_module_refcount("nvidia") == 3
+    assert kmod.read_module_refcount("nvidia-uvm") == 0
+    assert kmod.read_module_refcount("nouveau") is None
+    assert kmod.read_module_refcount("nvidia_peermem") is None
+
+
+def test_read_module_holders(module_fixtures):
+    assert kmod.read_module_holders("nvidia") == ["nvidia_modeset", "nvidia_uvm"]
+    assert kmod.read_module_holders("nvidia_uvm") == []
+
+
+def _release_path(fake_kernel):
+    return fake_kernel.kernel_modules_path / os.uname().release
+
+
+def _touch_later(path, seconds=1):
+    # Like a depmod run after the index was cached, whatever the mtime granularity
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_parse_module_index(fake_kernel):
+    (_release_path(fake_kernel) / "modules.alias").write_text(
+        "# Aliases extracted from modules themselves.\n"
+        "alias pci:v000010DEd*sv*sd*bc03sc02i00* nvidia\n"
+        "alias char-major-195-* nvidia\n"
+        "alias nvidia-current nvidia\n"
+        "alias devname:nvidia-uvm nvidia-uvm\n"
+        "alias nvidia_current_drm nvidia-drm\n")
+
+    index = kmod._parse_module_index(str(_release_path(fake_kernel)))
+
+    assert "nvidia_drm" in index.modules
+    assert index.aliases == {
+        "nvidia_current": "nvidia",
+        "devname:nvidia_uvm": "nvidia_uvm",
+        "nvidia_current_drm": "nvidia_drm"
+    }
+
+    assert index.is_available("nvidia-current")
+    assert index.is_available("nvidia-current-drm")
+    assert not index.is_available("char-major-195-0")
+
+
+def test_parse_module_index_builtin(fake_kernel):
+    fake_kernel.set_builtin("nouveau")
+    index = kmod._parse_module_index(str(_release_path(fake_kernel)))
+
+    assert "nouveau" not in index.modules
+    assert index.is_available("nouveau")
+
+
+def test_parse_module_index_missing(tmp_path):
+    with pytest.raises(kmod.KmodError, match="Run depmod"):
+        kmod._parse_module_index(str(tmp_path))
+
+
+def test_module_index_cached(fake_kernel, monkeypatch):
+    assert kmod.load_module_index().is_available("bbswitch")
+    assert os.path.isfile(envs.MODULE_INDEX_CACHE_PATH)
+
+    def fail(modules_dir_path):
+        raise AssertionError("Parsed again")
+
+    monkeypatch.setattr(kmod, "_parse_module_index", fail)
+    assert kmod.load_module_index().is_available("bbswitch")
+
+
+def test_module_index_rebuilt_after_depmod(fake_kernel):
+    # DKMS builds a module for the running kernel
+    assert not kmod.load_module_index().is_available("nvidia_peermem")
+
+    dep_path = _release_path(fake_kernel) / "modules.dep"
+    dep_path.write_text(dep_path.read_text() + "updates/dkms/nvidia-peermem.ko.zst: kernel/drivers/nvidia.ko.zst\n")
+    _touch_later(dep_path)
+
+    assert kmod.load_module_index().is_available("nvidia_peermem")
+
+
+def test_module_index_rebuilt_after_alias_change(fake_kernel):
+    alias_path = _release_path(fake_kernel) / "modules.alias"
+    alias_path.write_text("")
+    assert not kmod.load_module_index().is_available("nvidia-current")
+
+    alias_path.write_text("alias nvidia-current nvidia\n")
+    _touch_later(alias_path)
+
+    assert kmod.load_module_index().is_available("nvidia-current")
+
+
+def test_module_index_per_release(fake_kernel):
+    # Cached for one kernel release at a time
+    other_path = fake_kernel.kernel_modules_path / "6.1.0-lts"
+    other_path.mkdir()
+    (other_path / "modules.dep").write_text("kernel/drivers/nouveau.ko.zst:\n")
+
+    assert kmod.load_module_index().is_available("bbswitch")
+    assert not kmod.load_module_index("6.1.0-lts").is_available("bbswitch")
+    assert kmod.load_module_index().is_available("bbswitch")
+
+
+def test_module_index_invalid_cache(fake_kernel):
+    os.makedirs(os.path.dirname(envs.MODULE_INDEX_CACHE_PATH), exist_ok=True)
+
+    with open(envs.MODULE_INDEX_CACHE_PATH, "w") as cachefile:
+        cachefile.write("{\"key\": [")
+
+    assert kmod.load_module_index().is_available("bbswitch")
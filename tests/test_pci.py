@@ -0,0 +1,382 @@
+import os
+import threading
+import time
+import pytest
+from optimus_manager import envs
+from optimus_manager import pci
+from optimus_manager import runner
+from optimus_manager.pci import PciConfigSpace, PciTopology
+from tests.fakes import FakePciTree
+
+# Where the fake bridge has its PCI Express capability
+EXP_CAP_OFFSET = 0x50
+
+NVIDIA_ADD_EVENT = {"ACTION": "add", "SUBSYSTEM": "pci", "PCI_ID": "10DE:1F91"}
+USB_ADD_EVENT = {"ACTION": "add", "SUBSYSTEM": "usb"}
+
+
+class FakeDeviceMonitor:
+    # Stands in for the uevent, inotify and polling monitors. `steps` are run in turn,
+    # one per `wait`: each is called, then what it returns is returned as the events.
+    # Without steps left, `wait` waits the whole timeout for nothing.
+
+    def __init__(self, steps=()):
+        self.timeouts = []
+        self._steps = list(steps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+
+        if self._steps:
+            return self._steps.pop(0)()
+
+        time.sleep(timeout)
+        return []
+
+
+def _make_config_space(tmp_path, registers, size=4096):
+    # A regular file standing in for `/sys/bus/pci/devices/<bus ID>/config`.
+    # `registers` maps offsets to `(value, size)`.
+    path = tmp_path / "config"
+    data = bytearray(size)
+
+    for offset, (value, value_size) in registers.items():
+        data[offset:offset + value_size] = value.to_bytes(value_size, "little")
+
+    path.write_bytes(bytes(data))
+    return str(path)
+
+
+def _read_register(path, offset, size):
+    with open(path, "rb") as configfile:
+        configfile.seek(offset)
+        return int.from_bytes(configfile.read(size), "little")
+
+
+def _make_bridge(tmp_path, link_active, link_reporting=True):
+    # Capability list: power management at 0x40, then PCI Express
+    return _make_config_space(tmp_path, {
+        pci.PCI_STATUS: (pci.PCI_STATUS_CAP_LIST, 2),
+        pci.PCI_CAPABILITY_LIST: (0x40, 1),
+        0x40: (0x01, 1),
+        0x41: (EXP_CAP_OFFSET, 1),
+        EXP_CAP_OFFSET: (pci.PCI_CAP_ID_EXP, 1),
+        EXP_CAP_OFFSET + 1: (0x00, 1),
+        EXP_CAP_OFFSET + pci.PCI_EXP_LNKCAP: (pci.PCI_EXP_LNKCAP_DLLLARC if link_reporting else 0, 4),
+        EXP_CAP_OFFSET + pci.PCI_EXP_LNKSTA: (pci.PCI_EXP_LNKSTA_DLLLA if link_active else 0, 2)
+    })
+
+
+def test_read_little_endian(tmp_path):
+    path = _make_config_space(tmp_path, {0x10: (0x12345678, 4)})
+
+    with PciConfigSpace(path) as config_space:
+        assert config_space.read(0x10) == 0x12345678
+        assert config_space.read(0x10, 2) == 0x5678
+        assert config_space.read(0x13, 1) == 0x12
+
+
+def test_read_past_end(tmp_path):
+    path = _make_config_space(tmp_path, {}, size=256)
+
+    with PciConfigSpace(path) as config_space:
+        with pytest.raises(OSError):
+            config_space.read(0xfe, 4)
+
+
+def test_write_masked_sets_hot_reset_bit(tmp_path):
+    path = _make_config_space(tmp_path, {pci.HOT_RESET_REGISTER: (0x00400013, 4)})
+
+    with PciConfigSpace(path) as config_space:
+        config_space.write_masked(pci.HOT_RESET_REGISTER, pci.HOT_RESET_MASK, pci.HOT_RESET_MASK, size=4)
+
+    assert _read_register(path, pci.HOT_RESET_REGISTER, 4) == 0x00400013 | pci.HOT_RESET_MASK
+
+
+def test_write_masked_clears_only_masked_bits(tmp_path):
+    path = _make_config_space(tmp_path, {
+        pci.HOT_RESET_REGISTER - 4: (0xffffffff, 4),
+        pci.HOT_RESET_REGISTER: (0xffffffff, 4),
+        pci.HOT_RESET_REGISTER + 4: (0xffffffff, 4)
+    })
+
+    with PciConfigSpace(path) as config_space:
+        config_space.write_masked(pci.HOT_RESET_REGISTER, 0, pci.HOT_RESET_MASK, size=4)
+
+    assert _read_register(path, pci.HOT_RESET_REGISTER, 4) == 0xffffffff & ~pci.HOT_RESET_MASK
+    assert _read_register(path, pci.HOT_RESET_REGISTER - 4, 4) == 0xffffffff
+    assert _read_register(path, pci.HOT_RESET_REGISTER + 4, 4) == 0xffffffff
+
+
+def test_find_capability(tmp_path):
+    path = _make_bridge(tmp_path, link_active=True)
+
+    with PciConfigSpace(path) as config_space:
+        assert config_space.find_capability(pci.PCI_CAP_ID_EXP) == EXP_CAP_OFFSET
+        assert config_space.find_capability(0x05) is None
+
+
+def test_find_capability_without_list(tmp_path):
+    path = _make_config_space(tmp_path, {pci.PCI_CAPABILITY_LIST: (0x40, 1), 0x40: (pci.PCI_CAP_ID_EXP, 1)})
+
+    with PciConfigSpace(path) as config_space:
+        assert config_space.find_capability(pci.PCI_CAP_ID_EXP) is None
+
+
+def test_find_capability_looping_list(tmp_path):
+    path = _make_config_space(tmp_path, {
+        pci.PCI_STATUS: (pci.PCI_STATUS_CAP_LIST, 2),
+        pci.PCI_CAPABILITY_LIST: (0x40, 1),
+        0x40: (0x01, 1),
+        0x41: (0x40, 1)
+    })
+
+    with PciConfigSpace(path) as config_space:
+        assert config_space.find_capability(pci.PCI_CAP_ID_EXP) is None
+
+
+def _set_link_later(path, steps):
+    # Starts a thread writing the Data Link Layer Link Active bit of the fake bridge:
+    # `steps` are `(delay, active)`, run in turn
+    lnksta_offset = EXP_CAP_OFFSET + pci.PCI_EXP_LNKSTA
+
+    def set_link():
+        for delay, active in steps:
+            time.sleep(delay)
+            fd = os.open(path, os.O_WRONLY)
+
+            try:
+                os.pwrite(fd, (pci.PCI_EXP_LNKSTA_DLLLA if active else 0).to_bytes(2, "little"), lnksta_offset)
+
+            finally:
+                os.close(fd)
+
+    thread = threading.Thread(target=set_link)
+    thread.start()
+    return thread
+
+
+def test_wait_for_link_down_and_up(tmp_path):
+    # Not taken as back before it went down
+    path = _make_bridge(tmp_path, link_active=True)
+    thread = _set_link_later(path, [(0.02, False), (0.05, True)])
+
+    try:
+        with PciConfigSpace(path) as config_space:
+            link_time = pci._wait_for_link(config_space, 5.0)
+
+    finally:
+        thread.join()
+
+    assert 0.07 <= link_time < 5.0
+
+
+def test_wait_for_link_already_down(tmp_path):
+    path = _make_bridge(tmp_path, link_active=False)
+    thread = _set_link_later(path, [(0.05, True)])
+
+    try:
+        with PciConfigSpace(path) as config_space:
+            link_time = pci._wait_for_link(config_space, 5.0)
+
+    finally:
+        thread.join()
+
+    assert 0.05 <= link_time < 5.0
+
+
+def test_wait_for_link_never_down(tmp_path, monkeypatch):
+    # The reset didn't take: bounded wait, no link time
+    monkeypatch.setattr(envs, "PCI_LINK_DOWN_WAIT_TIMEOUT", 0.03)
+    path = _make_bridge(tmp_path, link_active=True)
+    start_time = time.monotonic()
+
+    with PciConfigSpace(path) as config_space:
+        assert pci._wait_for_link(config_space, 5.0) is None
+
+    assert 0.03 <= time.monotonic() - start_time < 1.0
+
+
+def test_wait_for_link_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(envs, "PCI_LINK_WAIT_PERIOD", 0.001)
+    path = _make_bridge(tmp_path, link_active=False)
+
+    with PciConfigSpace(path) as config_space:
+        with pytest.raises(pci.PCIError, match="still down"):
+            pci._wait_for_link(config_space, 0.02)
+
+
+def test_wait_for_link_switch_deadline(tmp_path, monkeypatch):
+    monkeypatch.setattr(envs, "PCI_LINK_WAIT_PERIOD", 0.001)
+    monkeypatch.setattr(runner, "_deadline", time.monotonic() + 0.05)
+    path = _make_bridge(tmp_path, link_active=False)
+
+    with PciConfigSpace(path) as config_space:
+        with pytest.raises(runner.DeadlineError) as excinfo:
+            pci._wait_for_link(config_space, 5.0)
+
+    assert excinfo.value.step == "wait for the PCI bridge link"
+
+
+def test_wait_for_link_unsupported(tmp_path):
+    path = _make_bridge(tmp_path, link_active=False, link_reporting=False)
+
+    with PciConfigSpace(path) as config_space:
+        assert pci._wait_for_link(config_space, 0.02) is None
+
+
+def test_topology(pci_tree):
+    topology = PciTopology()
+
+    assert topology.get_gpus_bus_ids() == {"nvidia": "PCI:1:0:0", "intel": "PCI:0:2:0"}
+    assert topology.get_gpus_bus_ids(notation_fix=False) == {"nvidia": "0000:01:00.0", "intel": "0000:00:02.0"}
+    assert topology.get_nvidia_functions() == ["0000:01:00.0", "0000:01:00.1"]
+    assert topology.get_nvidia_bridges() == ["0000:00:01.0"]
+    assert topology.enumerations_count == 1
+
+
+def test_topology_other_domain(tmp_path, monkeypatch):
+    # Behind a second host bridge, with a device of the same bus number in domain 0
+    tree = FakePciTree(tmp_path / "sys")
+    tree.add_device("0000:00:02.0", "030000", "8086", "3e9b")
+    tree.add_device("0000:00:1c.0", "060400", "8086")
+    tree.add_device("0000:01:00.0", "020000", "8086", "15f3", parent="0000:00:1c.0")
+    tree.add_device("0001:00:01.0", "060400", "8086")
+    tree.add_device("0001:01:00.0", "030200", "10de", "20b0", parent="0001:00:01.0")
+    tree.add_device("0001:01:00.1", "040300", "10de", "1aef", parent="0001:00:01.0")
+    monkeypatch.setattr(envs, "PCI_DEVICES_PATH", str(tree.devices_path))
+    topology = PciTopology()
+
+    assert topology.get_gpus_bus_ids() == {"nvidia": "PCI:1@1:0:0", "intel": "PCI:0:2:0"}
+    assert topology.get_nvidia_functions() == ["0001:01:00.0", "0001:01:00.1"]
+    assert topology.get_nvidia_bridges() == ["0001:00:01.0"]
+
+
+def test_hot_reset_behind_switch(tmp_path, monkeypatch):
+    # Root port, then the upstream and a downstream port of a PCIe switch:
+    # only the downstream port the card is plugged in is reset
+    tree = FakePciTree(tmp_path / "sys")
+    tree.add_device("0000:00:02.0", "030000", "8086", "3e9b")
+    tree.add_device("0000:00:01.0", "060400", "8086")
+    tree.add_device("0000:01:00.0", "060400", "10b5", parent="0000:00:01.0")
+    tree.add_device("0000:02:00.0", "060400", "10b5", parent="0000:01:00.0")
+    tree.add_device("0000:02:01.0", "060400", "10b5", parent="0000:01:00.0")
+    tree.add_device("0000:03:00.0", "030000", "10de", "1f91", parent="0000:02:00.0")
+    tree.add_device("0000:03:00.1", "040300", "10de", "10fa", parent="0000:02:00.0")
+    monkeypatch.setattr(envs, "PCI_DEVICES_PATH", str(tree.devices_path))
+    monkeypatch.setattr(envs, "PCI_RESCAN_PATH", str(tree.rescan_path))
+    monkeypatch.setattr(pci, "open_device_monitor", lambda path: FakeDeviceMonitor())
+
+    bridges = ["0000:00:01.0", "0000:01:00.0", "0000:02:00.0", "0000:02:01.0"]
+    config_paths = {bridge: tree.write_config(bridge, bytes(4096)) for bridge in bridges}
+    topology = PciTopology()
+
+    assert topology.get_nvidia_bridges() == ["0000:00:01.0", "0000:01:00.0", "0000:02:00.0"]
+
+    pci.hot_reset_nvidia(topology)
+
+    assert {
+        bridge: _read_register(config_path, pci.HOT_RESET_REGISTER, 4)
+        for bridge, config_path in config_paths.items()
+    } == {"0000:00:01.0": 0, "0000:01:00.0": 0, "0000:02:00.0": pci.HOT_RESET_MASK, "0000:02:01.0": 0}
+
+    assert tree.read_attribute("0000:03:00.0", "remove") == "1"
+    assert tree.read_attribute("0000:03:00.1", "remove") == "1"
+
+
+def test_hot_reset_without_bridge(pci_tree):
+    pci_tree.remove_device("0000:01:00.0")
+    pci_tree.add_device("0000:00:03.0", "030000", "10de", "1f91")
+
+    with pytest.raises(pci.PCIError, match="Unable to find the PCI bridge"):
+        pci.hot_reset_nvidia(PciTopology())
+
+
+def test_to_xorg_bus_id():
+    assert pci._to_xorg_bus_id("0000:3c:00.0") == "PCI:60:0:0"
+    assert pci._to_xorg_bus_id("0000:01:1f.7") == "PCI:1:31:7"
+    assert pci._to_xorg_bus_id("0001:3c:00.0") == "PCI:60@1:0:0"
+    assert pci._to_xorg_bus_id("00a0:00:01.1") == "PCI:0@160:1:1"
+
+
+def test_wait_for_nvidia_already_visible(pci_tree):
+    monitor = FakeDeviceMonitor()
+    pci.wait_for_nvidia(PciTopology(), monitor, 1.0)
+    assert monitor.timeouts == []
+
+
+def test_wait_for_nvidia_event(pci_tree):
+    # Events of other devices don't make the bus enumerated again
+    pci_tree.remove_device("0000:01:00.0")
+
+    def nvidia_shows_up():
+        pci_tree.restore_device("0000:01:00.0")
+        return [NVIDIA_ADD_EVENT]
+
+    topology = PciTopology()
+    monitor = FakeDeviceMonitor([lambda: [USB_ADD_EVENT], nvidia_shows_up])
+    appear_time = pci.wait_for_nvidia(topology, monitor, 5.0)
+
+    assert appear_time < 5.0
+    assert len(monitor.timeouts) == 2
+    assert topology.enumerations_count == 2
+    assert pci.is_nvidia_visible(topology)
+
+
+def test_wait_for_nvidia_missed_event(pci_tree, monkeypatch):
+    # Found by polling the bus
+    monkeypatch.setattr(envs, "PCI_APPEAR_POLL_PERIOD", 0.01)
+    pci_tree.remove_device("0000:01:00.0")
+
+    def nvidia_shows_up_silently():
+        pci_tree.restore_device("0000:01:00.0")
+        return []
+
+    topology = PciTopology()
+    monitor = FakeDeviceMonitor([nvidia_shows_up_silently])
+    pci.wait_for_nvidia(topology, monitor, 5.0)
+
+    assert all(timeout <= 0.01 for timeout in monitor.timeouts)
+    assert pci.is_nvidia_visible(topology)
+
+
+def test_wait_for_nvidia_timeout(pci_tree, monkeypatch):
+    monkeypatch.setattr(envs, "PCI_APPEAR_POLL_PERIOD", 0.01)
+    pci_tree.remove_device("0000:01:00.0")
+    topology = PciTopology()
+    monitor = FakeDeviceMonitor([lambda: [USB_ADD_EVENT]])
+    start_time = time.monotonic()
+
+    with pytest.raises(pci.PCIError, match="not showing up"):
+        pci.wait_for_nvidia(topology, monitor, 0.05)
+
+    assert time.monotonic() - start_time >= 0.05
+    assert all(timeout <= 0.01 for timeout in monitor.timeouts)
+    assert topology.enumerations_count > 2
+
+
+def test_wait_for_nvidia_switch_deadline(pci_tree, monkeypatch):
+    monkeypatch.setattr(envs, "PCI_APPEAR_POLL_PERIOD", 0.01)
+    monkeypatch.setattr(runner, "_deadline", time.monotonic() + 0.05)
+    pci_tree.remove_device("0000:01:00.0")
+    start_time = time.monotonic()
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        pci.wait_for_nvidia(PciTopology(), FakeDeviceMonitor(), 5.0)
+
+    assert excinfo.value.step == "wait for Nvidia in PCI bus"
+    assert time.monotonic() - start_time < 1.0
+
+
+def test_may_be_nvidia_event():
+    assert pci._may_be_nvidia_event(NVIDIA_ADD_EVENT)
+    assert pci._may_be_nvidia_event({"ACTION": "add"})
+    assert not pci._may_be_nvidia_event(USB_ADD_EVENT)
+    assert not pci._may_be_nvidia_event(dict(NVIDIA_ADD_EVENT, ACTION="remove"))
+    assert not pci._may_be_nvidia_event(dict(NVIDIA_ADD_EVENT, PCI_ID="8086:3E9B"))
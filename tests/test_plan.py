@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+import pytest
+from optimus_manager import runner
+from optimus_manager import var
+from optimus_manager.plan import ResultOf, format_plan, load_latencies, make_operation, run_plan
+
+
+@pytest.fixture(autouse=True)
+def no_deadline(monkeypatch, fake_vars):
+    # Latencies are recorded under a tmp folder
+    monkeypatch.setattr(runner, "_deadline", None)
+
+
+class FakeOperations:
+    # Makes operations recording their calls, in the order they ran
+
+    def __init__(self):
+        self.calls = []
+
+    def make(self, kind, name, result=None, error=None, requires=None, args=()):
+        def func(*func_args):
+            self.calls.append((name,) + tuple(func_args))
+
+            if error is not None:
+                raise error
+
+            return result
+
+        return make_operation(kind, name, func, *args, requires=requires)
+
+
+def test_run_in_order():
+    operations = FakeOperations()
+
+    run_plan([
+        operations.make("module_unload", "nouveau"),
+        operations.make("sysfs_write", "power/control = on"),
+        operations.make("module_load", "nvidia")
+    ])
+
+    assert operations.calls == [("nouveau",), ("power/control = on",), ("nvidia",)]
+
+
+def test_run_result_of():
+    operations = FakeOperations()
+    enumerate_operation = operations.make("pci_enumerate", "bus IDs", result={"nvidia": "PCI:1:0:0"}, requires=[])
+    render_operation = operations.make(
+        "xorg_conf_render", "render", result="Section", args=[ResultOf(enumerate_operation), "nvidia"], requires=[])
+    write_operation = operations.make("xorg_conf_write", "write", args=[ResultOf(render_operation)], requires=[])
+
+    run_plan([enumerate_operation, render_operation, write_operation])
+
+    assert operations.calls == [
+        ("bus IDs",),
+        ("render", {"nvidia": "PCI:1:0:0"}, "nvidia"),
+        ("write", "Section")
+    ]
+
+
+def test_run_stops_after_failure():
+    operations = FakeOperations()
+
+    with pytest.raises(runner.CommandError, match="modprobe"):
+        run_plan([
+            operations.make("module_unload", "nouveau"),
+            operations.make("module_load", "nvidia", error=runner.CommandError(["modprobe", "nvidia"], 1, "")),
+            operations.make("module_load", "nvidia_drm")
+        ])
+
+    assert operations.calls == [("nouveau",), ("nvidia",)]
+
+
+def test_run_deadline_passed(monkeypatch):
+    # Not even started
+    operations = FakeOperations()
+    monkeypatch.setattr(runner, "_deadline", 0.0)
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        run_plan([operations.make("module_load", "nvidia")])
+
+    assert excinfo.value.step == "module_load: nvidia"
+    assert operations.calls == []
+
+
+def test_run_deadline_in_operation():
+    operations = FakeOperations()
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        run_plan([
+            operations.make("script_run", "nvidia-enable.sh", error=runner.DeadlineError("nvidia-enable.sh", 2.0)),
+            operations.make("module_load", "nvidia")
+        ])
+
+    assert excinfo.value.step == "nvidia-enable.sh"
+    assert operations.calls == [("nvidia-enable.sh",)]
+
+
+def test_run_records_latencies():
+    operations = FakeOperations()
+    run_plan([operations.make("module_load", "nvidia"), operations.make("module_load", "nvidia_drm")])
+    run_plan([operations.make("sysfs_write", "power/control = on")])
+
+    stats = var.read_operation_latencies()
+
+    assert stats["module_load"]["count"] == 2
+    assert stats["sysfs_write"]["count"] == 1
+    assert set(load_latencies().keys()) == {"module_load", "sysfs_write"}
+
+
+def test_run_concurrently():
+    # Independent operations run together: the barrier only opens once all are waiting on it
+    barrier = threading.Barrier(3, timeout=5.0)
+
+    run_plan([
+        make_operation("module_load", "nvidia", barrier.wait, requires=[]),
+        make_operation("xorg_conf_render", "nvidia mode", barrier.wait, requires=[]),
+        make_operation("file_read", "extra Xorg options", barrier.wait, requires=[])
+    ])
+
+
+def test_run_waits_for_requirements():
+    # Started only when what it requires is done, while the others keep running
+    done = []
+
+    def slow_load():
+        time.sleep(0.05)
+        done.append("nvidia")
+
+    def check_loaded():
+        assert "nvidia" in done
+        done.append("nvidia_drm")
+
+    load_operation = make_operation("module_load", "nvidia", slow_load, requires=[])
+    render_operation = make_operation("xorg_conf_render", "nvidia mode", lambda: done.append("render"), requires=[])
+    drm_operation = make_operation("module_load", "nvidia_drm", check_loaded, requires=[load_operation])
+
+    run_plan([load_operation, render_operation, drm_operation])
+
+    assert done == ["render", "nvidia", "nvidia_drm"]
+
+
+def test_run_drains_after_failure():
+    # The running operation is waited for, the one it would have unlocked isn't started
+    started = []
+    finished = []
+
+    def slow_unload():
+        started.append("nouveau")
+        time.sleep(0.1)
+        finished.append("nouveau")
+
+    def fail():
+        started.append("render")
+        raise ValueError("Invalid Xorg option")
+
+    unload_operation = make_operation("module_unload", "nouveau", slow_unload, requires=[])
+    render_operation = make_operation("xorg_conf_render", "nvidia mode", fail, requires=[])
+    load_operation = make_operation("module_load", "nvidia", started.append, "nvidia", requires=[unload_operation])
+
+    with pytest.raises(ValueError, match="Invalid Xorg option"):
+        run_plan([unload_operation, render_operation, load_operation])
+
+    assert sorted(started) == ["nouveau", "render"]
+    assert finished == ["nouveau"]
+
+
+def test_run_logs_timings(caplog):
+    operations = FakeOperations()
+
+    with caplog.at_level(logging.INFO):
+        run_plan([operations.make("module_load", "nvidia"), operations.make("module_load", "nvidia_drm")])
+
+    messages = [record.getMessage() for record in caplog.records]
+
+    assert any(message.startswith("Operation done in") and message.endswith("module_load: nvidia") for message in messages)
+    assert any(message.startswith("Operation done in") and message.endswith("module_load: nvidia_drm") for message in messages)
+    assert any(message.startswith("Plan done in") and "2 of 2 operations" in message for message in messages)
+
+
+def test_format_plan_critical_path():
+    # The Xorg conf is rendered beside the kernel steps: only the longest chain counts
+    var.write_operation_latencies({
+        "module_unload": {"count": 2, "total": 0.2},
+        "module_load": {"count": 4, "total": 1.2},
+        "xorg_conf_render": {"count": 1, "total": 0.05}
+    })
+
+    operations = FakeOperations()
+    unload_operation = operations.make("module_unload", "nouveau")
+    load_operation = operations.make("module_load", "nvidia")
+    render_operation = operations.make("xorg_conf_render", "nvidia mode", requires=[])
+    write_operation = operations.make(
+        "xorg_conf_write", "10-optimus-manager.conf", args=[ResultOf(render_operation)], requires=[])
+
+    assert format_plan([unload_operation, load_operation, render_operation, write_operation]) == "\n".join([
+        " 1. module_unload    nouveau                                          ~100.0ms",
+        " 2. module_load      nvidia                                           ~300.0ms",
+        " 3. xorg_conf_render nvidia mode                                      ~50.0ms    after nothing",
+        " 4. xorg_conf_write  10-optimus-manager.conf                          ?          after 3",
+        "Estimated total: ~400.0ms"
+    ])
+
+
+def test_format_plan_empty():
+    assert format_plan([]) == "Nothing to do\nEstimated total: ~0.0ms"
@@ -0,0 +1,105 @@
+import os
+import pwd
+from optimus_manager import processes
+from optimus_manager.pci import PciTopology
+from optimus_manager.processes import GpuUser
+
+USER = pwd.getpwuid(os.getuid()).pw_name
+
+
+def _add_nvidia_devices(proc_tree):
+    return {
+        name: proc_tree.add_device(name)
+        for name in ["nvidia0", "nvidiactl", "nvidia-modeset", "nvidia-uvm", "dri/card1", "dri/renderD129"]
+    }
+
+
+def test_nvidia_device_paths(pci_tree, proc_tree):
+    # The render node of the Nvidia card, not the one of the Intel GPU
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_device("dri/renderD128")
+    (pci_tree.devices_path / "0000:01:00.0" / "drm" / "card1").mkdir(parents=True)
+    (pci_tree.devices_path / "0000:01:00.0" / "drm" / "renderD129").mkdir()
+    (pci_tree.devices_path / "0000:00:02.0" / "drm" / "renderD128").mkdir(parents=True)
+
+    assert processes.get_nvidia_device_paths(PciTopology()) == {
+        devices[name] for name in ["nvidia0", "nvidiactl", "nvidia-modeset", "nvidia-uvm", "dri/renderD129"]
+    }
+
+
+def test_nvidia_device_paths_without_card(pci_tree, proc_tree):
+    devices = _add_nvidia_devices(proc_tree)
+    pci_tree.remove_device("0000:01:00.0")
+
+    assert processes.get_nvidia_device_paths(PciTopology()) == {
+        devices[name] for name in ["nvidia0", "nvidiactl", "nvidia-modeset", "nvidia-uvm"]
+    }
+
+
+def test_find_gpu_users(proc_tree):
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_process(1, "/sbin/init")
+    proc_tree.add_process(812, "/usr/bin/nvidia-persistenced --user nvidia-persistenced", fds=[devices["nvidiactl"]])
+    proc_tree.add_process(1504, "/usr/lib/firefox/firefox", fds=["/dev/dri/renderD128", "/tmp/cache"])
+    proc_tree.add_process(2210, "blender", fds=[devices["nvidia-uvm"], devices["nvidia0"]])
+    proc_tree.add_process(3001, "steam")
+
+    assert processes.find_gpu_users([devices["nvidia0"], devices["nvidiactl"], devices["nvidia-uvm"]]) == [
+        GpuUser(812, USER, devices["nvidiactl"], "/usr/bin/nvidia-persistenced --user nvidia-persistenced"),
+        GpuUser(2210, USER, devices["nvidia-uvm"], "blender")
+    ]
+
+
+def test_find_gpu_users_maps(proc_tree):
+    # Mapped without an open fd left, like after the driver handed out the mapping
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_process(4410, "glxgears", maps=["/usr/lib/libGLX_nvidia.so.0", devices["nvidia0"]])
+    proc_tree.add_process(4411, "glxinfo", maps=["/usr/lib/libGLX_mesa.so.0"])
+
+    assert processes.find_gpu_users([devices["nvidia0"]]) == [GpuUser(4410, USER, devices["nvidia0"], "glxgears")]
+
+
+def _exit_during_scan(proc_tree, monkeypatch, pid, before_fds):
+    # Makes the process exit when its fds are about to be read, or right after
+    find_fd_device = processes._find_process_fd_device
+
+    def find_fd_device_and_exit(process_path, device_paths):
+        exiting = os.path.basename(process_path) == str(pid)
+
+        if exiting and before_fds:
+            proc_tree.exit(pid)
+
+        device = find_fd_device(process_path, device_paths)
+
+        if exiting and not before_fds:
+            proc_tree.exit(pid)
+
+        return device
+
+    monkeypatch.setattr(processes, "_find_process_fd_device", find_fd_device_and_exit)
+
+
+def test_find_gpu_users_exited(proc_tree, monkeypatch):
+    # Exits after its fds were read, before its user and command line are
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_process(2210, "blender", fds=[devices["nvidia0"]])
+    proc_tree.add_process(2211, "blender --background", fds=[devices["nvidia0"]])
+    _exit_during_scan(proc_tree, monkeypatch, 2211, before_fds=False)
+
+    assert processes.find_gpu_users([devices["nvidia0"]]) == [GpuUser(2210, USER, devices["nvidia0"], "blender")]
+
+
+def test_find_gpu_users_exited_before_scan(proc_tree, monkeypatch):
+    # Listed, then gone before its fds and maps are read
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_process(2210, "blender", fds=[devices["nvidia0"]])
+    proc_tree.add_process(2211, "blender --background", fds=[devices["nvidia0"]])
+    _exit_during_scan(proc_tree, monkeypatch, 2211, before_fds=True)
+
+    assert processes.find_gpu_users([devices["nvidia0"]]) == [GpuUser(2210, USER, devices["nvidia0"], "blender")]
+
+
+def test_find_gpu_users_none(proc_tree):
+    devices = _add_nvidia_devices(proc_tree)
+    proc_tree.add_process(1, "/sbin/init")
+    assert processes.find_gpu_users([devices["nvidia0"]]) == []
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import socket
+import threading
+import pytest
+from optimus_manager import protocol
+from optimus_manager.protocol import ProtocolError
+
+
+def _read_messages(chunks):
+    # Fed to an asyncio stream in `chunks`, like reads split anywhere by the socket
+    async def read_all():
+        reader = asyncio.StreamReader()
+
+        for chunk in chunks:
+            reader.feed_data(chunk)
+
+        reader.feed_eof()
+        messages = []
+
+        while True:
+            message = await protocol.read_message(reader)
+
+            if message is None:
+                return messages
+
+            messages.append(message)
+
+    return asyncio.run(read_all())
+
+
+def test_encode_message():
+    data = protocol.encode_message({"id": 1, "type": "get_state"})
+    payload = json.dumps({"id": 1, "type": "get_state"}).encode()
+
+    assert data == len(payload).to_bytes(4, "big") + payload
+
+
+def test_decode_messages_split_header():
+    data = protocol.encode_message({"id": 1, "type": "get_state"})
+
+    assert protocol.decode_messages(data[:2]) == ([], data[:2])
+    assert protocol.decode_messages(data[:7]) == ([], data[:7])
+    assert protocol.decode_messages(data) == ([{"id": 1, "type": "get_state"}], b"")
+
+
+def test_decode_messages_several():
+    first = protocol.encode_message({"id": 1})
+    second = protocol.encode_message({"id": 2})
+    third = protocol.encode_message({"id": 3})
+
+    assert protocol.decode_messages(first + second + third[:5]) == ([{"id": 1}, {"id": 2}], third[:5])
+
+
+def test_decode_messages_too_big():
+    with pytest.raises(ProtocolError, match="too big"):
+        protocol.decode_messages((protocol.MAX_MESSAGE_SIZE + 1).to_bytes(4, "big"))
+
+
+def test_decode_messages_invalid():
+    with pytest.raises(ProtocolError, match="Invalid message"):
+        protocol.decode_messages((3).to_bytes(4, "big") + b"{x}")
+
+
+def test_encode_message_too_big():
+    with pytest.raises(ProtocolError, match="too big"):
+        protocol.encode_message({"content": "x" * protocol.MAX_MESSAGE_SIZE})
+
+
+def test_read_message_byte_by_byte():
+    data = protocol.encode_message({"id": 1}) + protocol.encode_message({"id": 2, "args": {"content": "é" * 3000}})
+    assert _read_messages([data[i:i + 1] for i in range(len(data))]) == [{"id": 1}, {"id": 2, "args": {"content": "é" * 3000}}]
+
+
+def test_read_message_several_in_one_read():
+    data = b"".join(protocol.encode_message({"id": request_id}) for request_id in range(5))
+    assert _read_messages([data]) == [{"id": request_id} for request_id in range(5)]
+
+
+def test_read_message_too_big():
+    # Refused from the header, before the payload is read
+    with pytest.raises(ProtocolError, match="too big"):
+        _read_messages([(protocol.MAX_MESSAGE_SIZE + 1).to_bytes(4, "big")])
+
+
+def test_read_message_eof_in_header():
+    with pytest.raises(ProtocolError, match="Truncated message header"):
+        _read_messages([b"\0\0"])
+
+
+def test_read_message_eof_in_payload():
+    with pytest.raises(ProtocolError, match="Truncated message"):
+        _read_messages([protocol.encode_message({"id": 1})[:-1]])
+
+
+def _serve_once(tmp_path, handle):
+    # A server answering one connection with `handle(data)`, where `data` is all it received
+    socket_path = str(tmp_path / "socket")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+
+    def serve():
+        connection, _ = server.accept()
+
+        with connection:
+            messages, _ = protocol.decode_messages(connection.recv(65536))
+            connection.sendall(handle(messages))
+
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return socket_path, thread
+
+
+def test_send_requests(tmp_path):
+    # Replies matched by ID, whatever their order, in several writes
+    def reply(messages):
+        replies = [protocol.encode_message(protocol.make_reply(message["id"], message["type"])) for message in messages]
+        data = b"".join(reversed(replies))
+        return data
+
+    socket_path, thread = _serve_once(tmp_path, reply)
+    results = protocol.send_requests([{"type": "get_state"}, {"type": "get_config"}], socket_path)
+    thread.join()
+
+    assert results == ["get_state", "get_config"]
+
+
+def test_send_requests_error(tmp_path):
+    socket_path, thread = _serve_once(tmp_path, lambda messages: b"".join(
+        protocol.encode_message(protocol.make_reply(message["id"], error="Unknown command type: foo"))
+        for message in messages))
+
+    with pytest.raises(protocol.RequestError, match="Unknown command type"):
+        protocol.send_request({"type": "foo"}, socket_path)
+
+    thread.join()
+
+
+def test_send_requests_closed_early(tmp_path):
+    # Only the first request answered
+    socket_path, thread = _serve_once(tmp_path, lambda messages: protocol.encode_message(
+        protocol.make_reply(messages[0]["id"])))
+
+    with pytest.raises(ProtocolError, match="No reply to request: get_config"):
+        protocol.send_requests([{"type": "get_state"}, {"type": "get_config"}], socket_path)
+
+    thread.join()
+
+
+def test_send_requests_no_daemon(tmp_path):
+    with pytest.raises(ProtocolError, match="Socket unavailable"):
+        protocol.send_request({"type": "get_state"}, str(tmp_path / "socket"))
@@ -0,0 +1,255 @@
+import logging
+import os
+import signal
+import threading
+import time
+import pytest
+from optimus_manager import runner
+
+
+@pytest.fixture(autouse=True)
+def no_deadline(monkeypatch):
+    monkeypatch.setattr(runner, "_deadline", None)
+
+
+@pytest.fixture(autouse=True, params=["pidfd", "fallback"])
+def process_support(request, monkeypatch):
+    # Every test runs again without pidfds nor `process_group`, like on Linux < 5.3 and Python < 3.11
+    if request.param == "fallback":
+        monkeypatch.setattr(runner, "_open_pidfd", lambda pid: None)
+        monkeypatch.setattr(runner, "PROCESS_GROUP_ARGS", {"preexec_fn": os.setpgrp})
+
+
+@pytest.fixture
+def sleeper(tmp_path):
+    # Stand-in for a stuck power switching or xsetup script: forks a sleep it doesn't wait for,
+    # which keeps the output pipes open, then sleeps itself. Returns the script and the fork PID file.
+    script_path = tmp_path / "sleeper.sh"
+    pid_path = tmp_path / "sleeper.pid"
+
+    script_path.write_text(
+        "#!/bin/sh\n"
+        "sleep 30 &\n"
+        "echo $! > %s\n"
+        "echo started\n"
+        "exec sleep \"${1:-30}\"\n" % pid_path)
+
+    script_path.chmod(0o755)
+    yield str(script_path), pid_path
+
+    if pid_path.exists():
+        try:
+            os.kill(int(pid_path.read_text()), signal.SIGKILL)
+
+        except ProcessLookupError:
+            pass
+
+
+def _is_running(pid):
+    # Killed processes may stay zombies if nothing reaps them
+    try:
+        with open("/proc/%d/stat" % pid, "r") as statfile:
+            return statfile.read().rsplit(")", 1)[1].split()[0] != "Z"
+
+    except FileNotFoundError:
+        return False
+
+
+def _wait_until_gone(pid, timeout=2.0):
+    end_time = time.monotonic() + timeout
+
+    while _is_running(pid) and time.monotonic() < end_time:
+        time.sleep(0.01)
+
+    return not _is_running(pid)
+
+
+def test_run_output():
+    result = runner.run(["sh", "-c", "echo out; echo err >&2"], capture_output=True)
+
+    assert result == runner.CommandResult(0, "out\n", "err\n")
+
+
+def test_run_no_stdout_capture():
+    result = runner.run(["sh", "-c", "echo out"])
+    assert result.stdout == ""
+
+
+def test_command_error_stderr():
+    with pytest.raises(runner.CommandError) as excinfo:
+        runner.run(["sh", "-c", "echo 'modprobe: FATAL: Module nvidia is in use.' >&2; exit 1"])
+
+    assert excinfo.value.returncode == 1
+    assert excinfo.value.stderr == "modprobe: FATAL: Module nvidia is in use.\n"
+    assert "Module nvidia is in use" in str(excinfo.value)
+
+
+def test_failure_without_check():
+    result = runner.run(["sh", "-c", "echo nope >&2; exit 3"], check=False)
+    assert result == runner.CommandResult(3, "", "nope\n")
+
+
+def test_missing_command():
+    result = runner.run(["/nonexistent/nvidia-enable.sh"], check=False)
+
+    assert result.returncode == runner.COMMAND_NOT_FOUND_CODE == 127
+    assert result.stderr
+
+
+def test_missing_command_check():
+    with pytest.raises(runner.CommandError) as excinfo:
+        runner.run(["/nonexistent/nvidia-enable.sh"])
+
+    assert excinfo.value.returncode is None
+    assert "Unable to run" in str(excinfo.value)
+
+
+def test_timeout_step_name(sleeper):
+    script_path, _ = sleeper
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        runner.run([script_path, "30"], timeout=0.2)
+
+    assert excinfo.value.step == "%s 30" % script_path
+    assert "Timed out after 0.2s" in str(excinfo.value)
+
+
+def test_timeout_kills_process_group(sleeper):
+    # The fork would outlive a kill of the script alone
+    script_path, pid_path = sleeper
+    start_time = time.monotonic()
+
+    with pytest.raises(runner.DeadlineError):
+        runner.run([script_path], capture_output=True, timeout=0.3)
+
+    assert time.monotonic() - start_time < 2.0
+    assert _wait_until_gone(int(pid_path.read_text()))
+
+
+def test_exit_with_background_fork(sleeper):
+    # Returns when the script exits, not when its fork closes the pipes
+    script_path, pid_path = sleeper
+    start_time = time.monotonic()
+    result = runner.run([script_path, "0"], capture_output=True, timeout=5.0)
+
+    assert time.monotonic() - start_time < 2.0
+    assert result.stdout == "started\n"
+    assert _is_running(int(pid_path.read_text()))
+
+
+def test_deadline_shared_across_runs():
+    runner.start_deadline(0.5)
+    runner.run(["sleep", "0.3"])
+    start_time = time.monotonic()
+
+    with pytest.raises(runner.DeadlineError) as excinfo:
+        runner.run(["sleep", "0.3"])
+
+    assert time.monotonic() - start_time < 0.3
+    assert excinfo.value.step == "sleep 0.3"
+
+
+def test_deadline_over():
+    runner.start_deadline(0.1)
+    time.sleep(0.15)
+    start_time = time.monotonic()
+
+    with pytest.raises(runner.DeadlineError, match="Timed out after 0.0s: true"):
+        runner.run(["true"])
+
+    with pytest.raises(runner.DeadlineError):
+        runner.check_deadline("xorg_conf_write")
+
+    assert time.monotonic() - start_time < 0.1
+
+
+def test_no_deadline():
+    runner.start_deadline(0)
+
+    assert runner.get_remaining_time() is None
+    assert runner.get_timeout(30.0) == 30.0
+    runner.run(["true"])
+    runner.check_deadline("xorg_conf_write")
+
+
+def test_get_timeout():
+    assert runner.get_timeout(30.0) == 30.0
+    runner.start_deadline(10.0)
+    assert runner.get_timeout(30.0) <= 10.0
+    assert runner.get_timeout(1.0) == 1.0
+
+
+def test_stats():
+    before = runner.get_stats().get("tests.test_runner:test_stats", (0, 0.0))
+    runner.run(["true"])
+    runner.run(["true"])
+    count, total_time = runner.get_stats()["tests.test_runner:test_stats"]
+
+    assert count == before[0] + 2
+    assert total_time > before[1]
+
+
+def _run_true_twice():
+    runner.run(["true"])
+    runner.run(["true"])
+
+
+def test_stats_per_caller():
+    # Counted for the function calling `run`, failures and missing commands included
+    before = runner.get_stats()
+    _run_true_twice()
+    runner.run(["false"], check=False)
+    runner.run(["/nonexistent/nvidia-enable.sh"], check=False)
+    stats = runner.get_stats()
+
+    assert stats["tests.test_runner:_run_true_twice"][0] == \
+        before.get("tests.test_runner:_run_true_twice", (0, 0.0))[0] + 2
+    assert stats["tests.test_runner:test_stats_per_caller"][0] == \
+        before.get("tests.test_runner:test_stats_per_caller", (0, 0.0))[0] + 2
+
+
+def test_stats_from_threads():
+    # Like the operations of a plan
+    def run_many():
+        for _ in range(5):
+            runner.run(["true"])
+
+    before = runner.get_stats().get("tests.test_runner:run_many", (0, 0.0))
+    threads = [threading.Thread(target=run_many) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert runner.get_stats()["tests.test_runner:run_many"][0] == before[0] + 20
+
+
+def test_log_stats(caplog):
+    runner.run(["true"])
+
+    with caplog.at_level(logging.INFO):
+        runner.log_stats()
+
+    assert any(
+        record.getMessage().startswith("Commands run from tests.test_runner:test_log_stats: ")
+        for record in caplog.records)
+
+
+def test_interrupted(sleeper, monkeypatch):
+    # The process group is killed before the interruption goes on
+    script_path, pid_path = sleeper
+
+    def interrupt(process, timeout):
+        while not pid_path.exists() or not pid_path.read_text().strip():
+            time.sleep(0.01)
+
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(runner, "_communicate", interrupt)
+
+    with pytest.raises(KeyboardInterrupt):
+        runner.run([script_path])
+
+    assert _wait_until_gone(int(pid_path.read_text()))
@@ -0,0 +1,110 @@
+import errno
+import socket
+import pytest
+from optimus_manager.uevent import UeventMonitor, parse_uevent
+
+NVIDIA_ADD_UEVENT = (
+    b"add@/devices/pci0000:00/0000:00:01.0/0000:01:00.0\0"
+    b"ACTION=add\0"
+    b"DEVPATH=/devices/pci0000:00/0000:00:01.0/0000:01:00.0\0"
+    b"SUBSYSTEM=pci\0"
+    b"PCI_CLASS=30000\0"
+    b"PCI_ID=10DE:1F91\0"
+    b"MODALIAS=pci:v000010DEd00001F91sv00001043sd000018EFbc03sc00i00\0"
+    b"SEQNUM=4312\0"
+)
+
+
+class FakeUeventSocket:
+    # Readable through a socket pair, `recv` returns or raises what it is given in turn
+
+    def __init__(self, results):
+        self._results = list(results)
+        self._reader, self._writer = socket.socketpair()
+        self._writer.send(b"x")
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def recv(self, size, flags=0):
+        if not self._results:
+            raise BlockingIOError(errno.EAGAIN, "Resource temporarily unavailable")
+
+        result = self._results.pop(0)
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+def _make_monitor(results):
+    monitor = UeventMonitor.__new__(UeventMonitor)
+    monitor._socket = FakeUeventSocket(results)
+    return monitor
+
+
+def test_parse_uevent():
+    event = parse_uevent(NVIDIA_ADD_UEVENT)
+
+    assert event["ACTION"] == "add"
+    assert event["SUBSYSTEM"] == "pci"
+    assert event["PCI_ID"] == "10DE:1F91"
+    assert event["DEVPATH"] == "/devices/pci0000:00/0000:00:01.0/0000:01:00.0"
+    assert event["SEQNUM"] == "4312"
+    assert "add@/devices/pci0000:00/0000:00:01.0/0000:01:00.0" not in event
+
+
+def test_parse_uevent_action_from_header():
+    event = parse_uevent(b"remove@/devices/pci0000:00/0000:00:01.0/0000:01:00.0\0SUBSYSTEM=pci\0")
+
+    assert event == {
+        "ACTION": "remove",
+        "DEVPATH": "/devices/pci0000:00/0000:00:01.0/0000:01:00.0",
+        "SUBSYSTEM": "pci"
+    }
+
+
+def test_parse_uevent_value_with_equal_sign():
+    event = parse_uevent(b"change@/devices/virtual/x\0ACTION=change\0PARAMS=a=1 b=2\0")
+    assert event["PARAMS"] == "a=1 b=2"
+
+
+def test_parse_uevent_invalid_utf8():
+    event = parse_uevent(b"add@/devices/x\0ACTION=add\0NAME=\xff\xfe\0")
+
+    assert event["ACTION"] == "add"
+    assert event["NAME"] == "��"
+
+
+def test_monitor_wait():
+    monitor = _make_monitor([NVIDIA_ADD_UEVENT, b"remove@/devices/x\0SUBSYSTEM=usb\0"])
+
+    with monitor:
+        events = monitor.wait(1.0)
+
+    assert [event["ACTION"] for event in events] == ["add", "remove"]
+    assert events[0]["PCI_ID"] == "10DE:1F91"
+
+
+def test_monitor_wait_lost_events():
+    # After an overflow, what is left in the buffer is still read
+    monitor = _make_monitor([OSError(errno.ENOBUFS, "No buffer space available"), NVIDIA_ADD_UEVENT])
+
+    with monitor:
+        events = monitor.wait(1.0)
+
+    assert events[0] == {"ACTION": "add"}
+    assert events[1]["PCI_ID"] == "10DE:1F91"
+
+
+def test_monitor_wait_other_error():
+    monitor = _make_monitor([OSError(errno.EBADF, "Bad file descriptor")])
+
+    with monitor:
+        with pytest.raises(OSError):
+            monitor.wait(1.0)
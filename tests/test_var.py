@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+from optimus_manager import envs
+from optimus_manager import var
+from tests.fakes import age_file
+
+
+def _write_states(switch_id, count):
+    for _ in range(count):
+        var.write_state({"type": "done", "switch_id": switch_id, "current_mode": "hybrid"})
+
+
+def test_write_state(fake_vars):
+    state = {"type": "pending_pre_xorg_start", "switch_id": "20261018T193052", "requested_mode": "nvidia"}
+    var.write_state(state)
+
+    assert var.load_state() == state
+    assert os.listdir(os.path.dirname(envs.STATE_FILE_PATH)) == ["state.json"]
+
+
+def test_write_state_concurrently(fake_vars):
+    # Like the daemon and a hook: no writer fails, no reader sees a partial state
+    var.write_state({"type": "done", "switch_id": "0", "current_mode": "integrated"})
+    context = multiprocessing.get_context("fork")
+    writers = [context.Process(target=_write_states, args=(str(index), 300)) for index in [1, 2]]
+
+    for writer in writers:
+        writer.start()
+
+    while any(writer.is_alive() for writer in writers):
+        assert var.load_state()["type"] == "done"
+
+    for writer in writers:
+        writer.join()
+
+    assert [writer.exitcode for writer in writers] == [0, 0]
+    assert var.load_state()["switch_id"] in ["1", "2"]
+    assert os.listdir(os.path.dirname(envs.STATE_FILE_PATH)) == ["state.json"]
+
+
+def test_load_state_missing(fake_vars):
+    assert var.load_state() is None
+    assert var.get_state_file_key() is None
+
+
+def test_files_key(tmp_path):
+    # Changes on edit, creation and removal
+    first_path = tmp_path / "first.conf"
+    second_path = tmp_path / "second.conf"
+    first_path.write_text("[optimus]\n")
+    paths = [str(first_path), str(second_path)]
+    key = var.get_files_key(paths)
+
+    assert key[1] == [str(second_path), None, None, None]
+    assert var.get_files_key(paths) == key
+
+    second_path.write_text("[nvidia]\n")
+    created_key = var.get_files_key(paths)
+    assert created_key != key
+
+    age_file(first_path, 10)
+    first_path.write_text("[intel]\n")
+    edited_key = var.get_files_key(paths)
+    assert edited_key != created_key
+
+    os.remove(second_path)
+    assert var.get_files_key(paths) not in [key, created_key, edited_key]
+
+
+def test_files_key_same_size_edit(tmp_path):
+    # Told apart by the mtime
+    path = tmp_path / "optimus-manager.conf"
+    path.write_text("switching=none\n")
+    age_file(path, 10)
+    key = var.get_files_key([str(path)])
+
+    path.write_text("switching=nouv\n")
+    assert var.get_files_key([str(path)]) != key
+
+
+def test_files_key_racy(tmp_path):
+    path = tmp_path / "optimus-manager.conf"
+    path.write_text("[optimus]\n")
+    missing_path = tmp_path / "missing.conf"
+
+    assert var.is_files_key_racy(var.get_files_key([str(path), str(missing_path)]))
+
+    age_file(path, var.RACY_DELAY_NS / 1e9 + 1)
+    assert not var.is_files_key_racy(var.get_files_key([str(path), str(missing_path)]))
@@ -0,0 +1,230 @@
+import os
+import pytest
+from optimus_manager import checks
+from optimus_manager import envs
+from optimus_manager import xorg
+from tests.fakes import age_file, make_config
+
+BUS_IDS = {"nvidia": "PCI:1:0:0", "intel": "PCI:0:2:0"}
+
+FILES_SECTION = "Section \"Files\"\n%sEndSection\n\n" % "".join(
+    "\tModulePath \"%s\"\n" % path for path in xorg.NVIDIA_MODULE_PATHS)
+
+INTEGRATED_CONF = """\
+Section "ServerLayout"
+	Identifier "layout"
+	Screen 0 "integrated"
+EndSection
+
+Section "Monitor"
+	Identifier "monitor0"
+EndSection
+
+Section "Device"
+	Identifier "integrated"
+	Driver "modesetting"
+	BusID "PCI:0:2:0"
+	Option "DRI" "3"
+EndSection
+
+Section "Screen"
+	Identifier "integrated"
+	Device "integrated"
+	Monitor "monitor0"
+EndSection
+
+"""
+
+HYBRID_CONF = FILES_SECTION + """\
+Section "ServerLayout"
+	Identifier "layout"
+	Screen 0 "integrated"
+	Inactive "nvidia"
+	Option "AllowNVIDIAGPUScreens"
+EndSection
+
+Section "Device"
+	Identifier "integrated"
+	Driver "modesetting"
+	BusID "PCI:0:2:0"
+	Option "DRI" "3"
+EndSection
+
+Section "Screen"
+	Identifier "integrated"
+	Device "integrated"
+EndSection
+
+Section "Device"
+	Identifier "nvidia"
+	Driver "nvidia"
+	BusID "PCI:1:0:0"
+EndSection
+
+Section "Screen"
+	Identifier "nvidia"
+	Device "nvidia"
+EndSection
+
+"""
+
+NVIDIA_CONF = FILES_SECTION + """\
+Section "ServerLayout"
+	Identifier "layout"
+	Screen 0 "nvidia"
+	Inactive "integrated"
+EndSection
+
+Section "Device"
+	Identifier "nvidia"
+	Driver "nvidia"
+	BusID "PCI:1:0:0"
+EndSection
+
+Section "Screen"
+	Identifier "nvidia"
+	Device "nvidia"
+	Option "AllowEmptyInitialConfiguration"
+EndSection
+
+Section "Device"
+	Identifier "integrated"
+	Driver "modesetting"
+	Option "AccelMethod" "none"
+	BusID "PCI:0:2:0"
+EndSection
+
+Section "Screen"
+	Identifier "integrated"
+	Device "integrated"
+EndSection
+
+"""
+
+
+@pytest.fixture(autouse=True)
+def xorg_modules(monkeypatch):
+    # Neither the intel nor the amdgpu Xorg module installed
+    monkeypatch.setattr(checks, "is_xorg_intel_module_available", lambda: False)
+    monkeypatch.setattr(checks, "is_xorg_amdgpu_module_available", lambda: False)
+
+
+@pytest.fixture
+def xorg_conf_path(tmp_path, monkeypatch):
+    path = tmp_path / "xorg.conf.d" / "10-optimus-manager.conf"
+    monkeypatch.setattr(envs, "XORG_CONF_PATH", str(path))
+    return path
+
+
+def _make_xorg_extra(lines_by_mode_and_gpu=None):
+    xorg_extra = {mode: {gpu: [] for gpu in paths} for mode, paths in envs.EXTRA_XORG_OPTIONS_PATHS.items()}
+
+    for (mode, gpu), lines in (lines_by_mode_and_gpu or {}).items():
+        xorg_extra[mode][gpu] = lines
+
+    return xorg_extra
+
+
+def test_render_integrated():
+    assert xorg.render_xorg_conf(make_config(), BUS_IDS, _make_xorg_extra(), "integrated") == INTEGRATED_CONF
+
+
+def test_render_hybrid():
+    assert xorg.render_xorg_conf(make_config(), BUS_IDS, _make_xorg_extra(), "hybrid") == HYBRID_CONF
+
+
+def test_render_nvidia():
+    assert xorg.render_xorg_conf(make_config(), BUS_IDS, _make_xorg_extra(), "nvidia") == NVIDIA_CONF
+
+
+def test_render_options():
+    config = make_config(
+        intel={"accel": "sna", "tearfree": "yes", "dri": "2"},
+        nvidia={"options": "overclocking, triple_buffer", "ignore_abi": "yes", "allow_external_gpus": "yes"})
+
+    xorg_extra = _make_xorg_extra({
+        ("hybrid-mode", "integrated-gpu"): ["Option \"Backlight\" \"intel_backlight\""],
+        ("hybrid-mode", "nvidia-gpu"): ["Option \"ConnectToAcpid\" \"0\""]
+    })
+
+    conf = xorg.render_xorg_conf(config, BUS_IDS, xorg_extra, "hybrid")
+
+    assert "\tBusID \"PCI:0:2:0\"\n" \
+           "\tOption \"AccelMethod\" \"sna\"\n" \
+           "\tOption \"TearFree\" \"true\"\n" \
+           "\tOption \"DRI\" \"2\"\n" \
+           "\tOption \"Backlight\" \"intel_backlight\"\n" in conf
+
+    assert "\tBusID \"PCI:1:0:0\"\n" \
+           "\tOption \"Coolbits\" \"28\"\n" \
+           "\tOption \"TripleBuffer\" \"true\"\n" \
+           "\tOption \"ConnectToAcpid\" \"0\"\n" in conf
+
+    assert "\tDevice \"integrated\"\n\tOption \"AllowExternalGpus\"\n" in conf
+    assert conf.endswith("Section \"ServerFlags\"\n\tOption \"IgnoreABI\" \"1\"\nEndSection\n\n")
+
+
+def test_render_intel_driver(monkeypatch):
+    config = make_config(intel={"driver": "intel"})
+    assert "\tDriver \"modesetting\"\n" in xorg.render_xorg_conf(config, BUS_IDS, _make_xorg_extra(), "integrated")
+
+    monkeypatch.setattr(checks, "is_xorg_intel_module_available", lambda: True)
+    assert "\tDriver \"intel\"\n" in xorg.render_xorg_conf(config, BUS_IDS, _make_xorg_extra(), "integrated")
+
+
+def test_render_amd():
+    bus_ids = {"nvidia": "PCI:1:0:0", "amd": "PCI:5:0:0"}
+    config = make_config(amd={"driver": "hybrid", "tearfree": "no"})
+    conf = xorg.render_xorg_conf(config, bus_ids, _make_xorg_extra(), "integrated")
+
+    assert "\tIdentifier \"integrated\"\n" \
+           "\tDriver \"amdgpu\"\n" \
+           "\tBusID \"PCI:5:0:0\"\n" \
+           "\tOption \"TearFree\" \"false\"\n" in conf
+
+
+def test_write_xorg_conf(xorg_conf_path):
+    xorg._write_xorg_conf(INTEGRATED_CONF)
+
+    assert xorg_conf_path.read_text() == INTEGRATED_CONF
+    assert os.stat(xorg_conf_path).st_mode & 0o777 == 0o644
+    assert os.listdir(xorg_conf_path.parent) == [xorg_conf_path.name]
+
+
+def test_write_xorg_conf_unchanged(xorg_conf_path):
+    # Not written again: its mtime stays
+    xorg._write_xorg_conf(INTEGRATED_CONF)
+    age_file(xorg_conf_path, 10)
+    stat = os.stat(xorg_conf_path)
+
+    xorg._write_xorg_conf(INTEGRATED_CONF)
+    assert os.stat(xorg_conf_path).st_mtime_ns == stat.st_mtime_ns
+    assert os.stat(xorg_conf_path).st_ino == stat.st_ino
+
+
+def test_write_xorg_conf_changed(xorg_conf_path):
+    # Replaced by a rename: a reader of the old file still sees all of it
+    xorg._write_xorg_conf(INTEGRATED_CONF)
+
+    with open(xorg_conf_path, "r") as old_file:
+        xorg._write_xorg_conf(HYBRID_CONF)
+        assert old_file.read() == INTEGRATED_CONF
+
+    assert xorg_conf_path.read_text() == HYBRID_CONF
+    assert os.listdir(xorg_conf_path.parent) == [xorg_conf_path.name]
+
+
+def test_write_xorg_conf_failure(xorg_conf_path, monkeypatch):
+    # The previous conf is kept whole, the temp file removed
+    xorg._write_xorg_conf(INTEGRATED_CONF)
+
+    def failing_replace(source, destination):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(xorg.os, "replace", failing_replace)
+
+    with pytest.raises(xorg.XorgSetupError, match="Unable to write Xorg conf"):
+        xorg._write_xorg_conf(HYBRID_CONF)
+
+    assert xorg_conf_path.read_text() == INTEGRATED_CONF
+    assert os.listdir(xorg_conf_path.parent) == [xorg_conf_path.name]